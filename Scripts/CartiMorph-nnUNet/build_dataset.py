@@ -0,0 +1,232 @@
+"""
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+Build an nnUNet task from the data split sheets
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+The subjects listed in the split sheets (e.g. CartiMorph_dataset2.xlsx for training and
+CartiMorph_dataset3.xlsx for testing) are linked into the raw data folder of the task
+with the nnUNet naming, instead of being copied:
+    [nnUNet_raw_data]/[task_name]/imagesTr/<case>_0000.nii.gz  ->  [dir_img]/<SubjectID>.nii.gz
+    [nnUNet_raw_data]/[task_name]/labelsTr/<case>.nii.gz       ->  [dir_seg]/<SubjectID>.nii.gz
+    (imagesTs and labelsTs for the test sheet)
+Hard links are used by default (symbolic links if the raw data folder is on another
+file system). Before linking, every image/label pair is checked in parallel: the shapes
+and affine matrices are compared from the headers only, and the label values must be
+within {0, ..., nb_labels - 1}. The dataset.json file is then written as by
+"generate_dataset_json.py".
+
+Usage:
+    python build_dataset.py --task_name Task106_OAIZIB --dir_img path/to/images --dir_seg path/to/labels \
+        --train_sheet CartiMorph_dataset2.xlsx --test_sheet CartiMorph_dataset3.xlsx
+
+Copyright 2023 Yongcheng Yao
+
+-----------------------------------------------------------------------------------
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+compliance with the License. You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is
+distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+implied. See the License for the specific language governing permissions and limitations under
+the License.
+-----------------------------------------------------------------------------------
+"""
+
+import os
+import re
+import sys
+import time
+import errno
+import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# header reading of the image catalog
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'utility'))
+from niiCatalog import read_header, axcodes
+
+IMAGE_EXTENSIONS = ('.nii.gz', '.nii')
+
+
+def read_sheet(path_sheet, id_column='SubjectID'):
+    """
+    Subject IDs of a split sheet (.xlsx or .csv).
+    """
+    import pandas as pd
+    table = pd.read_csv(path_sheet) if path_sheet.endswith('.csv') else pd.read_excel(path_sheet)
+    if id_column not in table.columns:
+        raise ValueError(f"Column '{id_column}' is not found in '{path_sheet}'")
+    return [str(subID) for subID in table[id_column].dropna().astype(str)]
+
+
+def find_file(folder, subID):
+    for ext in IMAGE_EXTENSIONS:
+        path = os.path.join(folder, subID + ext)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def check_case(path_img, path_seg, nb_labels, check_values=True, atol=1e-3):
+    """
+    Issues of an image/label pair: shape and affine matrix (from the headers) and label values.
+    """
+    issues = []
+    shape_img, _, _, affine_img = read_header(path_img)
+    if path_seg is None:
+        return issues
+    shape_seg, dtype_seg, _, affine_seg = read_header(path_seg)
+    if list(shape_img) != list(shape_seg):
+        issues.append(f'shape of the label {tuple(shape_seg)} differs from the image {tuple(shape_img)}')
+    elif not np.allclose(affine_img, affine_seg, atol=atol):
+        issues.append(f'affine matrix of the label ({axcodes(affine_seg)}) differs from the image ({axcodes(affine_img)})')
+    if check_values:
+        import nibabel as nib
+        data = np.asanyarray(nib.load(path_seg).dataobj)
+        if not np.issubdtype(data.dtype, np.integer):
+            if not np.array_equal(data, np.rint(data)):
+                issues.append(f'non-integer label values (dtype {data.dtype})')
+            data = np.rint(data).astype(np.int64)
+        if data.size and (data.min() < 0 or data.max() >= nb_labels):
+            values = np.unique(data)
+            bad = values[(values < 0) | (values >= nb_labels)]
+            issues.append(f'label values {bad.tolist()} outside of 0-{nb_labels - 1}')
+    return issues
+
+
+def _check_case(task):
+    case = task[0]
+    try:
+        return case, check_case(*task[1:])
+    except Exception as e:
+        return case, [f'unreadable file ({type(e).__name__}: {e})']
+
+
+def link_file(source, target, mode):
+    """
+    Links (or copies) source to target; returns the mode used (hard links fall back to symbolic links across file systems).
+    """
+    source = os.path.abspath(source)
+    if os.path.lexists(target):
+        if os.path.islink(target) and os.readlink(target) == source:
+            return 'sym'
+        if not os.path.islink(target) and os.path.samefile(source, target):
+            return 'hard'
+        os.remove(target)
+    if mode == 'hard':
+        try:
+            os.link(source, target)
+            return 'hard'
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            mode = 'sym'
+    if mode == 'sym':
+        os.symlink(source, target)
+    else:
+        shutil.copy2(source, target)
+    return mode
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build an nnUNet task (links and dataset.json) from data split sheets')
+    parser.add_argument('--task_name', type=str, required=True, help='task name in the form of Task[xxx]_[task-name]')
+    parser.add_argument('--dir_img', type=str, required=True, help='folder of the images (<SubjectID>.nii.gz)')
+    parser.add_argument('--dir_seg', type=str, required=True, help='folder of the segmentation masks (<SubjectID>.nii.gz)')
+    parser.add_argument('--train_sheet', type=str, required=True, help='split sheet (.xlsx or .csv) of the training subjects')
+    parser.add_argument('--test_sheet', type=str, help='(optional) split sheet of the test subjects')
+    parser.add_argument('--id_column', type=str, default='SubjectID', help='column of the subject IDs in the sheets (default: SubjectID)')
+    parser.add_argument('--case_prefix', type=str, default='', help='prefix of the case names, e.g. "oaizib_" (default: none)')
+    parser.add_argument('--dir_raw', type=str, help='nnUNet raw data folder (default: nnUNet_raw_data of "nnUNet_raw_data_base")')
+    parser.add_argument('--link', type=str, default='hard', choices=['hard', 'sym', 'copy'], help='hard links, symbolic links or copies (default: hard)')
+    parser.add_argument('--nb_labels', type=int, default=6, help='number of labels including background (default: 6)')
+    parser.add_argument('--skip_value_check', action='store_true', help='only check the headers, not the label values')
+    parser.add_argument('--clean', action='store_true', help='remove the files of the task folders that are not in the sheets')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(), help='Number of worker processes (default: number of CPUs)')
+    args = parser.parse_args()
+
+    if not re.fullmatch(r'Task\d{3}_\S+', args.task_name):
+        raise ValueError(f"Task name should be in the form of Task[xxx]_[task-name], but found '{args.task_name}'")
+    if args.dir_raw is None:
+        from CartiMorph_nnUNet.paths import nnUNet_raw_data
+        if nnUNet_raw_data is None:
+            raise ValueError('Set "nnUNet_raw_data_base" or add "--dir_raw".')
+        args.dir_raw = nnUNet_raw_data
+    target_base = os.path.join(args.dir_raw, args.task_name)
+
+    # cases of the training and test sets
+    splits = {'Tr': read_sheet(args.train_sheet, args.id_column)}
+    if args.test_sheet:
+        splits['Ts'] = read_sheet(args.test_sheet, args.id_column)
+    overlap = set(splits['Tr']) & set(splits.get('Ts', []))
+    if overlap:
+        raise ValueError(f'Subjects in both the training and the test sheets: {sorted(overlap)}')
+
+    cases, issues = [], {}
+    for split, subIDs in splits.items():
+        for subID in subIDs:
+            case = args.case_prefix + subID
+            path_img = find_file(args.dir_img, subID)
+            path_seg = find_file(args.dir_seg, subID)
+            if path_img is None:
+                issues[case] = [f"image not found in '{args.dir_img}'"]
+            elif path_seg is None and split == 'Tr':
+                issues[case] = [f"label not found in '{args.dir_seg}'"]
+            elif not all(path.endswith('.nii.gz') for path in (path_img, path_seg) if path is not None):
+                issues[case] = ['nnUNet expects .nii.gz files, but found ' + ', '.join(
+                    f"'{path}'" for path in (path_img, path_seg) if path is not None and not path.endswith('.nii.gz'))]
+            else:
+                cases.append((split, case, path_img, path_seg))
+    print(f'{len(splits["Tr"])} training and {len(splits.get("Ts", []))} test subjects')
+
+    # check the image/label pairs in parallel
+    time_start = time.time()
+    tasks = [(case, path_img, path_seg, args.nb_labels, not args.skip_value_check) for _, case, path_img, path_seg in cases]
+    with ProcessPoolExecutor(max_workers=max(1, args.num_workers)) as pool:
+        for case, case_issues in pool.map(_check_case, tasks, chunksize=4):
+            if case_issues:
+                issues[case] = case_issues
+    print(f'Checked {len(tasks)} subjects in {time.time() - time_start:.1f} s')
+    if issues:
+        for case, case_issues in sorted(issues.items()):
+            for issue in case_issues:
+                print(f'{case}: {issue}')
+        raise SystemExit(f'{len(issues)} subject(s) with issues; the task folder was not changed')
+
+    # link the images and labels with the nnUNet naming
+    expected = set()
+    modes = {}
+    for split, case, path_img, path_seg in cases:
+        targets = [(path_img, os.path.join(target_base, 'images' + split, case + '_0000.nii.gz'))]
+        if path_seg is not None:
+            targets.append((path_seg, os.path.join(target_base, 'labels' + split, case + '.nii.gz')))
+        for source, target in targets:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            mode = link_file(source, target, args.link)
+            modes[mode] = modes.get(mode, 0) + 1
+            expected.add(os.path.abspath(target))
+    print(f'Linked {sum(modes.values())} files ({", ".join(f"{n} {mode}" for mode, n in modes.items())})')
+
+    # files of earlier builds that are not in the sheets
+    for folder in ('imagesTr', 'labelsTr', 'imagesTs', 'labelsTs'):
+        path_folder = os.path.join(target_base, folder)
+        if not os.path.isdir(path_folder):
+            continue
+        for name in sorted(os.listdir(path_folder)):
+            path = os.path.abspath(os.path.join(path_folder, name))
+            if path not in expected:
+                if args.clean:
+                    os.remove(path)
+                    print(f'Removed {path}')
+                else:
+                    print(f'Warning: {path} is not in the sheets (remove it with "--clean")')
+    if 'Ts' not in splits:
+        os.makedirs(os.path.join(target_base, 'imagesTs'), exist_ok=True)
+
+    # write dataset.json
+    from generate_dataset_json import write_dataset_json
+    write_dataset_json(args.task_name, raw_data=args.dir_raw)
+    print(f'Wrote {os.path.join(target_base, "dataset.json")}')
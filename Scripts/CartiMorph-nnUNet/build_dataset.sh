@@ -0,0 +1,48 @@
+# e.g. ~/Documents/anaconda3/etc/profile.d/conda.sh 
+source /path/to/anaconda3/etc/profile.d/conda.sh 
+
+conda activate CartiMorphToolbox-nnUNet 
+
+# ----------------------------------------------
+# set paths for CartiMorph-nnUNet, a work based on nnUNet
+# FYI: https://github.com/MIC-DKFZ/nnUNet/blob/nnunetv1/documentation/setting_up_paths.md
+# ----------------------------------------------
+# raw data folder -- required by nnUNet
+# e.g. nnUNet_raw_data_base='~/Documents/CartiMorph/Models_training/nnUNet/nnUNet_raw_data_base' 
+export nnUNet_raw_data_base='path/to/raw/data/folder/nnUNet_raw_data_base' 
+
+# preprocessed data folder -- required by nnUNet
+# e.g. nnUNet_preprocessed='~/Documents/CartiMorph/Models_training/nnUNet/nnUNet_preprocessed' 
+export nnUNet_preprocessed='path/to/preprocessed/data/folder/nnUNet_preprocessed' 
+
+# result folder -- required by nnUNet
+# e.g. RESULTS_FOLDER='~/Documents/CartiMorph/Models_training/nnUNet/nnUNet_trained_models' 
+export RESULTS_FOLDER='path/to/result/folder/nnUNet_trained_models' 
+# ----------------------------------------------
+
+# [Folder]
+# path to the folder containing the pyhton script "build_dataset.py"
+# e.g. dir_scripts='~/Documents/CartiMorph/Scripts/CartiMorph-nnUNet' 
+export dir_scripts='path/to/python/script/folder' 
+
+# folders of the images and the segmentation masks (<SubjectID>.nii.gz)
+export dir_img='path/to/image/folder'
+export dir_seg='path/to/segmentation/folder'
+
+# [Data split]
+# e.g. train_sheet='~/Documents/CartiMorph/Dataset/OAIZIB/CartiMorph_dataset2.xlsx'
+export train_sheet='path/to/training/split/sheet.xlsx'
+# e.g. test_sheet='~/Documents/CartiMorph/Dataset/OAIZIB/CartiMorph_dataset3.xlsx'
+export test_sheet='path/to/test/split/sheet.xlsx'
+
+# task name in the form of Task[xxx]_[task-name]
+export task_name='Task106_test6'
+
+# hard (default), sym (symbolic links) or copy
+export link=hard
+
+# [Logging] 
+export log_file='path/to/log/file/build_dataset.log' 
+
+# link the images and labels into the task folder, check them, and generate the dataset json file
+python $dir_scripts/build_dataset.py --task_name "$task_name" --dir_img "$dir_img" --dir_seg "$dir_seg" --train_sheet "$train_sheet" --test_sheet "$test_sheet" --link "$link" > "$log_file" 2>&1
@@ -0,0 +1,218 @@
+"""
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+Model ensemble from the softmax exports of nnUNet, slab by slab
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+A replacement of "CartiMorph_nnUNet_ensemble" for large images. The nnUNet ensemble
+loads the full softmax volume of every configuration (e.g. 6 x 160 x 384 x 384) and
+averages them in memory. Here the softmax exports (<case>.npz and <case>.pkl, written
+by "CartiMorph_nnUNet_predict" with "-z") are read as float16 streams in file order
+(class by class, z slab by z slab), the weighted average of each slab is compared with
+the best class so far, and the argmax segmentation is written directly with the
+geometry of the raw image. The memory needed for one case is one slab per
+configuration plus the running maximum (float32) and the argmax (uint8) of one volume,
+and the cases are processed in parallel. With equal weights, the segmentation is the
+one of "CartiMorph_nnUNet_ensemble" up to near-ties (nnUNet rounds the mean to float16,
+the average is kept in float32 here); the postprocessing (postprocessing.json) of the
+ensemble is then applied in the same way.
+
+Usage:
+    python ensemble_softmax.py -f path/to/2d path/to/3dCF -o path/to/2d3dCF -pp postprocessing.json --weights 1 1
+
+Copyright 2023 Yongcheng Yao
+
+-----------------------------------------------------------------------------------
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+compliance with the License. You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is
+distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+implied. See the License for the specific language governing permissions and limitations under
+the License.
+-----------------------------------------------------------------------------------
+"""
+
+import os
+import time
+import pickle
+import shutil
+import zipfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+
+class SoftmaxReader:
+    """
+    Sequential reader of the softmax array (C, Z, Y, X) of an nnUNet export (.npz or .npy).
+    """
+
+    def __init__(self, path, key='softmax'):
+        self.zip = None
+        if path.endswith('.npz'):
+            # the compressed member is decompressed as it is read
+            self.zip = zipfile.ZipFile(path)
+            self.file = self.zip.open(key + '.npy')
+        else:
+            self.file = open(path, 'rb')
+        version = np.lib.format.read_magic(self.file)
+        if version == (1, 0):
+            self.shape, fortran_order, self.dtype = np.lib.format.read_array_header_1_0(self.file)
+        else:
+            self.shape, fortran_order, self.dtype = np.lib.format.read_array_header_2_0(self.file)
+        if fortran_order or len(self.shape) != 4:
+            raise ValueError(f"Expected a C-ordered array of shape (C, Z, Y, X) in '{path}', but found {self.shape}")
+
+    def read(self, nb_slices):
+        """
+        The next nb_slices z slices (in file order) of the current class.
+        """
+        slab = np.empty((nb_slices,) + tuple(self.shape[2:]), dtype=self.dtype)
+        view = memoryview(slab).cast('B')
+        filled = 0
+        while filled < len(view):
+            n = self.file.readinto(view[filled:])
+            if not n:
+                raise EOFError('Softmax export ended early')
+            filled += n
+        return slab
+
+    def close(self):
+        self.file.close()
+        if self.zip is not None:
+            self.zip.close()
+
+
+def find_export(folder, case):
+    for ext in ('.npz', '.npy'):
+        path = os.path.join(folder, case + ext)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def ensemble_case(paths_softmax, weights, slab_size=16):
+    """
+    Argmax (uint8, shape (Z, Y, X)) of the weighted average of the softmax exports, slab by slab.
+    """
+    readers = [SoftmaxReader(path) for path in paths_softmax]
+    try:
+        shape = readers[0].shape
+        for reader, path in zip(readers[1:], paths_softmax[1:]):
+            if reader.shape != shape:
+                raise ValueError(f"Softmax shape {reader.shape} of '{path}' differs from {shape} of '{paths_softmax[0]}'")
+        nb_classes, nb_slices = shape[0], shape[1]
+        best = np.empty(shape[1:], dtype=np.float32)
+        seg = np.zeros(shape[1:], dtype=np.uint8)
+        for c in range(nb_classes):
+            for z in range(0, nb_slices, slab_size):
+                n = min(slab_size, nb_slices - z)
+                prob = np.zeros((n,) + tuple(shape[2:]), dtype=np.float32)
+                for reader, weight in zip(readers, weights):
+                    # in float32: a Python float times a float16 array stays float16 (NumPy 2)
+                    prob += weight * reader.read(n).astype(np.float32)
+                if c == 0:
+                    best[z:z + n] = prob
+                else:
+                    # strict comparison: ties go to the lower class, as np.argmax
+                    better = prob > best[z:z + n]
+                    best[z:z + n][better] = prob[better]
+                    seg[z:z + n][better] = c
+    finally:
+        for reader in readers:
+            reader.close()
+    return seg
+
+
+def save_segmentation(seg, properties, path_out):
+    """
+    Puts the segmentation into the cropping bounding box of the raw image and saves it with the geometry of the raw image.
+    """
+    import SimpleITK as sitk
+    bbox = properties.get('crop_bbox')
+    if bbox is not None:
+        seg_full = np.zeros(properties['original_size_of_raw_data'], dtype=np.uint8)
+        seg_full[tuple(slice(start, start + size) for (start, _), size in zip(bbox, seg.shape))] = seg
+        seg = seg_full
+    img = sitk.GetImageFromArray(seg)
+    img.SetSpacing(properties['itk_spacing'])
+    img.SetOrigin(properties['itk_origin'])
+    img.SetDirection(properties['itk_direction'])
+    # written under a temporary name, so an existing output is a complete one
+    path_tmp = os.path.join(os.path.dirname(path_out), '.tmp_' + os.path.basename(path_out))
+    try:
+        sitk.WriteImage(img, path_tmp)
+        os.replace(path_tmp, path_out)
+    finally:
+        if os.path.exists(path_tmp):
+            os.remove(path_tmp)
+
+
+def _ensemble_case(task):
+    case, paths_softmax, path_pkl, path_out, weights, slab_size = task
+    time_start = time.time()
+    with open(path_pkl, 'rb') as f:
+        properties = pickle.load(f)
+    if properties.get('regions_class_order') is not None:
+        raise ValueError(f"'{case}' was predicted with regions (sigmoid outputs), which are not supported")
+    seg = ensemble_case(paths_softmax, weights, slab_size)
+    save_segmentation(seg, properties, path_out)
+    return case, time.time() - time_start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Weighted model ensemble from the nnUNet softmax exports, slab by slab')
+    parser.add_argument('-f', '--folders', type=str, nargs='+', required=True, help='prediction folders with the softmax exports (<case>.npz and <case>.pkl)')
+    parser.add_argument('-o', '--output_folder', type=str, required=True, help='folder of the ensembled segmentation masks')
+    parser.add_argument('-pp', '--postprocessing_file', type=str, help='(optional) postprocessing.json of the ensemble')
+    parser.add_argument('--weights', type=float, nargs='+', help='weights of the folders (default: equal weights)')
+    parser.add_argument('--slab_size', type=int, default=16, help='number of z slices read at a time (default: 16)')
+    parser.add_argument('--num_workers', type=int, default=4, help='number of cases processed in parallel (default: 4)')
+    parser.add_argument('--overwrite', action='store_true', help='overwrite existing segmentation masks (default: skip them)')
+    args = parser.parse_args()
+
+    if len(args.folders) < 2:
+        raise ValueError('At least two prediction folders are needed for an ensemble')
+    weights = args.weights if args.weights is not None else [1.0] * len(args.folders)
+    if len(weights) != len(args.folders) or min(weights) < 0 or sum(weights) <= 0:
+        raise ValueError(f'Expected {len(args.folders)} non-negative weights, but found {weights}')
+    weights = [weight / sum(weights) for weight in weights]
+
+    # as "CartiMorph_nnUNet_ensemble", the raw ensemble goes to a subfolder if it is postprocessed
+    dir_raw = args.output_folder
+    if args.postprocessing_file is not None:
+        dir_raw = os.path.join(args.output_folder, 'not_postprocessed')
+    os.makedirs(dir_raw, exist_ok=True)
+
+    cases = sorted({name[:-4] for folder in args.folders for name in os.listdir(folder) if name.endswith(('.npz', '.npy'))})
+    tasks, missing, nb_skipped = [], [], 0
+    for case in cases:
+        paths_softmax = [find_export(folder, case) for folder in args.folders]
+        path_pkl = os.path.join(args.folders[0], case + '.pkl')
+        if None in paths_softmax or not os.path.isfile(path_pkl):
+            missing.append(case)
+            continue
+        path_out = os.path.join(dir_raw, case + '.nii.gz')
+        if os.path.isfile(path_out) and not args.overwrite:
+            nb_skipped += 1
+            continue
+        tasks.append((case, paths_softmax, path_pkl, path_out, weights, max(1, args.slab_size)))
+    if missing:
+        raise ValueError(f'Softmax exports (.npz and .pkl) are not available in all folders for: {missing} '
+                         '(predict with "-z" to save them)')
+    print(f'{len(tasks)} cases to ensemble ({nb_skipped} skipped), weights: {[round(w, 4) for w in weights]}')
+
+    time_start = time.time()
+    with ProcessPoolExecutor(max_workers=max(1, args.num_workers)) as pool:
+        for case, elapsed in pool.map(_ensemble_case, tasks):
+            print(f'{case}: {elapsed:.1f} s')
+    print(f'Ensembled {len(tasks)} cases in {time.time() - time_start:.1f} s')
+
+    if args.postprocessing_file is not None:
+        from CartiMorph_nnUNet.postprocessing.connected_components import load_postprocessing, apply_postprocessing_to_folder
+        for_which_classes, min_valid_obj_size = load_postprocessing(args.postprocessing_file)
+        print('Postprocessing...')
+        apply_postprocessing_to_folder(dir_raw, args.output_folder, for_which_classes, min_valid_obj_size, max(1, args.num_workers))
+        shutil.copy(args.postprocessing_file, args.output_folder)
@@ -1,28 +1,39 @@
-from batchgenerators.utilities.file_and_folder_operations import * 
-from CartiMorph_nnUNet.dataset_conversion.utils import generate_dataset_json 
-from CartiMorph_nnUNet.paths import nnUNet_raw_data, preprocessing_output_dir 
+import argparse
+from batchgenerators.utilities.file_and_folder_operations import *
+from CartiMorph_nnUNet.dataset_conversion.utils import generate_dataset_json
+from CartiMorph_nnUNet.paths import nnUNet_raw_data, preprocessing_output_dir
 
-# ================================================================
-# "nnUNet_raw_data" is the folder of raw data you set with the command:
-#   export nnUNet_raw_data_base='path/to/raw/data/folder/nnUNet_raw_data_base' 
-# 
-# arrange our training data like this:
-# ├── [nnUNet_raw_data]
-#     ├── [task_name]
-#         ├── imagesTr
-#         ├── imagesTs
-#         ├── labelsTr
-#         ├── labelsTs
-# ----------------------------------------------------------------
-# task name should be in the form of Task[xxx]_[task-name]
-task_name='Task106_test6' 
-target_base = join(nnUNet_raw_data, task_name) 
-target_imagesTr = join(target_base, 'imagesTr') 
-target_imagesTs = join(target_base, 'imagesTs') 
-target_labelsTr = join(target_base, 'labelsTr') 
-target_labelsTs = join(target_base, 'labelsTs') 
-# ================================================================
- 
-generate_dataset_json(join(target_base, 'dataset.json'), target_imagesTr, target_imagesTs, ('D'), 
-    labels={0: 'background', 1: 'femur', 2: 'femoral cartilage', 3: 'tibia', 4: 'medial tibial cartilage', 5: 'lateral tibial cartilage'}, 
-    dataset_name=task_name) 
+# segmentation labels of the OAIZIB-CM dataset
+LABELS = {0: 'background', 1: 'femur', 2: 'femoral cartilage', 3: 'tibia', 4: 'medial tibial cartilage', 5: 'lateral tibial cartilage'}
+
+
+def write_dataset_json(task_name, raw_data=nnUNet_raw_data):
+    # ================================================================
+    # "nnUNet_raw_data" is the folder of raw data you set with the command:
+    #   export nnUNet_raw_data_base='path/to/raw/data/folder/nnUNet_raw_data_base'
+    #
+    # arrange our training data like this:
+    # ├── [nnUNet_raw_data]
+    #     ├── [task_name]
+    #         ├── imagesTr
+    #         ├── imagesTs
+    #         ├── labelsTr
+    #         ├── labelsTs
+    # ----------------------------------------------------------------
+    target_base = join(raw_data, task_name)
+    target_imagesTr = join(target_base, 'imagesTr')
+    target_imagesTs = join(target_base, 'imagesTs')
+    # ================================================================
+
+    generate_dataset_json(join(target_base, 'dataset.json'), target_imagesTr, target_imagesTs, ('D'),
+        labels=LABELS,
+        dataset_name=task_name)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate the dataset.json file of an nnUNet task')
+    # task name should be in the form of Task[xxx]_[task-name]
+    parser.add_argument('--task_name', type=str, default='Task106_test6', help='task name in the form of Task[xxx]_[task-name] (default: Task106_test6)')
+    args = parser.parse_args()
+
+    write_dataset_json(args.task_name)
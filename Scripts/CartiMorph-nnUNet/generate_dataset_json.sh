@@ -25,8 +25,11 @@ export RESULTS_FOLDER='path/to/result/folder/nnUNet_trained_models'
 # e.g. dir_scripts='~/Documents/CartiMorph/Scripts/CartiMorph-nnUNet' 
 export dir_scripts='path/to/python/script/folder' 
 
+# task name in the form of Task[xxx]_[task-name]
+export task_name='Task106_test6'
+
 # [Logging] 
 export log_file='path/to/log/file/generate_dataset_json.log' 
 
 # generate dataset json file
-python $dir_scripts/generate_dataset_json.py 2>&1 > "$log_file"
\ No newline at end of file
+python $dir_scripts/generate_dataset_json.py --task_name "$task_name" 2>&1 > "$log_file"
\ No newline at end of file
@@ -53,6 +53,16 @@ export RESULTS_FOLDER='path/to/result/folder/nnUNet_trained_models'
 # ----------------------------------------------
 export nnUNet_model_ensemble="$RESULTS_FOLDER/nnUNet/ensembles"
 export nnUNet_pp_2d3dF="$nnUNet_model_ensemble/$nnUNet_taskName/ensemble_2d__nnUNetTrainerV2__nnUNetPlansv2.1--3d_fullres__nnUNetTrainerV2__nnUNetPlansv2.1/postprocessing.json"
+
+# weights of the 2d and 3d models in the ensemble
+export ensemble_weights='1 1' 
+
+# number of cases ensembled in parallel
+export num_workers='4' 
+
+# path to the folder containing the pyhton script "ensemble_softmax.py"
+# e.g. dir_scripts='~/Documents/CartiMorph/Scripts/CartiMorph-nnUNet' 
+export dir_scripts='path/to/python/script/folder'
 # ----------------------------------------------
 
 export nnUNet_plans_identifier='nnUNetPlansv2.1' 
@@ -91,11 +101,13 @@ fi
 # Model ensemble: 2d and 3dF
 # ----------------------------------------------
 # 2d model prediction
-CUDA_VISIBLE_DEVICES=$gpuIDs CartiMorph_nnUNet_predict -i "$nnUNet_prediction_in" -o "$nnUNet_prediction_out_2d" -tr nnUNetTrainerV2 -m 2d -p "$nnUNet_plans_identifier" -t "$nnUNet_taskName" 2>&1 > "$log_file_2d" 
+CUDA_VISIBLE_DEVICES=$gpuIDs CartiMorph_nnUNet_predict -i "$nnUNet_prediction_in" -o "$nnUNet_prediction_out_2d" -tr nnUNetTrainerV2 -m 2d -p "$nnUNet_plans_identifier" -t "$nnUNet_taskName" -z 2>&1 > "$log_file_2d" 
 
 # 3dF model prediction
-CUDA_VISIBLE_DEVICES=$gpuIDs CartiMorph_nnUNet_predict -i "$nnUNet_prediction_in" -o "$nnUNet_prediction_out_3dF" -tr nnUNetTrainerV2 -m 3d_cascade_fullres -p "$nnUNet_plans_identifier" -t "$nnUNet_taskName" 2>&1 > "$log_file_3dF" 
+CUDA_VISIBLE_DEVICES=$gpuIDs CartiMorph_nnUNet_predict -i "$nnUNet_prediction_in" -o "$nnUNet_prediction_out_3dF" -tr nnUNetTrainerV2 -m 3d_cascade_fullres -p "$nnUNet_plans_identifier" -t "$nnUNet_taskName" -z 2>&1 > "$log_file_3dF" 
 
-# model ensembel
-CUDA_VISIBLE_DEVICES=$gpuIDs CartiMorph_nnUNet_ensemble -f $nnUNet_prediction_out_2d $nnUNet_prediction_out_3dF -o $nnUNet_prediction_out_2d3dF -pp $nnUNet_pp_2d3dF 2>&1 > "$log_file_2d3dF" 
+# model ensemble (slab by slab, see ensemble_softmax.py)
+python $dir_scripts/ensemble_softmax.py -f $nnUNet_prediction_out_2d $nnUNet_prediction_out_3dF -o $nnUNet_prediction_out_2d3dF -pp $nnUNet_pp_2d3dF --weights $ensemble_weights --num_workers $num_workers 2>&1 > "$log_file_2d3dF" 
+# (alternative) model ensemble of nnUNet, with the full softmax volumes in memory
+# CUDA_VISIBLE_DEVICES=$gpuIDs CartiMorph_nnUNet_ensemble -f $nnUNet_prediction_out_2d $nnUNet_prediction_out_3dF -o $nnUNet_prediction_out_2d3dF -pp $nnUNet_pp_2d3dF 2>&1 > "$log_file_2d3dF" 
 # ----------------------------------------------
@@ -31,45 +31,139 @@ the License.
 """
 
 import os
+import glob
 import argparse
 import numpy as np
 import CartiMorph_vxm as vxm
 import tensorflow as tf
+from utils_modelCache import RegistrationModelCache, TransformCache
+from utils_modelExport import BACKENDS
+from utils_streamIO import VolumeReader, VolumeWriter
+from utils_labelFusion import LabelFusion
 
 # parse commandline args
 parser = argparse.ArgumentParser()
 parser.add_argument('--file_targetTemp', required=True, help='target template')
-parser.add_argument('--file_sourceImg', required=True, help='source image')
-parser.add_argument('--file_sourceLabel', required=True, help='the segmentation label of the source image')
-parser.add_argument('--file_warpedLabel', required=True, help='the warped segmentation label')
-parser.add_argument('--file_model', required=True, help='the template learning model')
+# a single subject
+parser.add_argument('--file_sourceImg', help='source image')
+parser.add_argument('--file_sourceLabel', help='the segmentation label of the source image')
+parser.add_argument('--file_warpedLabel', help='the warped segmentation label')
+# multiple subjects (the model is loaded once)
+parser.add_argument('--dir_sourceImg', help='folder of the source images')
+parser.add_argument('--dir_sourceLabel', help='folder of the segmentation labels (same file names as the source images)')
+parser.add_argument('--list_source', help='text file with one "source_image source_label" pair per line (instead of --dir_sourceImg/--dir_sourceLabel)')
+parser.add_argument('--dir_warpedLabel', help='folder of the warped segmentation labels')
+parser.add_argument('--file_TempSeg', help='(optional) template segmentation built by majority voting of the warped labels')
+parser.add_argument('--file_freqMap', help='(optional) per-class frequency maps of the warped labels (requires --file_TempSeg)')
+parser.add_argument('--nb_labels', type=int, default=6, help='number of labels including background for --file_TempSeg (default: 6)')
+parser.add_argument('--file_model', required=True,
+                    help='the template learning model (.h5), or the export folder of "utils_modelExport.py" with --backend')
+parser.add_argument('--backend', default='keras', choices=('keras',) + tuple(BACKENDS),
+                    help='keras (.h5 model), or an exported artifact, e.g. savedmodel or tflite_float16 (default: keras)')
+parser.add_argument('--threads', type=int, help='number of CPU threads of an exported artifact (default: all cores)')
+parser.add_argument('--batch_size', type=int, default=1,
+                    help='number of source images registered in one prediction (default: 1)')
+parser.add_argument('--io_threads', type=int, default=2,
+                    help='number of threads for reading and for writing .nii.gz files (default: 2)')
+parser.add_argument('--prefetch', type=int, default=4,
+                    help='number of subjects loaded ahead of the prediction (default: 4)')
 parser.add_argument('-g', '--gpuIDs', help='GPU ID(s) - if not supplied, CPU is used')
 parser.add_argument('--multichannel', action='store_true',
                     help='specify that data has multiple channels')
 args = parser.parse_args()
 
+if args.batch_size < 1:
+    raise ValueError('Batch size should be a positive integer, but found %d' % args.batch_size)
+
+# list the subjects as (source image, source label, warped label)
+if args.file_sourceImg:
+    if not (args.file_sourceLabel and args.file_warpedLabel):
+        raise ValueError('"--file_sourceImg" requires "--file_sourceLabel" and "--file_warpedLabel".')
+    list_subjects = [(args.file_sourceImg, args.file_sourceLabel, args.file_warpedLabel)]
+else:
+    if not (args.dir_warpedLabel or args.file_TempSeg):
+        raise ValueError('Add "--file_sourceImg/--file_sourceLabel/--file_warpedLabel" for one subject, or "--dir_warpedLabel" (and/or "--file_TempSeg") for multiple subjects.')
+    if args.list_source:
+        with open(args.list_source, 'r') as f:
+            pairs = [line.split() for line in f if line.strip()]
+    elif args.dir_sourceImg and args.dir_sourceLabel:
+        list_sourceImg = sorted(glob.glob(os.path.join(args.dir_sourceImg, "*.nii.gz")) + glob.glob(os.path.join(args.dir_sourceImg, "*.nii")))
+        pairs = [(file_img, os.path.join(args.dir_sourceLabel, os.path.basename(file_img))) for file_img in list_sourceImg]
+    else:
+        raise ValueError('Multiple subjects require "--list_source" or "--dir_sourceImg" and "--dir_sourceLabel".')
+    # without --dir_warpedLabel, the warped labels are only fused into the template segmentation
+    if args.dir_warpedLabel:
+        os.makedirs(args.dir_warpedLabel, exist_ok=True)
+    list_subjects = [(file_img, file_label, os.path.join(args.dir_warpedLabel, os.path.basename(file_img)) if args.dir_warpedLabel else None)
+                     for file_img, file_label in pairs]
+if args.file_freqMap and not args.file_TempSeg:
+    raise ValueError('"--file_freqMap" requires "--file_TempSeg".')
+
 # tensorflow device handling
 device, nb_devices = vxm.tf.utils.setup_device(args.gpuIDs)
 
-# load the target template, source image, and source segmentation
+# load the target template (for the affine matrix of the outputs)
 add_feat_axis = not args.multichannel
-targetTemp, targetAffine = vxm.py.utils.load_volfile(
+_, targetAffine = vxm.py.utils.load_volfile(
     args.file_targetTemp, add_batch_axis=True, add_feat_axis=add_feat_axis, ret_affine=True)
-sourceImg = vxm.py.utils.load_volfile(
-    args.file_sourceImg, add_batch_axis=True, add_feat_axis=add_feat_axis, ret_affine=False)
-sourceLabel = vxm.py.utils.load_volfile(
-    args.file_sourceLabel, add_batch_axis=True, add_feat_axis=add_feat_axis, ret_affine=False)
-
-inshape = sourceImg.shape[1:-1]
-nb_feats = sourceImg.shape[-1]
-
-with tf.device(device):
-    # load model and predict
-    config = dict(inshape=inshape)
-    warpingField = vxm.networks.TemplateCreation.load(args.file_model, **config).register_img2tmp(sourceImg)
-    warpedLabel = vxm.networks.Transform(sourceLabel.shape[1:-1],
-                                   interp_method="nearest",
-                                   nb_feats=sourceLabel.shape[-1]).predict([sourceLabel, warpingField])
-
-# save the wrapped segmentation
-vxm.py.utils.save_volfile(warpedLabel.squeeze(), args.file_warpedLabel, targetAffine)
\ No newline at end of file
+
+# the registration model and the transform model are built once per input shape
+regModels = RegistrationModelCache(args.file_model, direction='img2tmp', backend=args.backend, nb_threads=args.threads)
+transformModels = TransformCache(interp_method='nearest')
+
+# vote counts of the warped labels
+fusion = LabelFusion(nb_labels=args.nb_labels) if args.file_TempSeg else None
+
+
+def load_subject(subject):
+    file_sourceImg, file_sourceLabel, _ = subject
+    sourceImg = vxm.py.utils.load_volfile(file_sourceImg, add_batch_axis=True, add_feat_axis=add_feat_axis)
+    sourceLabel = vxm.py.utils.load_volfile(file_sourceLabel, add_batch_axis=True, add_feat_axis=add_feat_axis)
+    return sourceImg, sourceLabel
+
+
+# source images and labels are decoded and outputs are compressed in background threads
+reader = VolumeReader(load_subject, nb_threads=args.io_threads, prefetch=args.prefetch)
+writer = VolumeWriter(vxm.py.utils.save_volfile, nb_threads=args.io_threads, queue_size=2 * args.batch_size)
+
+
+def register_batch(batch):
+    """
+    Registers a batch of same-shape source images to the template and warps their labels.
+    """
+    sourceImgs = np.concatenate([sourceImg for _, sourceImg, _ in batch], axis=0)
+    sourceLabels = np.concatenate([sourceLabel for _, _, sourceLabel in batch], axis=0)
+
+    with tf.device(device):
+        # predict
+        warpingFields = regModels.predict(sourceImgs)
+        warpedLabels = transformModels.predict(sourceLabels, warpingFields)
+
+    for i, (subject, _, _) in enumerate(batch):
+        if fusion is not None:
+            fusion.add(warpedLabels[i])
+        # save the wrapped segmentation
+        if subject[2] is not None:
+            writer.put(warpedLabels[i].squeeze(), subject[2], targetAffine)
+
+
+# subjects waiting for a full batch, grouped by input shape
+pending = {}
+for subject, (sourceImg, sourceLabel) in reader.iterate(list_subjects):
+    inshape = (sourceImg.shape[1:], sourceLabel.shape[1:])
+    pending.setdefault(inshape, []).append((subject, sourceImg, sourceLabel))
+    if len(pending[inshape]) == args.batch_size:
+        register_batch(pending.pop(inshape))
+
+# register the remaining (incomplete) batches
+for batch in pending.values():
+    register_batch(batch)
+
+# save the template segmentation (and the frequency maps)
+if fusion is not None:
+    writer.put(fusion.segmentation(), args.file_TempSeg, targetAffine)
+    if args.file_freqMap:
+        writer.put(fusion.frequency(), args.file_freqMap, targetAffine)
+
+# wait for the pending writes
+writer.close()
@@ -0,0 +1,520 @@
+#!/usr/bin/env python
+
+"""
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+A local registration service keeping the models in memory.
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+The one-shot inference scripts pay for the Python startup, the TensorFlow import and
+the model loading on every call. This service loads the template learning model (and
+optionally a VxmDense image-to-image model) once, listens on localhost (TCP) or on a
+UNIX socket, and serves:
+    POST /tmp2img   {"image", "field", "warped_seg"}: template-to-image registration,
+                    the template segmentation is warped to the image
+    POST /img2tmp   {"image", "label", "field", "warped_label"}: image-to-template
+                    registration, the label of the image is warped to the template
+    POST /img2img   {"moving", "fixed", "field", "moved"}: VxmDense registration
+    GET  /stats     queue depth, batch sizes and latency percentiles (ms)
+    GET  /health
+The inputs of a JSON request are file paths and the outputs (at least one) are the
+paths to write, e.g. {"image": "knee.nii.gz", "warped_seg": "knee_seg.nii.gz"}.
+Alternatively, the body is an .npz file (Content-Type: application/octet-stream) with
+the input volumes (without batch axis) and the response is an .npz file with all the
+outputs. Concurrent requests of the same task and input shape are grouped into one
+prediction of up to --max_batch volumes, waiting at most --max_wait_ms for the batch
+to fill; files are read and written in the request threads.
+
+Usage:
+    python inference_server.py --file_model bestModel.h5 --file_TempSeg templateSeg.nii.gz \
+        --socket /tmp/cartimorph.sock
+    curl --unix-socket /tmp/cartimorph.sock http://localhost/tmp2img \
+        -d '{"image": "/data/knee.nii.gz", "warped_seg": "/out/knee.nii.gz", "field": "/out/knee_field.nii.gz"}'
+    curl --unix-socket /tmp/cartimorph.sock http://localhost/stats
+
+Model inference is implemented in
+CartiMorph-vxm (https://github.com/YongchengYAO/CartiMorph-vxm), a work based on
+VoxelMorph (https://github.com/voxelmorph/voxelmorph)
+
+If you use this code, please cite the following:
+
+    Yongcheng Yao, Junru Zhong, Liping Zhang, Sheheryar Khan, Weitian Chen.
+    "CartiMorph: a framework for automated knee articular cartilage morphometrics."
+    Medical Image Analysis
+
+Copyright 2023 Yongcheng Yao
+
+-----------------------------------------------------------------------------------
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+compliance with the License. You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is
+distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+implied. See the License for the specific language governing permissions and limitations under
+the License.
+-----------------------------------------------------------------------------------
+"""
+
+import os
+import io
+import json
+import time
+import argparse
+import threading
+import collections
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import CartiMorph_vxm as vxm
+import tensorflow as tf
+from utils_modelCache import RegistrationModelCache, TransformCache
+from utils_modelExport import BACKENDS, ExportedModel
+from utils_fieldIO import FIELD_DTYPES, field_filename, is_compact, save_field
+
+# inputs and outputs of each task
+TASKS = {
+    'tmp2img': (('image',), ('field', 'warped_seg')),
+    'img2tmp': (('image', 'label'), ('field', 'warped_label')),
+    'img2img': (('moving', 'fixed'), ('field', 'moved')),
+}
+
+# number of recent requests in the latency statistics
+STATS_WINDOW = 1000
+
+
+class RequestError(ValueError):
+    """
+    An invalid request (answered with status 400).
+    """
+
+
+class PairModelCache:
+    """
+    VxmDense registration models (one per input shape) predicting the warp of a moving and a fixed image.
+    """
+
+    def __init__(self, file_model, backend='keras', nb_threads=None):
+        self.file_model = file_model
+        self.backend = backend
+        self.nb_threads = nb_threads
+        self.models = {}
+
+    def get(self, inshape):
+        inshape = tuple(inshape)
+        if inshape not in self.models:
+            if self.backend != 'keras':
+                model = ExportedModel(self.file_model, backend=self.backend, nb_threads=self.nb_threads)
+                if model.inshape != inshape:
+                    raise ValueError(f"The model in '{self.file_model}' was exported for inputs of shape "
+                                     f"{model.inshape}, but found {inshape}")
+                self.models[inshape] = model
+            else:
+                import voxelmorph
+                self.models[inshape] = voxelmorph.networks.VxmDense.load(
+                    self.file_model, inshape=inshape, input_model=None).get_registration_model()
+        return self.models[inshape]
+
+    def predict(self, moving, fixed):
+        return self.get(moving.shape[1:-1]).predict([moving, fixed], batch_size=moving.shape[0])
+
+
+class _Job:
+    def __init__(self, item):
+        self.item = item
+        self.time_submit = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.wait_time = None
+        self.predict_time = None
+        self.batch_size = None
+
+
+class MicroBatcher:
+    """
+    Groups concurrent requests with the same key (task and input shapes) into batches predicted in one thread.
+    """
+
+    def __init__(self, predict_fn, max_batch=4, max_wait=0.01):
+        """
+        Parameters:
+            predict_fn: Function called with (key, items) that returns one result per item.
+            max_batch: Maximum number of items per batch. Default is 4.
+            max_wait: Maximum time (s) the oldest item waits for the batch to fill. Default is 0.01.
+        """
+        self.predict_fn = predict_fn
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._work, daemon=True)
+        self.thread.start()
+
+    def submit(self, key, item):
+        """
+        Queues one item and waits for its batch. Returns the job with the result and the timings.
+        """
+        job = _Job(item)
+        with self.condition:
+            self.pending.setdefault(key, []).append(job)
+            self.condition.notify_all()
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job
+
+    def depth(self):
+        """
+        Number of queued items per key.
+        """
+        with self.condition:
+            return {key: len(jobs) for key, jobs in self.pending.items()}
+
+    def _next_batch(self):
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+            # the key of the oldest item goes first
+            key = min(self.pending, key=lambda k: self.pending[k][0].time_submit)
+            deadline = self.pending[key][0].time_submit + self.max_wait
+            while len(self.pending[key]) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            jobs, rest = self.pending[key][:self.max_batch], self.pending[key][self.max_batch:]
+            if rest:
+                self.pending[key] = rest
+            else:
+                del self.pending[key]
+        return key, jobs
+
+    def _work(self):
+        while True:
+            key, jobs = self._next_batch()
+            start = time.perf_counter()
+            error = None
+            try:
+                results = self.predict_fn(key, [job.item for job in jobs])
+            except Exception as e:
+                results, error = [None] * len(jobs), e
+            predict_time = time.perf_counter() - start
+            for job, result in zip(jobs, results):
+                job.result, job.error = result, error
+                job.wait_time = start - job.time_submit
+                job.predict_time = predict_time
+                job.batch_size = len(jobs)
+                job.done.set()
+
+
+class ServiceStats:
+    """
+    Request counts and latencies (of the last STATS_WINDOW requests) per task.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.time_start = time.time()
+        self.counts = collections.defaultdict(lambda: {'requests': 0, 'errors': 0})
+        self.timings = collections.defaultdict(lambda: collections.deque(maxlen=STATS_WINDOW))
+        self.batch_sizes = collections.defaultdict(lambda: collections.deque(maxlen=STATS_WINDOW))
+
+    def add(self, task, timing=None, batch_size=None):
+        with self.lock:
+            self.counts[task]['requests'] += 1
+            if timing is None:
+                self.counts[task]['errors'] += 1
+                return
+            self.timings[task].append(timing)
+            self.batch_sizes[task].append(batch_size)
+
+    def summary(self, depth):
+        with self.lock:
+            tasks = {}
+            for task, counts in self.counts.items():
+                tasks[task] = dict(counts)
+                timings = self.timings[task]
+                if timings:
+                    tasks[task]['mean_batch_size'] = float(np.mean(self.batch_sizes[task]))
+                    tasks[task]['latency_ms'] = {
+                        name: {'p50': float(np.percentile(values, 50)), 'p90': float(np.percentile(values, 90)),
+                               'p99': float(np.percentile(values, 99)), 'max': float(np.max(values))}
+                        for name, values in ((name, [t[name] for t in timings]) for name in timings[0])}
+        queue = {}
+        for key, nb_jobs in depth.items():
+            name = '%s %s' % (key[0], 'x'.join(map(str, key[1])))
+            queue[name] = queue.get(name, 0) + nb_jobs
+        return {'uptime_s': time.time() - self.time_start, 'queue_depth': sum(depth.values()),
+                'queue': queue, 'tasks': tasks}
+
+
+class RegistrationService:
+    """
+    The models, the micro-batcher and the statistics of the service.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.add_feat_axis = not args.multichannel
+        self.device, _ = vxm.tf.utils.setup_device(args.gpuIDs)
+
+        # the template segmentation (tmp2img) and the affine matrix of the template space (img2tmp)
+        self.TempSeg, self.templateAffine = None, None
+        if args.file_TempSeg:
+            self.TempSeg, self.templateAffine = self.load(args.file_TempSeg)
+        if args.file_targetTemp:
+            _, self.templateAffine = self.load(args.file_targetTemp)
+
+        self.regModels = {direction: RegistrationModelCache(args.file_model, direction=direction,
+                                                            backend=args.backend, nb_threads=args.threads)
+                          for direction in ('tmp2img', 'img2tmp')}
+        self.pairModels = PairModelCache(args.file_regModel, backend=args.regModel_backend,
+                                         nb_threads=args.threads) if args.file_regModel else None
+        self.labelTransforms = TransformCache(interp_method='nearest')
+        self.imageTransforms = TransformCache(interp_method='linear')
+        self.batcher = MicroBatcher(self.predict_batch, max_batch=args.max_batch, max_wait=args.max_wait_ms / 1000)
+        self.stats = ServiceStats()
+
+    def load(self, file):
+        return vxm.py.utils.load_volfile(file, add_batch_axis=True, add_feat_axis=self.add_feat_axis, ret_affine=True)
+
+    def warmup(self):
+        """
+        Builds the models of the template shape (and traces their predictions) before the first request.
+        """
+        if self.TempSeg is None:
+            return
+        img = np.zeros(self.TempSeg.shape, dtype=np.float32)
+        key = ('tmp2img', self.TempSeg.shape[1:])
+        self.predict_batch(key, [{'image': img}])
+        self.predict_batch(('img2tmp', key[1]), [{'image': img, 'label': self.TempSeg}])
+
+    def predict_batch(self, key, items):
+        """
+        Predicts the outputs of a batch of requests of the same task and input shapes.
+        """
+        task = key[0]
+        with tf.device(self.device):
+            if task == 'tmp2img':
+                fields = self.regModels[task].predict(np.concatenate([item['image'] for item in items]))
+                # without a template segmentation, only the warping fields are predicted
+                warped = self.labelTransforms.predict(self.TempSeg, fields) if self.TempSeg is not None else None
+                return [{'field': fields[i:i + 1], 'warped_seg': warped[i:i + 1] if warped is not None else None}
+                        for i in range(len(items))]
+            if task == 'img2tmp':
+                fields = self.regModels[task].predict(np.concatenate([item['image'] for item in items]))
+                warped = self.labelTransforms.predict(np.concatenate([item['label'] for item in items]), fields)
+                return [{'field': fields[i:i + 1], 'warped_label': warped[i:i + 1]} for i in range(len(items))]
+            moving = np.concatenate([item['moving'] for item in items])
+            fields = self.pairModels.predict(moving, np.concatenate([item['fixed'] for item in items]))
+            moved = self.imageTransforms.predict(moving, fields)
+            return [{'field': fields[i:i + 1], 'moved': moved[i:i + 1]} for i in range(len(items))]
+
+    def as_batch(self, vol):
+        vol = np.asarray(vol, dtype=np.float32)
+        return vol[np.newaxis, ..., np.newaxis] if self.add_feat_axis else vol[np.newaxis]
+
+    def save_output(self, array, filename, affine):
+        """
+        Saves a .nii.gz file, or a warping field in the compact format (.npz).
+        """
+        if is_compact(filename):
+            dtype = self.args.field_format if self.args.field_format != 'nii' else 'float16'
+            save_field(array, filename, affine, dtype=dtype, step=self.args.field_step)
+        else:
+            vxm.py.utils.save_volfile(array, filename, affine)
+
+    def run(self, task, request, arrays=None):
+        """
+        Serves one request: the inputs are the file paths in `request`, or the volumes in `arrays`.
+        Returns the written output files, or the output volumes (with `arrays`), and the timings (ms).
+        """
+        if task == 'img2img' and self.pairModels is None:
+            raise RequestError('The service was started without "--file_regModel".')
+        if task == 'tmp2img' and self.TempSeg is None and request.get('warped_seg'):
+            raise RequestError('The service was started without "--file_TempSeg".')
+        if task == 'img2tmp' and self.templateAffine is None and arrays is None:
+            raise RequestError('The service was started without "--file_targetTemp" or "--file_TempSeg".')
+        names_in, names_out = TASKS[task]
+        outputs = {name: request[name] for name in names_out if request.get(name)}
+        if arrays is None and not outputs:
+            raise RequestError('No output requested; add one or more of: %s' % ', '.join(names_out))
+
+        time_start = time.perf_counter()
+        item, affine = {}, None
+        for name in names_in:
+            if arrays is not None:
+                if name not in arrays:
+                    raise RequestError('Missing input array "%s"' % name)
+                item[name] = self.as_batch(arrays[name])
+            else:
+                if not isinstance(request.get(name), str) or not os.path.isfile(request[name]):
+                    raise RequestError('Input "%s" is not an existing file: %s' % (name, request.get(name)))
+                item[name], vol_affine = self.load(request[name])
+                if name in ('image', 'fixed'):
+                    affine = vol_affine
+        if task == 'img2tmp':
+            affine = self.templateAffine
+        shapes = [vol.shape[1:-1] for vol in item.values()]
+        if len(set(shapes)) > 1:
+            raise RequestError('Inputs of different shapes: %s' % shapes)
+        if task == 'tmp2img' and self.TempSeg is not None and shapes[0] != self.TempSeg.shape[1:-1]:
+            raise RequestError('Image of shape %s does not match the template shape %s'
+                               % (shapes[0], self.TempSeg.shape[1:-1]))
+        time_loaded = time.perf_counter()
+
+        job = self.batcher.submit((task, shapes[0]), item)
+        time_predicted = time.perf_counter()
+
+        if arrays is None:
+            for name, filename in outputs.items():
+                if name == 'field' and self.args.field_format != 'nii':
+                    filename = outputs[name] = field_filename(filename)
+                self.save_output(job.result[name].squeeze(), filename, affine)
+        time_end = time.perf_counter()
+
+        timing = {'load': time_loaded - time_start, 'wait': job.wait_time, 'predict': job.predict_time,
+                  'save': time_end - time_predicted, 'total': time_end - time_start}
+        timing = {name: 1000 * seconds for name, seconds in timing.items()}
+        self.stats.add(task, timing, job.batch_size)
+        if arrays is not None:
+            outputs = {name: job.result[name].squeeze() for name in names_out if job.result[name] is not None}
+        return outputs, timing, job.batch_size
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP interface of the RegistrationService (self.server.service).
+    """
+
+    def send_json(self, status, content):
+        body = json.dumps(content).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        elif self.path == '/stats':
+            self.send_json(200, service.stats.summary(service.batcher.depth()))
+        else:
+            self.send_json(404, {'error': 'Unknown path %s' % self.path})
+
+    def do_POST(self):
+        service = self.server.service
+        task = self.path.strip('/')
+        if task not in TASKS:
+            self.send_json(404, {'error': 'Unknown task %s (expected one of: %s)' % (self.path, ', '.join(TASKS))})
+            return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        arrays = None
+        try:
+            if self.headers.get('Content-Type') == 'application/octet-stream':
+                with np.load(io.BytesIO(body), allow_pickle=False) as npz:
+                    arrays = {name: npz[name] for name in npz.files}
+                outputs, timing, batch_size = service.run(task, {}, arrays)
+            else:
+                request = json.loads(body or b'{}')
+                if not isinstance(request, dict):
+                    raise RequestError('The request should be a JSON object')
+                outputs, timing, batch_size = service.run(task, request)
+        except (RequestError, json.JSONDecodeError) as e:
+            service.stats.add(task)
+            self.send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            service.stats.add(task)
+            self.send_json(500, {'error': '%s: %s' % (type(e).__name__, e)})
+            return
+
+        if arrays is not None:
+            buffer = io.BytesIO()
+            np.savez(buffer, **outputs)
+            body = buffer.getvalue()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('X-Timing-ms', json.dumps(timing))
+            self.send_header('X-Batch-Size', str(batch_size))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_json(200, {'outputs': outputs, 'timing_ms': timing, 'batch_size': batch_size})
+
+    def address_string(self):
+        # UNIX socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    # parse commandline args
+    parser = argparse.ArgumentParser(description='Local registration service keeping the models in memory')
+    parser.add_argument('--file_model', required=True,
+                        help='the template learning model (.h5), or the export folder of "utils_modelExport.py" with --backend')
+    parser.add_argument('--backend', default='keras', choices=('keras',) + tuple(BACKENDS),
+                        help='keras (.h5 model), or an exported artifact, e.g. savedmodel or tflite_float16 (default: keras)')
+    parser.add_argument('--file_TempSeg', help='the template segmentation, warped by /tmp2img (also defines the template space)')
+    parser.add_argument('--file_targetTemp', help='(optional) the template image, for the affine matrix of the /img2tmp outputs')
+    parser.add_argument('--file_regModel', help='(optional) an image-to-image registration model (VxmDense) for /img2img')
+    parser.add_argument('--regModel_backend', default='keras', choices=('keras',) + tuple(BACKENDS),
+                        help='runtime of --file_regModel (default: keras)')
+    parser.add_argument('--threads', type=int, help='number of CPU threads of an exported artifact (default: all cores)')
+    parser.add_argument('--field_format', default='nii', choices=('nii',) + FIELD_DTYPES,
+                        help='format of the written warping fields: nii (.nii.gz), or float16/int16/float32 compact .npz files (default: nii)')
+    parser.add_argument('--field_step', type=float,
+                        help='quantization step (in voxels) of int16 warping fields (default: max|field|/32767)')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8765, help='TCP port (default: 8765)')
+    parser.add_argument('--socket', help='listen on this UNIX socket instead of TCP')
+    parser.add_argument('--max_batch', type=int, default=4,
+                        help='maximum number of same-shape requests predicted together (default: 4)')
+    parser.add_argument('--max_wait_ms', type=float, default=10,
+                        help='maximum time a request waits for its batch to fill (default: 10 ms)')
+    parser.add_argument('--no_warmup', action='store_true', help='do not build the models of the template shape at startup')
+    parser.add_argument('--quiet', action='store_true', help='do not log every request')
+    parser.add_argument('-g', '--gpuIDs', help='GPU ID(s) - if not supplied, CPU is used')
+    parser.add_argument('--multichannel', action='store_true',
+                        help='specify that data has multiple channels')
+    args = parser.parse_args()
+
+    if args.max_batch < 1:
+        raise ValueError('Batch size should be a positive integer, but found %d' % args.max_batch)
+
+    service = RegistrationService(args)
+    if not args.no_warmup:
+        time_start = time.perf_counter()
+        service.warmup()
+        print('Models built in %.1fs' % (time.perf_counter() - time_start), flush=True)
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, RequestHandler)
+        address = args.socket
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), RequestHandler)
+        address = 'http://%s:%d' % server.server_address[:2]
+    server.service = service
+    server.quiet = args.quiet
+    print('Serving on %s' % address, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
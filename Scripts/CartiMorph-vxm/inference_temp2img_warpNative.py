@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+
+"""
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+Warp the template segmentation mask to the target image space at the original
+(native) image resolution.
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+The warping fields saved by "inference_temp2img_warpTempSeg.py" live on the grid of the
+downsampled and cropped images of "M_down.m". Instead of warping the template at that
+grid and bringing the result back with "M_up.m" (zero-filling & resampling), this script
+maps every voxel of the original image grid to the low-resolution grid (as the
+resampling of "CM_imgPreprocess_resample.m" and the cropping range in imgPreInfo.mat),
+interpolates the warping field there, and samples the template segmentation (or the
+template image) directly. The native grid is processed in slabs along the last axis, so
+the full-resolution field is never held in memory; voxels outside the cropping box are
+set to 0, as in "M_up.m".
+
+With --field_interp nearest, the output is the same as warping at the low resolution
+followed by "M_up.m"; the default (linear) gives smoother boundaries at the native
+resolution.
+
+If you use this code, please cite the following:
+
+    Yongcheng Yao, Junru Zhong, Liping Zhang, Sheheryar Khan, Weitian Chen.
+    "CartiMorph: a framework for automated knee articular cartilage morphometrics."
+    Medical Image Analysis
+
+Copyright 2023 Yongcheng Yao
+
+-----------------------------------------------------------------------------------
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+compliance with the License. You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is
+distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+implied. See the License for the specific language governing permissions and limitations under
+the License.
+-----------------------------------------------------------------------------------
+"""
+
+import os
+import glob
+import argparse
+import numpy as np
+from utils_warping import WarpSampler
+
+
+def load_imgPreInfo(file_imgPreInfo):
+    """
+    Reads imgPreInfo.mat (saved by "M_down.m"). Returns {filename: (cropRange, imageSize_original, imageSize_downsampled)},
+    with 0-based, inclusive cropping ranges of shape (ndims, 2).
+    """
+    from scipy.io import loadmat
+    imgPreInfo = loadmat(file_imgPreInfo)
+    filenames = [str(np.squeeze(name)) for name in np.ravel(imgPreInfo['filename'])]
+    cropRange = np.atleast_2d(imgPreInfo['cropRange']).astype(np.int64) - 1
+    size_original = np.atleast_2d(imgPreInfo['imageSize_original']).astype(np.int64)
+    size_downsampled = np.atleast_2d(imgPreInfo['imageSize_downsampled']).astype(np.int64)
+    return {name: (cropRange[i].reshape(-1, 2), size_original[i], size_downsampled[i])
+            for i, name in enumerate(filenames)}
+
+
+def native_axis(n_original, n_downsampled, crop_start, crop_stop, field_interp):
+    """
+    Maps the voxels of one axis of the original grid to the cropped low-resolution grid.
+
+    The resampling of "CM_imgPreprocess_resample.m" puts voxel q of the original axis at
+    q * (n_downsampled - 1) / (n_original - 1) on the downsampled axis; "M_up.m" takes the
+    nearest downsampled voxel. Returns the range of original voxels inside the cropping box,
+    their (continuous, or nearest with field_interp='nearest') coordinates in the crop, and
+    the indices and weights of the linear interpolation of the field along the axis.
+    """
+    q = np.arange(n_original, dtype=np.float64)
+    p = q * (n_downsampled - 1) / max(n_original - 1, 1)
+    nearest = np.floor(p + 0.5)
+    inside = np.flatnonzero((nearest >= crop_start) & (nearest <= crop_stop))
+    if inside.size == 0:
+        return slice(0, 0), None, None, None, None
+    span = slice(inside[0], inside[-1] + 1)
+    n_crop = crop_stop - crop_start + 1
+    if field_interp == 'nearest':
+        coord = np.clip(nearest[span] - crop_start, 0, n_crop - 1)
+    else:
+        coord = np.clip(p[span] - crop_start, 0, n_crop - 1)
+    i0 = np.floor(coord).astype(np.int64)
+    i1 = np.minimum(i0 + 1, n_crop - 1)
+    w1 = (coord - i0).astype(np.float32)
+    return span, coord.astype(np.float32), i0, i1, w1
+
+
+def interp_axis(field, axis, i0, i1, w1):
+    """
+    Linear interpolation of a field along one axis at the given indices and weights.
+    """
+    shape = [-1 if i == axis else 1 for i in range(field.ndim)]
+    w1 = w1.reshape(shape)
+    return np.take(field, i0, axis=axis) * (1 - w1) + np.take(field, i1, axis=axis) * w1
+
+
+def warp_native(vol, field, cropRange, size_original, size_downsampled, interp_method='nearest',
+                field_interp='linear', slab_size=16):
+    """
+    Warps a template volume (on the cropped low-resolution grid) with a low-resolution
+    warping field and returns the result on the original image grid.
+
+    Parameters:
+        vol: Template volume of shape vol_shape (the shape of the cropped low-resolution images).
+        field: Warping field of shape (*vol_shape, ndims) in low-resolution voxel units.
+        cropRange: 0-based, inclusive cropping range of shape (ndims, 2).
+        size_original: Shape of the original image.
+        size_downsampled: Shape of the downsampled image before cropping.
+        interp_method: Interpolation of the template, 'nearest' or 'linear'. Default is 'nearest'.
+        field_interp: Interpolation of the field, 'linear' or 'nearest'. Default is 'linear'.
+        slab_size: Number of slices (along the last axis) of the original grid warped at once. Default is 16.
+    """
+    field = np.asarray(field, dtype=np.float32).squeeze()
+    vol = np.asarray(vol).squeeze()
+    ndims = field.shape[-1]
+    if field.shape[:-1] != vol.shape:
+        raise ValueError(f'Field of shape {field.shape} does not match the template of shape {vol.shape}')
+    if tuple(cropRange[:, 1] - cropRange[:, 0] + 1) != vol.shape:
+        raise ValueError(f'Cropping range {cropRange.tolist()} does not match the template of shape {vol.shape}')
+
+    axes = [native_axis(size_original[d], size_downsampled[d], cropRange[d, 0], cropRange[d, 1], field_interp)
+            for d in range(ndims)]
+    out_dtype = vol.dtype if interp_method == 'nearest' else np.float32
+    out = np.zeros(tuple(size_original), dtype=out_dtype)
+    if any(span.stop == span.start for span, *_ in axes):
+        return out
+
+    last = ndims - 1
+    span_last, coord_last, i0_last, i1_last, w1_last = axes[last]
+    for start in range(span_last.start, span_last.stop, slab_size):
+        stop = min(start + slab_size, span_last.stop)
+        part = slice(start - span_last.start, stop - span_last.start)
+
+        # interpolate the field along the slab axis first, then along the other axes
+        lo, hi = i0_last[part].min(), i1_last[part].max() + 1
+        slab = interp_axis(field[..., lo:hi, :], last, i0_last[part] - lo, i1_last[part] - lo, w1_last[part])
+        for d in reversed(range(last)):
+            _, _, i0, i1, w1 = axes[d]
+            slab = interp_axis(slab, d, i0, i1, w1)
+
+        # sampling locations (coordinate in the crop + displacement), given to the sampler as a shift of the slab grid
+        for d in range(ndims):
+            coord = coord_last[part] if d == last else axes[d][1]
+            shape = [-1 if i == d else 1 for i in range(ndims)]
+            slab[..., d] += coord.reshape(shape) - np.arange(coord.size, dtype=np.float32).reshape(shape)
+        warped = WarpSampler(slab, interp_method=interp_method, vol_shape=vol.shape).warp(vol)
+
+        index = tuple(axes[d][0] for d in range(last)) + (slice(start, stop),)
+        out[index] = warped.astype(out_dtype, copy=False)
+    return out
+
+
+def find_nativeImg(dir_nativeImg, filename):
+    """
+    The original image of a case: <name>_0000.nii.gz (as read by "M_down.m") or <name>.nii.gz.
+    """
+    for ext in ('.nii.gz', '.nii'):
+        if filename.endswith(ext):
+            name = filename[:-len(ext)]
+            break
+    else:
+        name = os.path.splitext(filename)[0]
+    for candidate in (name + '_0000.nii.gz', name + '_0000.nii', name + '.nii.gz', name + '.nii'):
+        path = os.path.join(dir_nativeImg, candidate)
+        if os.path.isfile(path):
+            return path
+    raise FileNotFoundError(f"Could not find the original image of '{filename}' in '{dir_nativeImg}'")
+
+
+if __name__ == '__main__':
+    import nibabel as nib
+    from utils_streamIO import VolumeReader, VolumeWriter
+    from utils_fieldIO import FIELD_EXT, load_warp
+
+    # parse commandline args
+    parser = argparse.ArgumentParser(description='Warp the template segmentation to the target images at the original resolution')
+    parser.add_argument('--dir_warpingField', required=True,
+                        help='folder of the warping fields (.nii.gz or compact .npz) saved by "inference_temp2img_warpTempSeg.py"')
+    parser.add_argument('--file_TempSeg', required=True, help='the template segmentation (or the template image with --interp_method linear)')
+    parser.add_argument('--file_imgPreInfo', required=True, help='imgPreInfo.mat saved by "M_down.m"')
+    parser.add_argument('--dir_nativeImg', required=True,
+                        help='folder of the original images (<name>_0000.nii.gz or <name>.nii.gz), whose headers are copied')
+    parser.add_argument('--dir_warpedTempSeg', required=True, help='output folder of the warped template segmentation masks')
+    parser.add_argument('--interp_method', default='nearest', choices=('nearest', 'linear'),
+                        help='interpolation of the template: nearest (segmentation) or linear (image) (default: nearest)')
+    parser.add_argument('--field_interp', default='linear', choices=('linear', 'nearest'),
+                        help='interpolation of the warping field; nearest gives the same result as "M_up.m" (default: linear)')
+    parser.add_argument('--slab_size', type=int, default=16,
+                        help='number of slices (along the last axis) of the original grid warped at once (default: 16)')
+    parser.add_argument('--io_threads', type=int, default=2,
+                        help='number of threads for reading and for writing files (default: 2)')
+    args = parser.parse_args()
+
+    if args.slab_size < 1:
+        raise ValueError('Slab size should be a positive integer, but found %d' % args.slab_size)
+    os.makedirs(args.dir_warpedTempSeg, exist_ok=True)
+
+    # the template and the image preprocessing parameters
+    TempSeg = np.asanyarray(nib.load(args.file_TempSeg).dataobj).squeeze()
+    imgPreInfo = load_imgPreInfo(args.file_imgPreInfo)
+
+    list_warpingField = sorted(glob.glob(os.path.join(args.dir_warpingField, "*.nii.gz")) +
+                               glob.glob(os.path.join(args.dir_warpingField, "*.nii")) +
+                               glob.glob(os.path.join(args.dir_warpingField, "*" + FIELD_EXT)))
+    if not list_warpingField:
+        raise ValueError(f"Could not find any warping field in '{args.dir_warpingField}'")
+
+    def case_name(file_warpingField):
+        # imgPreInfo.mat records the case names with the NIfTI extension
+        name = os.path.basename(file_warpingField)
+        if name.endswith(FIELD_EXT):
+            name = name[:-len(FIELD_EXT)]
+            return name + '.nii.gz' if name + '.nii.gz' in imgPreInfo else name + '.nii'
+        return name
+
+    def load_case(file_warpingField):
+        name = case_name(file_warpingField)
+        if name not in imgPreInfo:
+            raise ValueError(f"Could not find '{name}' in '{args.file_imgPreInfo}'")
+        field, _ = load_warp(file_warpingField)
+        # only the header of the original image is read
+        nativeImg = nib.load(find_nativeImg(args.dir_nativeImg, name))
+        return name, field, nativeImg
+
+    def save_output(array, filename, nativeImg):
+        header = nativeImg.header.copy()
+        header.set_data_dtype(array.dtype)
+        nib.save(nib.Nifti1Image(array, nativeImg.affine, header), filename)
+
+    reader = VolumeReader(load_case, nb_threads=args.io_threads, prefetch=2 * args.io_threads)
+    with VolumeWriter(save_output, nb_threads=args.io_threads, queue_size=2 * args.io_threads) as writer:
+        for _, (name, field, nativeImg) in reader.iterate(list_warpingField):
+            cropRange, size_original, size_downsampled = imgPreInfo[name]
+            if tuple(nativeImg.shape[:len(size_original)]) != tuple(size_original):
+                raise ValueError(f"Shape mismatch: the original image of '{name}' has shape {nativeImg.shape}, "
+                                 f"expected {tuple(size_original)}")
+            warpedTempSeg = warp_native(TempSeg, field, cropRange, size_original, size_downsampled,
+                                        interp_method=args.interp_method, field_interp=args.field_interp,
+                                        slab_size=args.slab_size)
+            writer.put(warpedTempSeg, os.path.join(args.dir_warpedTempSeg, name), nativeImg)
@@ -32,23 +32,59 @@ the License.
 
 import os
 import glob
+import time
 import argparse
+import threading
 import numpy as np
 import CartiMorph_vxm as vxm
 import tensorflow as tf
+from utils_modelCache import RegistrationModelCache, TransformCache
+from utils_modelExport import BACKENDS
+from utils_streamIO import VolumeReader, VolumeWriter
+from utils_fieldIO import FIELD_DTYPES, field_filename, is_compact, save_field
+from utils_cohort import parse_shard, shard_items, save_atomic, is_complete, RunManifest
 
 # parse commandline args
 parser = argparse.ArgumentParser()
-parser.add_argument('--dir_targetImg', required=True, help='folder of the target images')
+parser.add_argument('--dir_targetImg', help='folder of the target images')
+parser.add_argument('--list_targetImg',
+                    help='text file with one target image per line, instead of --dir_targetImg (e.g. a shape list of "niiCatalog.py")')
 parser.add_argument('--file_TempSeg', required=True, help='the template segmentation')
 parser.add_argument('--dir_warpedTempSeg', required=True, help='folder of the warped template segmentation masks')
 parser.add_argument('--dir_warpingField', required=True, help='folder of the warping field')
-parser.add_argument('--file_model', required=True, help='the template learning model')
+parser.add_argument('--field_format', default='nii', choices=('nii',) + FIELD_DTYPES,
+                    help='format of the warping fields: nii (.nii.gz), or float16/int16/float32 compact .npz files (default: nii)')
+parser.add_argument('--field_step', type=float,
+                    help='quantization step (in voxels) of int16 warping fields; the error is at most half of it (default: max|field|/32767)')
+parser.add_argument('--file_model', required=True,
+                    help='the template learning model (.h5), or the export folder of "utils_modelExport.py" with --backend')
+parser.add_argument('--backend', default='keras', choices=('keras',) + tuple(BACKENDS),
+                    help='keras (.h5 model), or an exported artifact, e.g. savedmodel or tflite_float16 (default: keras)')
+parser.add_argument('--threads', type=int, help='number of CPU threads of an exported artifact (default: all cores)')
+parser.add_argument('--batch_size', type=int, default=1,
+                    help='number of same-shape target images registered in one prediction (default: 1)')
+parser.add_argument('--io_threads', type=int, default=2,
+                    help='number of threads for reading and for writing .nii.gz files (default: 2)')
+parser.add_argument('--prefetch', type=int, default=4,
+                    help='number of target images loaded ahead of the prediction (default: 4)')
+parser.add_argument('--shard', default='0/1',
+                    help='process shard i of N (0 <= i < N) of the sorted target images, e.g. $SLURM_ARRAY_TASK_ID/$SLURM_ARRAY_TASK_COUNT (default: 0/1)')
+parser.add_argument('--overwrite', action='store_true',
+                    help='register all target images (by default, images whose outputs already exist are skipped)')
+parser.add_argument('--file_manifest',
+                    help='manifest of the run (JSON lines) with the status and timings of every subject '
+                         '(default: manifest_shard<i>of<N>_<time>.jsonl in --dir_warpedTempSeg)')
 parser.add_argument('-g', '--gpuIDs', help='GPU ID(s) - if not supplied, CPU is used')
 parser.add_argument('--multichannel', action='store_true',
                     help='specify that data has multiple channels')
 args = parser.parse_args()
 
+if args.batch_size < 1:
+    raise ValueError('Batch size should be a positive integer, but found %d' % args.batch_size)
+if not (args.dir_targetImg or args.list_targetImg):
+    raise ValueError('Add "--dir_targetImg" or "--list_targetImg".')
+shard_index, nb_shards = parse_shard(args.shard)
+
 # tensorflow device handling
 device, nb_devices = vxm.tf.utils.setup_device(args.gpuIDs)
 
@@ -57,28 +93,152 @@ add_feat_axis = not args.multichannel
 TempSeg = vxm.py.utils.load_volfile(
     args.file_TempSeg, add_batch_axis=True, add_feat_axis=add_feat_axis, ret_affine=False)
 
-
-for file_targetImg in glob.glob(os.path.join(args.dir_targetImg, "*.nii.gz")) + glob.glob(os.path.join(args.dir_targetImg, "*.nii")):
-    # load the target image
-    targetImg, targetAffine = vxm.py.utils.load_volfile(
-        file_targetImg, add_batch_axis=True, add_feat_axis=add_feat_axis, ret_affine=True)
-
-    inshape = targetImg.shape[1:-1]
-    nb_feats = targetImg.shape[-1]
-
-    with tf.device(device):
-        # load model and predict
-        config = dict(inshape=inshape)
-        warpingField = vxm.networks.TemplateCreation.load(args.file_model, **config).register_tmp2img(targetImg)
-        warpedTempSeg = vxm.networks.Transform(TempSeg.shape[1:-1],
-                                       interp_method="nearest",
-                                       nb_feats=TempSeg.shape[-1]).predict([TempSeg, warpingField])
-
-    # save the wrapped atlas
-    tmp, name_targetImg = os.path.split(file_targetImg)
-    file_warpedTempSeg = os.path.join(args.dir_warpedTempSeg, name_targetImg)
-    vxm.py.utils.save_volfile(warpedTempSeg.squeeze(), file_warpedTempSeg, targetAffine)
-
-    # save the warping field
+# the registration model and the transform model are built once per input shape
+regModels = RegistrationModelCache(args.file_model, direction='tmp2img', backend=args.backend, nb_threads=args.threads)
+transformModels = TransformCache(interp_method='nearest')
+
+# the target images of this shard; images whose outputs exist were registered by an earlier run
+if args.list_targetImg:
+    with open(args.list_targetImg, 'r') as f:
+        list_targetImg = [line.strip() for line in f if line.strip()]
+else:
+    list_targetImg = glob.glob(os.path.join(args.dir_targetImg, "*.nii.gz")) + glob.glob(os.path.join(args.dir_targetImg, "*.nii"))
+list_targetImg = shard_items(list_targetImg, shard_index, nb_shards)
+os.makedirs(args.dir_warpedTempSeg, exist_ok=True)
+os.makedirs(args.dir_warpingField, exist_ok=True)
+file_manifest = args.file_manifest or os.path.join(
+    args.dir_warpedTempSeg, 'manifest_shard%dof%d_%s.jsonl' % (shard_index, nb_shards, time.strftime('%Y%m%d-%H%M%S')))
+manifest = RunManifest(file_manifest, dict(vars(args), nb_subjects=len(list_targetImg)))
+
+
+def output_files(file_targetImg):
+    """
+    The warped template segmentation and the warping field of a target image.
+    """
+    name_targetImg = os.path.basename(file_targetImg)
     file_warpingField = os.path.join(args.dir_warpingField, name_targetImg)
-    vxm.py.utils.save_volfile(warpingField.squeeze(), file_warpingField, targetAffine)
+    if args.field_format != 'nii':
+        file_warpingField = field_filename(file_warpingField)
+    return os.path.join(args.dir_warpedTempSeg, name_targetImg), file_warpingField
+
+
+list_todo = []
+for file_targetImg in list_targetImg:
+    if not args.overwrite and is_complete(output_files(file_targetImg)):
+        manifest.record(os.path.basename(file_targetImg), 'skipped')
+    else:
+        list_todo.append(file_targetImg)
+print('Shard %d/%d: %d target images, %d to register' % (shard_index, nb_shards, len(list_targetImg), len(list_todo)))
+
+
+def load_target(file_targetImg):
+    """
+    Loads a target image; an image that cannot be read is recorded as failed and the run goes on.
+    """
+    start = time.perf_counter()
+    try:
+        targetImg, targetAffine = vxm.py.utils.load_volfile(
+            file_targetImg, add_batch_axis=True, add_feat_axis=add_feat_axis, ret_affine=True)
+    except Exception as e:
+        return None, None, time.perf_counter() - start, '%s: %s' % (type(e).__name__, e)
+    return targetImg, targetAffine, time.perf_counter() - start, None
+
+
+# target images are decoded and outputs are compressed in background threads
+reader = VolumeReader(load_target, nb_threads=args.io_threads, prefetch=args.prefetch)
+
+
+def save_volume(array, filename, affine):
+    """
+    Saves a .nii.gz file, or a warping field in the compact format (.npz).
+    """
+    if is_compact(filename):
+        save_field(array, filename, affine, dtype=args.field_format, step=args.field_step)
+    else:
+        vxm.py.utils.save_volfile(array, filename, affine)
+
+
+# subjects with outputs being written: the manifest record is completed by the last write
+progress = {}
+progress_lock = threading.Lock()
+
+
+def save_output(array, filename, affine, file_targetImg):
+    """
+    Writes one output atomically and records the subject when all its outputs are written.
+    """
+    start = time.perf_counter()
+    try:
+        save_atomic(save_volume, array, filename, affine)
+    except Exception as e:
+        with progress_lock:
+            record = progress.pop(file_targetImg, None)
+        if record is not None:
+            manifest.record(os.path.basename(file_targetImg), 'failed', error='%s: %s' % (type(e).__name__, e))
+        raise
+    with progress_lock:
+        record = progress.get(file_targetImg)
+        if record is None:
+            return
+        record['time_save'] += time.perf_counter() - start
+        record['remaining'] -= 1
+        if record['remaining'] > 0:
+            return
+        del progress[file_targetImg]
+    del record['remaining']
+    manifest.record(os.path.basename(file_targetImg), 'done', **record)
+
+
+writer = VolumeWriter(save_output, nb_threads=args.io_threads, queue_size=2 * args.batch_size)
+
+
+def register_batch(batch):
+    """
+    Registers the template to a batch of same-shape target images and saves the outputs.
+    """
+    targetImgs = np.concatenate([targetImg for _, targetImg, _, _ in batch], axis=0)
+
+    start = time.perf_counter()
+    try:
+        with tf.device(device):
+            # predict
+            warpingFields = regModels.predict(targetImgs)
+            warpedTempSegs = transformModels.predict(TempSeg, warpingFields)
+    except Exception as e:
+        for file_targetImg, _, _, _ in batch:
+            manifest.record(os.path.basename(file_targetImg), 'failed', error='%s: %s' % (type(e).__name__, e))
+        raise
+    time_predict = time.perf_counter() - start
+
+    for i, (file_targetImg, _, targetAffine, time_load) in enumerate(batch):
+        file_warpedTempSeg, file_warpingField = output_files(file_targetImg)
+        with progress_lock:
+            progress[file_targetImg] = dict(time_load=time_load, time_predict=time_predict, batch_size=len(batch),
+                                            time_save=0.0, remaining=2)
+        # save the wrapped atlas
+        writer.put(warpedTempSegs[i].squeeze(), file_warpedTempSeg, targetAffine, file_targetImg)
+        # save the warping field
+        writer.put(warpingFields[i].squeeze(), file_warpingField, targetAffine, file_targetImg)
+
+
+try:
+    # target images waiting for a full batch, grouped by input shape
+    pending = {}
+    for file_targetImg, (targetImg, targetAffine, time_load, error) in reader.iterate(list_todo):
+        if error is not None:
+            manifest.record(os.path.basename(file_targetImg), 'failed', error=error)
+            continue
+        inshape = targetImg.shape[1:]
+        pending.setdefault(inshape, []).append((file_targetImg, targetImg, targetAffine, time_load))
+        if len(pending[inshape]) == args.batch_size:
+            register_batch(pending.pop(inshape))
+
+    # register the remaining (incomplete) batches
+    for batch in pending.values():
+        register_batch(batch)
+
+    # wait for the pending writes
+    writer.close()
+finally:
+    counts = manifest.close()
+    print('Shard %d/%d: %s (manifest: %s)' % (shard_index, nb_shards, counts, file_manifest))
@@ -19,6 +19,10 @@ export dir_sourceLabels="path/to/training/segmentations"
 # folder of the output segmentation masks warped to the template image space
 export dir_warpedLabels="path/to/warped/segmentations" 
 
+# template segmentation built by majority voting of the warped segmentations (replaces "constructTempSeg.m")
+# e.g. file_TempSeg="~/Documents/CartiMorph/Models_training/vxm/vxm_data/template/templateSeg.nii.gz" 
+export file_TempSeg="path/to/template/segmentation/templateSeg.nii.gz" 
+
 # trained model
 export file_model='path/to/model/xxxxxx.h5' 
 
@@ -27,13 +31,10 @@ export file_model='path/to/model/xxxxxx.h5'
 export dir_scripts='path/to/python/script/folder' 
 export gpuIDs=0
 
+# number of source images registered in one prediction (the model is loaded only once)
+export batch_size=4
+
 
 # ====== registration ========================= 
-for img in $dir_sourceImgs/*.nii.gz 
-do 
-    export file_sourceImg="$dir_sourceImgs/${img##*/}" 
-    export file_sourceLabel="$dir_sourceLabels/${img##*/}" 
-    export file_warpedLabel="$dir_warpedLabels/${img##*/}" 
-    "$dir_scripts"/inference_img2temp_warpLabel.py --file_targetTemp "$file_targetTemp" --file_sourceImg "$file_sourceImg" --file_sourceLabel "$file_sourceLabel" --file_warpedLabel "$file_warpedLabel" --file_model "$file_model" --gpuIDs "$gpuIDs" 
-done 
+"$dir_scripts"/inference_img2temp_warpLabel.py --file_targetTemp "$file_targetTemp" --dir_sourceImg "$dir_sourceImgs" --dir_sourceLabel "$dir_sourceLabels" --dir_warpedLabel "$dir_warpedLabels" --file_TempSeg "$file_TempSeg" --file_model "$file_model" --batch_size "$batch_size" --gpuIDs "$gpuIDs" 
 # ====== registration ========================= 
@@ -0,0 +1,46 @@
+# e.g. ~/Documents/anaconda3/etc/profile.d/conda.sh 
+source /path/to/anaconda3/etc/profile.d/conda.sh 
+
+conda activate CartiMorphToolbox-Vxm 
+ 
+# e.g. LD_LIBRARY_PATH="~/Documents/anaconda3/envs/CartiMorphToolbox-Vxm/lib/python3.10/site-packages/nvidia/cublas/lib:$LD_LIBRARY_PATH" 
+export LD_LIBRARY_PATH="path/to/anaconda3/envs/CartiMorphToolbox-Vxm/lib/python3.10/site-packages/nvidia/cublas/lib:$LD_LIBRARY_PATH" 
+ 
+# path to the folder containing the pyhton script "inference_server.py"
+# e.g. dir_scripts='~/Documents/CartiMorph/Scripts/CartiMorph-vxm' 
+export dir_scripts='path/to/python/script/folder' 
+
+# path to the template segmentation mask
+# e.g. file_TempSeg='~/Documents/CartiMorph/Models_training/vxm/vxm_data/template/templateSeg.nii.gz' 
+export file_TempSeg='path/to/template/segmentation/file' 
+
+# set the path to the trained model
+# e.g. file_model='~/Documents/CartiMorph/Models_training/vxm/vxm_models/bestModel.h5' 
+export file_model='path/to/the/trained/model/bestModel.h5' 
+
+# model runtime: keras (the .h5 model above), or an artifact exported by "utils_modelExport.py" (e.g. savedmodel, tflite_float16),
+#   in which case file_model is the export folder
+export backend=keras
+
+export gpuIDs='0' 
+
+# UNIX socket of the service
+# e.g. socket='/tmp/cartimorph.sock'
+export socket='path/to/socket'
+
+# maximum number of concurrent same-shape requests predicted together, and the time a request waits for others
+export max_batch=4
+export max_wait_ms=10
+
+# format of the deformation fields: nii (.nii.gz), or float16/int16 (compact .npz files, smaller and faster to write)
+export field_format=nii
+
+# [Logging] 
+export log_file='path/to/log/file/predicting_service.log' 
+
+
+# the service runs until it is stopped (Ctrl+C); requests, e.g. for one target image:
+#   curl --unix-socket "$socket" http://localhost/tmp2img -d '{"image": "/path/to/image.nii.gz", "warped_seg": "/path/to/warpedTempSeg.nii.gz", "field": "/path/to/warpingField.nii.gz"}'
+# statistics (queue depth, batch sizes, latency):
+#   curl --unix-socket "$socket" http://localhost/stats
+"$dir_scripts"/inference_server.py --file_model "$file_model" --backend "$backend" --file_TempSeg "$file_TempSeg" --socket "$socket" --max_batch "$max_batch" --max_wait_ms "$max_wait_ms" --field_format "$field_format" --gpuIDs "$gpuIDs" >> "$log_file" 2>&1
@@ -30,10 +30,25 @@ export dir_warpingField='path/to/deformation/fields'
 # e.g. file_model='~/Documents/CartiMorph/Models_training/vxm/vxm_models/bestModel.h5' 
 export file_model='path/to/the/trained/model/bestModel.h5' 
 
+# model runtime: keras (the .h5 model above), or an artifact exported by "utils_modelExport.py" (e.g. savedmodel, tflite_float16),
+#   in which case file_model is the export folder
+export backend=keras
+
 export gpuIDs='0' 
 
+# number of target images registered in one prediction (the model is loaded only once)
+export batch_size=4
+
+# format of the deformation fields: nii (.nii.gz), or float16/int16 (compact .npz files, smaller and faster to write)
+export field_format=nii
+
+# part of the target images registered by this run: shard i of N (0 <= i < N), e.g. in a SLURM job array (sbatch --array=0-9)
+#   shard="$SLURM_ARRAY_TASK_ID/$SLURM_ARRAY_TASK_COUNT"
+# target images whose outputs already exist are skipped, so an interrupted run is resumed by running it again
+export shard=0/1
+
 # [Logging] 
 export log_file='path/to/log/file/predicting_warpTempSeg.log' 
 
 
-"$dir_scripts"/inference_temp2img_warpTempSeg.py --dir_targetImg "$dir_targetImg" --file_TempSeg "$file_TempSeg" --dir_warpedTempSeg "$dir_warpedTempSeg" --dir_warpingField "$dir_warpingField" --file_model "$file_model" --gpuIDs "$gpuIDs" >> "$log_file" 2>&1
+"$dir_scripts"/inference_temp2img_warpTempSeg.py --dir_targetImg "$dir_targetImg" --file_TempSeg "$file_TempSeg" --dir_warpedTempSeg "$dir_warpedTempSeg" --dir_warpingField "$dir_warpingField" --file_model "$file_model" --backend "$backend" --batch_size "$batch_size" --field_format "$field_format" --shard "$shard" --gpuIDs "$gpuIDs" >> "$log_file" 2>&1
@@ -0,0 +1,36 @@
+# e.g. ~/Documents/anaconda3/etc/profile.d/conda.sh 
+source /path/to/anaconda3/etc/profile.d/conda.sh 
+
+conda activate CartiMorphToolbox-Vxm 
+
+# path to the folder containing the pyhton script "inference_temp2img_warpNative.py"
+# e.g. dir_scripts='~/Documents/CartiMorph/Scripts/CartiMorph-vxm' 
+export dir_scripts='path/to/python/script/folder' 
+
+# path to the deformation fields saved by "predicting_warpTempSeg.sh"
+# e.g. dir_warpingField='~/Documents/CartiMorph/Models_training/vxm/vxm_inference/temp2img_warpingField'
+export dir_warpingField='path/to/deformation/fields' 
+
+# path to the template segmentation mask
+# e.g. file_TempSeg='~/Documents/CartiMorph/Models_training/vxm/vxm_data/template/templateSeg.nii.gz' 
+export file_TempSeg='path/to/template/segmentation/file' 
+
+# image preprocessing parameters saved by "M_down.m"
+# e.g. file_imgPreInfo='~/Documents/CartiMorph/Models_training/vxm/vxm_data/imgPreInfo.mat' 
+export file_imgPreInfo='path/to/imgPreInfo.mat' 
+
+# path to the original (full-resolution) image folder, i.e. the input image folder of "M_down.m"
+export dir_nativeImg='path/to/original/image/folder' 
+
+# output folder for the warped template segmentation masks at the original resolution
+# e.g. dir_warpedTempSeg='~/Documents/CartiMorph/Models_training/vxm/vxm_inference/temp2img_warpedTempSeg_fullres' 
+export dir_warpedTempSeg='path/to/warped/template/segmentation' 
+
+# number of slices of the original image warped at once (bounds the memory use)
+export slab_size=16
+
+# [Logging] 
+export log_file='path/to/log/file/predicting_warpTempSegNative.log' 
+
+
+"$dir_scripts"/inference_temp2img_warpNative.py --dir_warpingField "$dir_warpingField" --file_TempSeg "$file_TempSeg" --file_imgPreInfo "$file_imgPreInfo" --dir_nativeImg "$dir_nativeImg" --dir_warpedTempSeg "$dir_warpedTempSeg" --slab_size "$slab_size" >> "$log_file" 2>&1
@@ -30,45 +30,95 @@ License.
 """
 
 import os
+import sys
 import argparse
 import numpy as np
 import voxelmorph as vxm
 import tensorflow as tf
 
+# shared helpers in the parent folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils_streamIO import VolumeReader, VolumeWriter
+from utils_fieldIO import FIELD_DTYPES, field_filename, save_field
+from utils_modelExport import BACKENDS, ExportedModel
+
 
 # parse commandline args
 parser = argparse.ArgumentParser()
 parser.add_argument('--moving', required=True, help='moving image (source) filename')
 parser.add_argument('--fixed', required=True, help='fixed image (target) filename')
 parser.add_argument('--moved', required=True, help='warped image output filename')
-parser.add_argument('--model', required=True, help='keras model for nonlinear registration')
+parser.add_argument('--model', required=True,
+                    help='keras model for nonlinear registration, or the export folder of "utils_modelExport.py" with --backend')
+parser.add_argument('--backend', default='keras', choices=('keras',) + tuple(BACKENDS),
+                    help='keras (.h5 model), or an exported artifact, e.g. savedmodel or tflite_float16 (default: keras)')
+parser.add_argument('--threads', type=int, help='number of CPU threads of an exported artifact (default: all cores)')
 parser.add_argument('--warp', help='output warp deformation filename')
+parser.add_argument('--warp-format', default='nii', choices=('nii',) + FIELD_DTYPES,
+                    help='format of the warp: nii, or float16/int16/float32 compact .npz file (default: nii)')
+parser.add_argument('--warp-step', type=float,
+                    help='quantization step (in voxels) of an int16 warp; the error is at most half of it (default: max|warp|/32767)')
+parser.add_argument('--warp-svf', action='store_true',
+                    help='store the low-resolution stationary velocity field of the compact warp; it is integrated when loaded')
 parser.add_argument('-g', '--gpu', help='GPU number(s) - if not supplied, CPU is used')
 parser.add_argument('--multichannel', action='store_true',
                     help='specify that data has multiple channels')
 args = parser.parse_args()
 
+if args.warp_svf and args.warp_format == 'nii':
+    raise ValueError('"--warp-svf" requires a compact "--warp-format" (float16, int16 or float32).')
+if args.warp_svf and args.backend != 'keras':
+    raise ValueError('"--warp-svf" requires the keras backend (the exported models predict the warp only).')
+
 # tensorflow device handling
 device, nb_devices = vxm.tf.utils.setup_device(args.gpu)
 
-# load moving and fixed images
+# load moving and fixed images (decoded concurrently)
 add_feat_axis = not args.multichannel
-moving = vxm.py.utils.load_volfile(args.moving, add_batch_axis=True, add_feat_axis=add_feat_axis)
-fixed, fixed_affine = vxm.py.utils.load_volfile(
-    args.fixed, add_batch_axis=True, add_feat_axis=add_feat_axis, ret_affine=True)
+reader = VolumeReader(lambda file: vxm.py.utils.load_volfile(
+    file, add_batch_axis=True, add_feat_axis=add_feat_axis, ret_affine=True), nb_threads=2)
+(moving, _), (fixed, fixed_affine) = reader.load_all([args.moving, args.fixed])
 
 inshape = moving.shape[1:-1]
 nb_feats = moving.shape[-1]
 
 with tf.device(device):
     # load model and predict
-    config = dict(inshape=inshape, input_model=None)
-    warp = vxm.networks.VxmDense.load(args.model, **config).register(moving, fixed)
+    if args.backend != 'keras':
+        warp = ExportedModel(args.model, backend=args.backend, nb_threads=args.threads).predict([moving, fixed])
+    else:
+        config = dict(inshape=inshape, input_model=None)
+        model = vxm.networks.VxmDense.load(args.model, **config)
+        if args.warp_svf:
+            # predict the (low-resolution) velocity field along with the warp
+            warp, svf = tf.keras.Model(model.inputs, [model.references.pos_flow, model.references.preint_flow]).predict([moving, fixed])
+        else:
+            warp = model.register(moving, fixed)
     moved = vxm.networks.Transform(inshape, nb_feats=nb_feats).predict([moving, warp])
 
-# save warp
-if args.warp:
-    vxm.py.utils.save_volfile(warp.squeeze(), args.warp, fixed_affine)
 
-# save moved image
-vxm.py.utils.save_volfile(moved.squeeze(), args.moved, fixed_affine)
+def save_output(array, filename, affine):
+    """
+    Saves a .nii.gz file, or the warp in the compact format (.npz) with the measured displacement error.
+    """
+    if filename != args.warp or args.warp_format == 'nii':
+        vxm.py.utils.save_volfile(array, filename, affine)
+        return
+    filename = field_filename(filename)
+    if args.warp_svf:
+        params = model.config.params
+        int_steps = params.get('int_steps', 7)
+        rescale_factor = inshape[0] / svf.shape[1] if int_steps > 0 else 1
+        max_error = save_field(svf, filename, affine, dtype=args.warp_format, kind='svf', int_steps=int_steps,
+                               rescale_factor=rescale_factor, step=args.warp_step, reference=warp)
+    else:
+        max_error = save_field(array, filename, affine, dtype=args.warp_format, step=args.warp_step)
+    print('Saved %s (maximum displacement error: %.2g voxels)' % (filename, max_error))
+
+
+# save warp and moved image (compressed concurrently)
+with VolumeWriter(save_output, nb_threads=2) as writer:
+    if args.warp:
+        writer.put(warp.squeeze(), args.warp, fixed_affine)
+    writer.put(moved.squeeze(), args.moved, fixed_affine)
+
@@ -5,7 +5,9 @@ Example script to apply a deformation to an image. Usage is:
 
     warp.py --moving moving.nii.gz --warp warp.nii.gz --moved moved.nii.gz
 
-Interpolation method can be specified with the --interp flag.
+Interpolation method can be specified with the --interp flag. Several moving images can be
+warped by the same field (--moving a.nii.gz b.nii.gz --moved a_moved.nii.gz b_moved.nii.gz);
+the default NumPy backend computes the sampling indices once and does not import TensorFlow.
 
 If you use this code, please cite the following, and read function docs for further info/citations
     VoxelMorph: A Learning Framework for Deformable Medical Image Registration 
@@ -27,37 +29,74 @@ the License.
 
 import os
 import argparse
+import sys
 import numpy as np
-import voxelmorph as vxm
-import tensorflow as tf
+import nibabel as nib
+
+# shared helpers in the parent folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils_streamIO import VolumeReader, VolumeWriter
+from utils_warping import WarpSampler
+from utils_fieldIO import is_compact, load_warp
 
 
 # parse commandline args
 parser = argparse.ArgumentParser()
-parser.add_argument('--moving', required=True, help='moving image filename')
-parser.add_argument('--warp', required=True, help='warp image filename')
-parser.add_argument('--moved', required=True, help='warped image output filename')
+parser.add_argument('--moving', required=True, nargs='+', help='moving image filename(s)')
+parser.add_argument('--warp', required=True, help='warp image filename (.nii.gz, or a compact field file .npz)')
+parser.add_argument('--moved', required=True, nargs='+', help='warped image output filename(s), one per moving image')
 parser.add_argument('--interp', default='linear',
                     help='interpolation method linear/nearest (default: linear)')
-parser.add_argument('--gpu', help='GPU number - if not supplied, CPU is used')
+parser.add_argument('--backend', default='numpy', choices=['numpy', 'tf'],
+                    help='warping engine: numpy (no TensorFlow, sampling indices reused for all moving images) or tf (default: numpy)')
+parser.add_argument('--gpu', help='GPU number - if not supplied, CPU is used (tf backend)')
 parser.add_argument('--multichannel', action='store_true',
                     help='specify that data has multiple channels')
 args = parser.parse_args()
 
-# load moving image and deformation field
-add_feat_axis = not args.multichannel
-moving = vxm.py.utils.load_volfile(args.moving, add_batch_axis=True, add_feat_axis=add_feat_axis)
-deform, deform_affine = vxm.py.utils.load_volfile(
-    args.warp, add_batch_axis=True, ret_affine=add_feat_axis)
+if len(args.moving) != len(args.moved):
+    raise ValueError('Number of moving images (%d) should match the number of output filenames (%d)' % (len(args.moving), len(args.moved)))
+
+if args.backend == 'numpy':
+    # load the deformation field and build the sampler once
+    deform, deform_affine = load_warp(args.warp)
+    sampler = WarpSampler(deform, interp_method=args.interp)
+
+    def save_volfile(array, filename, affine):
+        nib.save(nib.Nifti1Image(array, affine), filename)
+
+    # warp every moving image with the same sampling indices (files decoded and written in background threads)
+    reader = VolumeReader(lambda file: np.asanyarray(nib.load(file).dataobj), nb_threads=2)
+    with VolumeWriter(save_volfile, nb_threads=2) as writer:
+        for (file_moving, moving), file_moved in zip(reader.iterate(args.moving), args.moved):
+            if args.multichannel:
+                moved = sampler.warp(moving)
+            else:
+                moved = sampler.warp(moving.squeeze())
+            writer.put(moved.squeeze(), file_moved, deform_affine)
+
+else:
+    import voxelmorph as vxm
+    import tensorflow as tf
+
+    # load moving image and deformation field (decoded concurrently)
+    add_feat_axis = not args.multichannel
+    reader = VolumeReader(lambda load_args: vxm.py.utils.load_volfile(load_args[0], **load_args[1]), nb_threads=2)
+    if is_compact(args.warp):
+        deform, deform_affine = load_warp(args.warp)
+        deform = deform[np.newaxis]
+    else:
+        deform, deform_affine = vxm.py.utils.load_volfile(args.warp, add_batch_axis=True, ret_affine=True)
 
-# tensorflow device handling
-device, nb_devices = vxm.tf.utils.setup_device(args.gpu)
+    # tensorflow device handling
+    device, nb_devices = vxm.tf.utils.setup_device(args.gpu)
 
-# build transfer model and warp
-with tf.device(device):
-    moved = vxm.networks.Transform(moving.shape[1:-1],
-                                   interp_method=args.interp,
-                                   nb_feats=moving.shape[-1]).predict([moving, deform])
+    for (_, moving), file_moved in zip(reader.iterate([(file, dict(add_batch_axis=True, add_feat_axis=add_feat_axis)) for file in args.moving]), args.moved):
+        # build transfer model and warp
+        with tf.device(device):
+            moved = vxm.networks.Transform(moving.shape[1:-1],
+                                           interp_method=args.interp,
+                                           nb_feats=moving.shape[-1]).predict([moving, deform])
 
-# save moved image
-vxm.py.utils.save_volfile(moved.squeeze(), args.moved, deform_affine)
+        # save moved image
+        vxm.py.utils.save_volfile(moved.squeeze(), file_moved, deform_affine)
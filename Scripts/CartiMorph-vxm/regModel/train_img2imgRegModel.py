@@ -35,7 +35,9 @@ License.
 """
 
 import os
+import sys
 import random
+import contextlib
 import argparse
 import numpy as np
 import tensorflow as tf
@@ -43,12 +45,13 @@ import keras
 from keras.optimizer_v2.adam import Adam
 import voxelmorph as vxm
 
+# shared helpers in the parent folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import utils_volumeCache
+import utils_distributed
+from utils_profiler import TrainingProfiler
+from utils_checkpoint import CheckpointManager
 
-# disable eager execution
-tf.compat.v1.disable_eager_execution()
-
-# compatibility setting
-tf.compat.v1.experimental.output_all_intermediates(True)
 
 # parse the commandline
 parser = argparse.ArgumentParser()
@@ -62,6 +65,8 @@ parser.add_argument('--model-dir', default='models',
                     help='model output directory (default: models)')
 parser.add_argument('--multichannel', action='store_true',
                     help='specify that data has multiple channels')
+parser.add_argument('--cache-dir',
+                    help='optional folder of a memory-mapped cache of the training images (built on first use)')
 
 # training parameters
 parser.add_argument('--gpu', default='0', help='GPU ID numbers (default: 0)')
@@ -74,6 +79,19 @@ parser.add_argument('--load-weights', help='optional weights file to initialize
 parser.add_argument('--initial-epoch', type=int, default=0,
                     help='initial epoch number (default: 0)')
 parser.add_argument('--lr', type=float, default=1e-4, help='learning rate (default: 1e-4)')
+parser.add_argument('--keep-checkpoints', type=int, default=0,
+                    help='number of latest checkpoints kept besides the best one; 0 keeps all (default: 0)')
+parser.add_argument('--profile', help='optional log file (.jsonl or .csv) of the time, throughput and memory of every training step')
+parser.add_argument('--profile-steps', type=int, nargs=2, metavar=('START', 'STOP'),
+                    help='optional window of global steps traced by the TF profiler (written to <model-dir>/profile)')
+
+# distributed training parameters
+parser.add_argument('--distributed', action='store_true',
+                    help='data-parallel training on CPU with the workers in TF_CONFIG (the batch size is the global batch size)')
+parser.add_argument('--local-workers', type=int, default=0,
+                    help='start this many local worker processes for distributed training (implies --distributed)')
+parser.add_argument('--threads-per-worker', type=int,
+                    help='number of CPU threads of each worker (default: all cores)')
 
 # network architecture parameters
 parser.add_argument('--enc', type=int, nargs='+',
@@ -99,6 +117,28 @@ parser.add_argument('--legacy-image-sigma', dest='image_sigma', type=float, defa
                     help='image noise parameter for miccai 2018 network (recommended value is 0.02 when --use-probs is enabled)')  # nopep8
 args = parser.parse_args()
 
+# start the local workers, each running this script with its TF_CONFIG
+if args.local_workers > 1 and 'TF_CONFIG' not in os.environ:
+    sys.exit(utils_distributed.launch_local(args.local_workers, sys.argv, nb_threads=args.threads_per_worker))
+distributed = args.distributed or args.local_workers > 1
+
+if distributed:
+    # CPU-only data-parallel training (the strategy must be created before any other TF operation)
+    device, nb_devices = vxm.tf.utils.setup_device('-1')
+    strategy, task_index, nb_workers = utils_distributed.setup_strategy(args.threads_per_worker)
+    is_chief = task_index == 0
+    assert args.batch_size % strategy.num_replicas_in_sync == 0, \
+        'Batch size (%d) should be a multiple of the nr of workers (%d)' % (args.batch_size, strategy.num_replicas_in_sync)
+else:
+    # disable eager execution
+    tf.compat.v1.disable_eager_execution()
+
+    # compatibility setting
+    tf.compat.v1.experimental.output_all_intermediates(True)
+
+    strategy, task_index, nb_workers = None, 0, 1
+    is_chief = True
+
 # load and prepare training data
 train_files = vxm.py.utils.read_file_list(args.img_list, prefix=args.img_prefix,
                                           suffix=args.img_suffix)
@@ -107,21 +147,49 @@ assert len(train_files) > 0, 'Could not find any training data.'
 # no need to append an extra feature axis if data is multichannel
 add_feat_axis = not args.multichannel
 
+# optional memory-mapped cache of the training images
+cache = None
+if args.cache_dir:
+    cache = utils_volumeCache.VolumeCache(args.cache_dir, train_files,
+                                          load_fn=lambda scan: vxm.py.utils.load_volfile(scan, np_var='vol', add_feat_axis=add_feat_axis))
+
+atlas = None
 if args.atlas:
-    # scan-to-atlas generator
     atlas = vxm.py.utils.load_volfile(args.atlas, np_var='vol',
                                       add_batch_axis=True, add_feat_axis=add_feat_axis)
-    generator = vxm.generators.scan_to_atlas(train_files, atlas,
-                                             batch_size=args.batch_size,
-                                             bidir=args.bidir,
-                                             add_feat_axis=add_feat_axis)
-else:
+
+
+def make_generator(shard_index=0, nb_shards=1, batch_size=args.batch_size):
+    """
+    Training generator drawing from one shard of the training files (all files by default).
+    """
+    if atlas is not None:
+        # scan-to-atlas generator
+        if cache is not None:
+            return utils_volumeCache.scan_to_atlas(cache, atlas,
+                                                   batch_size=batch_size,
+                                                   bidir=args.bidir,
+                                                   indices=utils_distributed.shard(range(len(cache)), shard_index, nb_shards))
+        return vxm.generators.scan_to_atlas(utils_distributed.shard(train_files, shard_index, nb_shards), atlas,
+                                            batch_size=batch_size,
+                                            bidir=args.bidir,
+                                            add_feat_axis=add_feat_axis)
     # scan-to-scan generator
-    generator = vxm.generators.scan_to_scan(
-        train_files, batch_size=args.batch_size, bidir=args.bidir, add_feat_axis=add_feat_axis)
+    if cache is not None:
+        return utils_volumeCache.scan_to_scan(
+            cache, batch_size=batch_size, bidir=args.bidir,
+            indices=utils_distributed.shard(range(len(cache)), shard_index, nb_shards))
+    return vxm.generators.scan_to_scan(
+        utils_distributed.shard(train_files, shard_index, nb_shards),
+        batch_size=batch_size, bidir=args.bidir, add_feat_axis=add_feat_axis)
+
+
+# each worker draws its part of the batch from its own shard of the training files
+generator = make_generator(task_index, nb_workers, args.batch_size // nb_workers)
 
 # extract shape and number of features from sampled input
-sample_shape = next(generator)[0][0].shape
+sample = next(generator)
+sample_shape = sample[0][0].shape
 inshape = sample_shape[1:-1]
 nfeats = sample_shape[-1]
 
@@ -130,7 +198,8 @@ model_dir = args.model_dir
 os.makedirs(model_dir, exist_ok=True)
 
 # tensorflow device handling
-device, nb_devices = vxm.tf.utils.setup_device(args.gpu)
+if not distributed:
+    device, nb_devices = vxm.tf.utils.setup_device(args.gpu)
 assert np.mod(args.batch_size, nb_devices) == 0, \
     'Batch size (%d) should be a multiple of the nr of gpus (%d)' % (args.batch_size, nb_devices)
 
@@ -138,8 +207,20 @@ assert np.mod(args.batch_size, nb_devices) == 0, \
 enc_nf = args.enc if args.enc else [16, 32, 32, 32]
 dec_nf = args.dec if args.dec else [32, 32, 32, 32, 32, 16, 16]
 
+# optional step-level profiling (one log per worker)
+callbacks = []
+if args.profile or args.profile_steps:
+    file_profile = args.profile or os.path.join(model_dir, 'profile.jsonl')
+    if not is_chief:
+        root, ext = os.path.splitext(file_profile)
+        file_profile = '%s.worker%d%s' % (root, task_index, ext)
+    profiler = TrainingProfiler(file_profile, args.batch_size // nb_workers, profile_steps=args.profile_steps,
+                                profile_dir=os.path.join(model_dir, 'profile', 'worker%d' % task_index))
+    generator = profiler.wrap(generator)
+    callbacks.append(profiler)
+
 # prepare model checkpoint save path
-save_filename = os.path.join(model_dir, '{epoch:04d}.h5')
+save_filename = '{epoch:04d}.h5'
 
 # build the model
 if args.reg_field=='svf':
@@ -147,21 +228,24 @@ if args.reg_field=='svf':
 elif args.reg_field=='deformation':
     reg_field='warp'
 
-model = vxm.networks.VxmDense(
-    inshape=inshape,
-    nb_unet_features=[enc_nf, dec_nf],
-    bidir=args.bidir,
-    use_probs=args.use_probs,
-    int_steps=args.int_steps,
-    int_resolution=args.int_downsize,
-    src_feats=nfeats,
-    trg_feats=nfeats,
-    reg_field=reg_field
-)
-
-# load initial weights (if provided)
-if args.load_weights:
-    model.load_weights(args.load_weights)
+# variables created in the strategy scope are mirrored on all workers
+scope = strategy.scope() if distributed else contextlib.nullcontext()
+with scope:
+    model = vxm.networks.VxmDense(
+        inshape=inshape,
+        nb_unet_features=[enc_nf, dec_nf],
+        bidir=args.bidir,
+        use_probs=args.use_probs,
+        int_steps=args.int_steps,
+        int_resolution=args.int_downsize,
+        src_feats=nfeats,
+        trg_feats=nfeats,
+        reg_field=reg_field
+    )
+
+    # load initial weights (if provided)
+    if args.load_weights:
+        model.load_weights(args.load_weights)
 
 # prepare image loss
 if args.image_loss == 'ncc':
@@ -188,22 +272,43 @@ else:
 
 weights += [args.lambda_weight]
 
+# checkpoints written in the background (by the chief worker only); the single-device
+# model is saved when training a multi-gpu copy
+save_callback = CheckpointManager(model, model_dir,
+                                  period=1 if nb_devices > 1 else 20,
+                                  keep_last=args.keep_checkpoints,
+                                  filename=save_filename,
+                                  is_chief=is_chief)
+
 # multi-gpu support
 if nb_devices > 1:
-    save_callback = vxm.networks.ModelCheckpointParallel(save_filename)
     model = keras.utils.multi_gpu_utils.multi_gpu_model(model, gpus=nb_devices)
-else:
-    save_callback = keras.callbacks.ModelCheckpoint(save_filename, period=20)
 
-model.compile(optimizer=Adam(learning_rate=args.lr), loss=losses, loss_weights=weights)
+with scope:
+    model.compile(optimizer=Adam(learning_rate=args.lr), loss=losses, loss_weights=weights)
 
 # save starting weights
-model.save(save_filename.format(epoch=args.initial_epoch))
-
-model.fit_generator(generator,
-                    initial_epoch=args.initial_epoch,
-                    epochs=args.epochs,
-                    steps_per_epoch=args.steps_per_epoch,
-                    callbacks=[save_callback],
-                    verbose=1
-                    )
+save_callback.save(args.initial_epoch)
+
+if distributed:
+    # each worker builds the generator of its shard with its part of the global batch
+    if callbacks:
+        shard_generator = lambda *shard: profiler.wrap(make_generator(*shard))
+    else:
+        shard_generator = make_generator
+    model.fit(utils_distributed.dataset_creator(shard_generator, args.batch_size, sample),
+              initial_epoch=args.initial_epoch,
+              epochs=args.epochs,
+              steps_per_epoch=args.steps_per_epoch,
+              callbacks=[save_callback] + callbacks,
+              verbose=1 if is_chief else 0
+              )
+else:
+    model.fit_generator(generator,
+                        initial_epoch=args.initial_epoch,
+                        epochs=args.epochs,
+                        steps_per_epoch=args.steps_per_epoch,
+                        callbacks=[save_callback] + callbacks,
+                        verbose=1
+                        )
+save_callback.close()
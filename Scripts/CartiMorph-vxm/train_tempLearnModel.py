@@ -32,11 +32,15 @@ the License.
 
 import os
 import argparse
+import numpy as np
 import shutil
 import tensorflow as tf
-import keras
 from keras.optimizers import Adam # keras==2.9.0
 import CartiMorph_vxm as vxm
+from utils_template import init_template
+import utils_volumeCache
+from utils_profiler import TrainingProfiler
+from utils_checkpoint import CheckpointManager
 
 
 # confirm visible GPUs
@@ -61,11 +65,15 @@ parser.add_argument('--model-dir', default='models',
                     help='model output directory (default: models)')
 parser.add_argument('--multichannel', action='store_true',
                     help='specify that data has multiple channels')
+parser.add_argument('--cache-dir',
+                    help='optional folder of a memory-mapped cache of the training images (built on first use)')
 
 # template image
 parser.add_argument('--init-template', help='initial template image')
 parser.add_argument('--imgVoxelSize', required=True, help='voxel size of the learned template image', nargs='+')
 parser.add_argument('--freezeTemp', action='store_true', help='stop template learning/freeze the learned template')
+parser.add_argument('--init-threads', type=int, default=4,
+                    help='number of threads reading scans for the starting template (default: 4)')
 
 # training parameters
 parser.add_argument('--gpu', default='0', help='GPU ID numbers (default: 0)')
@@ -79,6 +87,11 @@ parser.add_argument('--initial-epoch', type=int, default=0,
                     help='initial epoch number (default: 0)')
 parser.add_argument('--lr', type=float, default=1e-4, help='learning rate (default: 1e-4)')
 parser.add_argument('--model_saving_step', type=int, default=50, help='model saving step')
+parser.add_argument('--keep-checkpoints', type=int, default=0,
+                    help='number of latest checkpoints (weights and template) kept besides the best one; 0 keeps all (default: 0)')
+parser.add_argument('--profile', help='optional log file (.jsonl or .csv) of the time, throughput and memory of every training step')
+parser.add_argument('--profile-steps', type=int, nargs=2, metavar=('START', 'STOP'),
+                    help='optional window of global steps traced by the TF profiler (written to <model-dir>/profile)')
 
 # network architecture parameters
 parser.add_argument('--enc', type=int, nargs='+',
@@ -130,27 +143,38 @@ else:
                    [0, args.imgVoxelSize[1], 0, 0],
                    [0, 0, args.imgVoxelSize[2], 0],
                    [0,0,0,1]]
-    # generate rough atlas by averaging inputs
-    navgs = len(train_files)
-    print('Creating starting template by averaging first %d scans.' % navgs)
-    template = 0
-    for scan in train_files[:navgs]:
-        template += vxm.py.utils.load_volfile(scan, add_batch_axis=True,
-                                              add_feat_axis=add_feat_axis)
-    template = template / navgs
-    # save average input atlas for the record
-    vxm.py.utils.save_volfile(template.squeeze(), os.path.join(model_dir, 'init_template.nii.gz'), template_affine)
+    # generate rough atlas by averaging inputs (reused if built from the same scans)
+    template = init_template(train_files,
+                             load_fn=lambda scan: vxm.py.utils.load_volfile(scan, add_feat_axis=add_feat_axis),
+                             save_fn=vxm.py.utils.save_volfile,
+                             model_dir=model_dir,
+                             affine=template_affine,
+                             nb_threads=args.init_threads)[np.newaxis]
 
 # get template shape (might differ from image input shape)
 template_shape = template.shape[1:-1]
 nfeats = template.shape[-1]
 
 # configure generator
-generator = vxm.generators.template_creation(
-    train_files, bidir=True, batch_size=args.batch_size, add_feat_axis=add_feat_axis)
+if args.cache_dir:
+    # draw batches from the memory-mapped cache instead of decoding the files for every sample
+    cache = utils_volumeCache.VolumeCache(args.cache_dir, train_files,
+                                          load_fn=lambda scan: vxm.py.utils.load_volfile(scan, add_feat_axis=add_feat_axis))
+    generator = utils_volumeCache.template_creation(cache, bidir=True, batch_size=args.batch_size)
+else:
+    generator = vxm.generators.template_creation(
+        train_files, bidir=True, batch_size=args.batch_size, add_feat_axis=add_feat_axis)
+
+# optional step-level profiling
+callbacks = []
+if args.profile or args.profile_steps:
+    profiler = TrainingProfiler(args.profile or os.path.join(model_dir, 'profile.jsonl'), args.batch_size,
+                                profile_steps=args.profile_steps, profile_dir=os.path.join(model_dir, 'profile'))
+    generator = profiler.wrap(generator)
+    callbacks.append(profiler)
 
 # prepare model checkpoint save path
-save_filename = os.path.join(model_dir, '{epoch:06d}.h5')
+save_filename = '{epoch:06d}.h5'
 
 # build model
 model = vxm.networks.TemplateCreation(
@@ -184,40 +208,24 @@ weights = [args.image_loss_weight, 1 - args.image_loss_weight,
 # compile model
 model.compile(optimizer=Adam(learning_rate=args.lr), loss=losses, loss_weights=weights)
 
+# checkpoints of the weights and the template every model_saving_step epochs, written in the background
+checkpoints = CheckpointManager(model, model_dir,
+                                period=args.model_saving_step,
+                                keep_last=args.keep_checkpoints,
+                                filename=save_filename,
+                                template_fn=model.get_atlas,
+                                save_template_fn=vxm.py.utils.save_volfile,
+                                template_affine=template_affine)
+
 # save starting weights
-model.save(save_filename.format(epoch=args.initial_epoch))
+checkpoints.save(args.initial_epoch)
 
 # model training
-model_saving_step = args.model_saving_step
-save_callback = keras.callbacks.ModelCheckpoint(save_filename, period=model_saving_step)
-if len(range(args.initial_epoch, args.epochs-model_saving_step+1, model_saving_step)):
-    for epoch in range(args.initial_epoch, args.epochs-model_saving_step+1, model_saving_step):
-        model.fit_generator(generator,
-                            initial_epoch=epoch,
-                            epochs=epoch+model_saving_step,
-                            callbacks=[save_callback],
-                            steps_per_epoch=args.steps_per_epoch,
-                            verbose=1
-                            )
-        vxm.py.utils.save_volfile(model.get_atlas(), os.path.join(model_dir, 'template_epoch'+str(epoch+model_saving_step).zfill(6)+'.nii.gz'), template_affine)
-    if epoch+model_saving_step < args.epochs:
-        save_callback_final = keras.callbacks.ModelCheckpoint(save_filename, period=args.epochs-epoch-model_saving_step)
-        model.fit_generator(generator,
-                            initial_epoch=epoch+model_saving_step,
-                            epochs=args.epochs,
-                            callbacks=[save_callback_final],
-                            steps_per_epoch=args.steps_per_epoch,
-                            verbose=1
-                            )
-        vxm.py.utils.save_volfile(model.get_atlas(), os.path.join(model_dir, 'template_epoch'+str(args.epochs).zfill(6)+'.nii.gz'), template_affine)
-else:
-    save_callback_final = keras.callbacks.ModelCheckpoint(save_filename, period=args.epochs-args.initial_epoch)
-    model.fit_generator(generator,
-                        initial_epoch=args.initial_epoch,
-                        epochs=args.epochs,
-                        callbacks=[save_callback_final],
-                        steps_per_epoch=args.steps_per_epoch,
-                        verbose=1
-                        )
-    vxm.py.utils.save_volfile(model.get_atlas(), os.path.join(model_dir, 'template_epoch'+str(args.epochs).zfill(6)+'.nii.gz'), template_affine)
-
+model.fit_generator(generator,
+                    initial_epoch=args.initial_epoch,
+                    epochs=args.epochs,
+                    callbacks=[checkpoints] + callbacks,
+                    steps_per_epoch=args.steps_per_epoch,
+                    verbose=1
+                    )
+checkpoints.close()
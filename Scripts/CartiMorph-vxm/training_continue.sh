@@ -33,6 +33,8 @@ export batch_size=1
 # total training epoch
 export epochs=500 
 export steps_per_epoch=103
+# number of latest checkpoints (model and template) kept besides the best one, 0 keeps all
+export keep_checkpoints=0
 
 # [Logging] 
 export log_file='path/to/log/file/training_continue.log' 
@@ -44,6 +46,10 @@ export lastModel='path/to/the/last/model/000100.h5'
 export lastEpoch=100 
 # last template image
 export lastTemplate='path/to/the/last/template/template_epoch000100.nii.gz' 
+# alternatively, resume from the latest complete checkpoint recorded in "$dir_model"/checkpoint.json
+# export lastModel=$(python "$dir_scripts"/utils_checkpoint.py --model-dir "$dir_model" --print model)
+# export lastEpoch=$(python "$dir_scripts"/utils_checkpoint.py --model-dir "$dir_model" --print epoch)
+# export lastTemplate=$(python "$dir_scripts"/utils_checkpoint.py --model-dir "$dir_model" --print template)
 
 
 # set the voxel size of the learned template image
@@ -53,9 +59,9 @@ export lastTemplate='path/to/the/last/template/template_epoch000100.nii.gz'
 
 # [training option 1]
 # modify the "--imgVoxelSize 1.0295 0.39976 0.39976" below
-CUDA_VISIBLE_DEVICES=$gpuIDs "$dir_scripts"/train_tempLearnModel.py --imgVoxelSize 1.0295 0.39976 0.39976 --enc 16  32  32  32 --dec 32  32  32  32  32  16  16 --image-loss "$imgLoss" --img-list "$img_list" --img-prefix "$img_prefix" --img-suffix "$img_suffix" --init-template "$lastTemplate" --model-dir "$dir_model" --batch-size "$batch_size"  --epochs "$epochs" --steps-per-epoch "$steps_per_epoch" --load-weights "$lastModel" --initial-epoch "$lastEpoch" >> "$log_file" 2>&1
+CUDA_VISIBLE_DEVICES=$gpuIDs "$dir_scripts"/train_tempLearnModel.py --imgVoxelSize 1.0295 0.39976 0.39976 --enc 16  32  32  32 --dec 32  32  32  32  32  16  16 --image-loss "$imgLoss" --img-list "$img_list" --img-prefix "$img_prefix" --img-suffix "$img_suffix" --init-template "$lastTemplate" --model-dir "$dir_model" --batch-size "$batch_size"  --epochs "$epochs" --steps-per-epoch "$steps_per_epoch" --keep-checkpoints "$keep_checkpoints" --load-weights "$lastModel" --initial-epoch "$lastEpoch" >> "$log_file" 2>&1
 
 # [training option 2]
 # use this command instead if you want to freeze the learned template and only train the registration module/subnetwork
 # (we add the argument "--freezeTemp")
-# CUDA_VISIBLE_DEVICES=$gpuIDs "$dir_scripts"/train_tempLearnModel.py --imgVoxelSize 1.0295 0.39976 0.39976 --freezeTemp --enc 16  32  32  32 --dec 32  32  32  32  32  16  16 --image-loss "$imgLoss" --img-list "$img_list" --img-prefix "$img_prefix" --img-suffix "$img_suffix" --init-template "$lastTemplate" --model-dir "$dir_model" --batch-size "$batch_size"  --epochs "$epochs" --steps-per-epoch "$steps_per_epoch" --load-weights "$lastModel" --initial-epoch "$lastEpoch" >> "$log_file" 2>&1
+# CUDA_VISIBLE_DEVICES=$gpuIDs "$dir_scripts"/train_tempLearnModel.py --imgVoxelSize 1.0295 0.39976 0.39976 --freezeTemp --enc 16  32  32  32 --dec 32  32  32  32  32  16  16 --image-loss "$imgLoss" --img-list "$img_list" --img-prefix "$img_prefix" --img-suffix "$img_suffix" --init-template "$lastTemplate" --model-dir "$dir_model" --batch-size "$batch_size"  --epochs "$epochs" --steps-per-epoch "$steps_per_epoch" --keep-checkpoints "$keep_checkpoints" --load-weights "$lastModel" --initial-epoch "$lastEpoch" >> "$log_file" 2>&1
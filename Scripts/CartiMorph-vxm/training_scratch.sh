@@ -29,6 +29,8 @@ export batch_size=1
 # total training epoch
 export epochs=1000
 export steps_per_epoch=100
+# number of latest checkpoints (model and template) kept besides the best one, 0 keeps all
+export keep_checkpoints=0
 
 # [Logging] 
 export log_file='path/to/log/file/training_scratch.log' 
@@ -48,4 +50,4 @@ fi
 # - you may set it to the voxel size of the first image 
 
 # modify the "--imgVoxelSize 1.0295 0.39976 0.39976" below
-CUDA_VISIBLE_DEVICES=$gpuIDs "$dir_scripts"/train_tempLearnModel.py --imgVoxelSize 1.0295 0.39976 0.39976 --enc 16  32  32  32 --dec 32  32  32  32  32  16  16 --image-loss "$imgLoss" --img-list "$img_list" --img-prefix "$img_prefix" --img-suffix "$img_suffix" --model-dir "$dir_model" --batch-size "$batch_size" --epochs "$epochs" --steps-per-epoch "$steps_per_epoch" >> "$log_file" 2>&1
+CUDA_VISIBLE_DEVICES=$gpuIDs "$dir_scripts"/train_tempLearnModel.py --imgVoxelSize 1.0295 0.39976 0.39976 --enc 16  32  32  32 --dec 32  32  32  32  32  16  16 --image-loss "$imgLoss" --img-list "$img_list" --img-prefix "$img_prefix" --img-suffix "$img_suffix" --model-dir "$dir_model" --batch-size "$batch_size" --epochs "$epochs" --steps-per-epoch "$steps_per_epoch" --keep-checkpoints "$keep_checkpoints" >> "$log_file" 2>&1
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+
+"""
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+Asynchronous, rotating checkpoints of the model weights and the learned template.
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+The CheckpointManager callback copies the weights (and the template) in the training
+thread and leaves the serialization to a background thread, so training only stalls
+when the previous checkpoint is still being written. Each file is written under a
+temporary name and renamed when complete; checkpoint.json in the model folder is
+updated last and points to the latest and the best (lowest loss) checkpoints, so it
+always refers to complete files. Only the last N checkpoints and the best one are
+kept (all of them with N=0).
+
+The .h5 files hold the weights (in the layout of Keras save_weights) and the model
+config, so they are loaded as before with load_weights() or the load() of the
+VoxelMorph models.
+
+Usage (in a shell script, the latest checkpoint to continue training from):
+    lastModel=$(python utils_checkpoint.py --model-dir /path/to/model/folder --print model)
+
+If you use this code, please cite the following:
+
+    Yongcheng Yao, Junru Zhong, Liping Zhang, Sheheryar Khan, Weitian Chen.
+    "CartiMorph: a framework for automated knee articular cartilage morphometrics."
+    Medical Image Analysis
+
+Copyright 2023 Yongcheng Yao
+
+-----------------------------------------------------------------------------------
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+compliance with the License. You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is
+distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+implied. See the License for the specific language governing permissions and limitations under
+the License.
+-----------------------------------------------------------------------------------
+"""
+
+import os
+import json
+import argparse
+import numpy as np
+import tensorflow as tf
+
+FILE_CHECKPOINT_INFO = 'checkpoint.json'
+
+# maximum size of an HDF5 attribute (as in Keras)
+HDF5_OBJECT_HEADER_LIMIT = 64512
+
+
+def _json_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return str(obj)
+
+
+def _save_attributes(group, name, data):
+    """
+    Saves a list of byte strings as an attribute, split into chunks as Keras does if it is too large.
+    """
+    data = np.asarray(data)
+    nb_chunks = 1
+    chunks = np.array_split(data, nb_chunks)
+    while any(chunk.nbytes > HDF5_OBJECT_HEADER_LIMIT for chunk in chunks):
+        nb_chunks += 1
+        chunks = np.array_split(data, nb_chunks)
+    if nb_chunks > 1:
+        for i, chunk in enumerate(chunks):
+            group.attrs['%s%d' % (name, i)] = chunk
+    else:
+        group.attrs[name] = data
+
+
+def save_weights_h5(filename, layers, model_config, keras_version=''):
+    """
+    Writes weights in the layout of Keras save_weights (.h5) with the model config.
+
+    layers is a list of (layer_name, weight_names, weight_values) in the order of model.layers.
+    """
+    import h5py
+    with h5py.File(filename, 'w') as f:
+        f.attrs['model_config'] = model_config.encode('utf8')
+        _save_attributes(f, 'layer_names', [name.encode('utf8') for name, _, _ in layers])
+        f.attrs['backend'] = b'tensorflow'
+        f.attrs['keras_version'] = str(keras_version).encode('utf8')
+        for layer_name, weight_names, values in sorted(layers, key=lambda layer: layer[0]):
+            group = f.create_group(layer_name)
+            _save_attributes(group, 'weight_names', [name.encode('utf8') for name in weight_names])
+            for name, value in zip(weight_names, values):
+                group.create_dataset(name, data=value)
+
+
+def read_checkpoint_info(model_dir):
+    """
+    The content of checkpoint.json in the model folder (None if there is no checkpoint).
+    """
+    path = os.path.join(model_dir, FILE_CHECKPOINT_INFO)
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _replace_tmp(path):
+    # temporary name with the same extension (the writers pick the format by extension)
+    return os.path.join(os.path.dirname(path), '.tmp_' + os.path.basename(path))
+
+
+class CheckpointManager(tf.keras.callbacks.Callback):
+    """
+    Callback saving the weights (and the template) every `period` epochs in a background thread.
+    """
+
+    def __init__(self, model, model_dir, period=1, keep_last=0, filename='{epoch:06d}.h5',
+                 template_fn=None, template_filename='template_epoch{epoch:06d}.nii.gz', save_template_fn=None,
+                 template_affine=None, monitor='loss', is_chief=True):
+        """
+        Parameters:
+            model: The model to save (e.g. the template model when training a multi-GPU copy).
+            model_dir: Model folder.
+            period: Number of epochs between checkpoints; the last epoch of a fit() call is always saved. Default is 1.
+            keep_last: Number of latest checkpoints kept besides the best one (0 keeps all). Default is 0.
+            filename: File name of the weights, formatted with the epoch. Default is '{epoch:06d}.h5'.
+            template_fn: Optional function returning the template (called in the training thread).
+            template_filename: File name of the template, formatted with the epoch.
+            save_template_fn: Function called with (template, filename, affine) that writes the template.
+            template_affine: Affine matrix of the template.
+            monitor: Training log value used to select the best checkpoint. Default is 'loss'.
+            is_chief: Only the chief worker of a distributed run writes checkpoints. Default is True.
+        """
+        super().__init__()
+        from utils_streamIO import VolumeWriter
+        self.source_model = model
+        self.model_dir = model_dir
+        self.period = max(1, period)
+        self.keep_last = keep_last
+        self.filename = filename
+        self.template_fn = template_fn
+        self.template_filename = template_filename
+        self.save_template_fn = save_template_fn
+        self.template_affine = template_affine
+        self.monitor = monitor
+        self.is_chief = is_chief
+        self.first_epoch = None
+        self.model_config = json.dumps({'class_name': model.__class__.__name__, 'config': model.get_config()},
+                                       default=_json_default)
+        # resume the rotation of an earlier run in the same folder
+        self.info = read_checkpoint_info(model_dir) or {'latest': None, 'best': None, 'checkpoints': []}
+        # one writing thread keeps the checkpoints in order; at most one more snapshot waits in memory
+        self.writer = VolumeWriter(self._write, nb_threads=1, queue_size=1)
+
+    def set_model(self, model):
+        # the model given at construction is saved (e.g. not the multi-GPU copy being trained)
+        super().set_model(model)
+
+    def on_epoch_begin(self, epoch, logs=None):
+        if self.first_epoch is None:
+            self.first_epoch = epoch
+
+    def on_epoch_end(self, epoch, logs=None):
+        nb_epochs = epoch + 1
+        if (nb_epochs - self.first_epoch) % self.period == 0 or nb_epochs == self.params.get('epochs'):
+            loss = (logs or {}).get(self.monitor)
+            self.save(nb_epochs, loss=None if loss is None else float(loss))
+
+    def on_train_end(self, logs=None):
+        self.flush()
+        # the period of the next fit() call counts from its first epoch
+        self.first_epoch = None
+
+    def save(self, epoch, loss=None):
+        """
+        Copies the weights (and the template) and queues them to be written as the checkpoint of the epoch.
+        """
+        if not self.is_chief:
+            return
+        layers = []
+        for layer in self.source_model.layers:
+            weights = layer.trainable_weights + layer.non_trainable_weights
+            layers.append((layer.name, [w.name for w in weights], tf.keras.backend.batch_get_value(weights)))
+        template = np.array(self.template_fn()) if self.template_fn is not None else None
+        self.writer.put(epoch, layers, template, loss)
+
+    def flush(self):
+        """
+        Waits until the queued checkpoints are written.
+        """
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+
+    def _write(self, epoch, layers, template, loss):
+        entry = {'epoch': epoch, 'loss': loss, 'model': self.filename.format(epoch=epoch), 'template': None}
+        path = os.path.join(self.model_dir, entry['model'])
+        save_weights_h5(_replace_tmp(path), layers, self.model_config, getattr(tf.keras, '__version__', ''))
+        os.replace(_replace_tmp(path), path)
+        if template is not None:
+            entry['template'] = self.template_filename.format(epoch=epoch)
+            path = os.path.join(self.model_dir, entry['template'])
+            self.save_template_fn(template, _replace_tmp(path), self.template_affine)
+            os.replace(_replace_tmp(path), path)
+
+        # update the list of checkpoints (a checkpoint of the same epoch is replaced)
+        checkpoints = [c for c in self.info['checkpoints'] if c['epoch'] != epoch] + [entry]
+        checkpoints.sort(key=lambda c: c['epoch'])
+        best = self.info['best']
+        if best is not None and best['epoch'] == epoch:
+            best = None
+        if loss is not None and (best is None or best['loss'] is None or loss < best['loss']):
+            best = entry
+        keep = checkpoints[-self.keep_last:] if self.keep_last > 0 else checkpoints
+        # by epoch: after a resume, best and its entry in checkpoints are equal but distinct dicts
+        removed = [c for c in checkpoints if c not in keep and (best is None or c['epoch'] != best['epoch'])]
+        self.info = {'latest': entry, 'best': best, 'checkpoints': [c for c in checkpoints if c not in removed]}
+
+        path_info = os.path.join(self.model_dir, FILE_CHECKPOINT_INFO)
+        with open(path_info + '.tmp', 'w') as f:
+            json.dump(self.info, f, indent=1)
+        os.replace(path_info + '.tmp', path_info)
+
+        # old files are removed only after checkpoint.json no longer refers to them
+        for c in removed:
+            for name in (c['model'], c['template']):
+                if name and os.path.isfile(os.path.join(self.model_dir, name)):
+                    os.remove(os.path.join(self.model_dir, name))
+
+
+if __name__ == '__main__':
+    # parse commandline args
+    parser = argparse.ArgumentParser(description='Print the latest (or the best) checkpoint of a model folder')
+    parser.add_argument('--model-dir', required=True, help='model folder')
+    parser.add_argument('--best', action='store_true', help='the best checkpoint instead of the latest one')
+    parser.add_argument('--print', default='model', choices=('model', 'template', 'epoch', 'loss'),
+                        help='what to print: the path of the model or the template, the epoch, or the loss (default: model)')
+    args = parser.parse_args()
+
+    info = read_checkpoint_info(args.model_dir)
+    checkpoint = info and info['best' if args.best else 'latest']
+    if not checkpoint:
+        raise SystemExit(f"No checkpoint found in '{args.model_dir}'")
+    value = checkpoint[args.print]
+    if args.print in ('model', 'template') and value is not None:
+        value = os.path.join(args.model_dir, value)
+    print(value)
@@ -0,0 +1,132 @@
+"""
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+Sharded and resumable processing of a cohort.
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+The input files are sorted and split into N shards by position (shard i gets the
+files i, i+N, i+2N, ...), so the processes listing the same folder, e.g. the tasks of
+a SLURM job array, get disjoint parts of the cohort:
+    sbatch --array=0-9 ...   with   --shard $SLURM_ARRAY_TASK_ID/$SLURM_ARRAY_TASK_COUNT
+Outputs are written under a temporary name and renamed when complete, so an existing
+output is a complete one, and a subject with all its outputs is skipped when the run
+is restarted (e.g. after preemption). Each run writes a manifest (JSON lines): the
+run settings, then one record per subject with its status (done, skipped, failed) and
+timings, and a summary at the end.
+
+If you use this code, please cite the following:
+
+    Yongcheng Yao, Junru Zhong, Liping Zhang, Sheheryar Khan, Weitian Chen.
+    "CartiMorph: a framework for automated knee articular cartilage morphometrics."
+    Medical Image Analysis
+
+Copyright 2023 Yongcheng Yao
+
+-----------------------------------------------------------------------------------
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+compliance with the License. You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is
+distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+implied. See the License for the specific language governing permissions and limitations under
+the License.
+-----------------------------------------------------------------------------------
+"""
+
+import os
+import json
+import time
+import socket
+import threading
+import collections
+
+
+def parse_shard(text):
+    """
+    Parses a shard "i/N" (0 <= i < N) into (i, N).
+    """
+    try:
+        index, count = (int(value) for value in text.split('/'))
+    except ValueError:
+        raise ValueError('Shard should be "i/N", but found "%s"' % text)
+    if not 0 <= index < count:
+        raise ValueError('Shard index should be in [0, %d), but found %d' % (count, index))
+    return index, count
+
+
+def shard_items(items, index, count):
+    """
+    The items of shard index (of count shards) of the sorted items.
+    """
+    return sorted(items)[index::count]
+
+
+def temporary_filename(filename):
+    """
+    The name (in the same folder and with the same extension) under which a file is written before it is renamed.
+    """
+    return os.path.join(os.path.dirname(filename), '.tmp_' + os.path.basename(filename))
+
+
+def save_atomic(save_fn, array, filename, *args):
+    """
+    Calls save_fn(array, temporary filename, *args) and renames the file when it is complete.
+    """
+    tmp_filename = temporary_filename(filename)
+    try:
+        save_fn(array, tmp_filename, *args)
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+def is_complete(filenames):
+    """
+    True if all the (atomically written) output files exist.
+    """
+    return all(os.path.isfile(filename) and os.path.getsize(filename) > 0 for filename in filenames)
+
+
+class RunManifest:
+    """
+    Appends the status and timings of the subjects of one run to a JSON-lines file.
+    """
+
+    def __init__(self, filename, run_info):
+        """
+        Parameters:
+            filename: The manifest file (records are appended).
+            run_info: Settings of the run (e.g. the command line arguments), written as the first record.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.counts = collections.Counter()
+        self.time_start = time.time()
+        self.file = open(filename, 'a')
+        self._write({'run': dict(run_info, host=socket.gethostname(), pid=os.getpid(),
+                                 start=time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.time_start)))})
+
+    def _write(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record) + '\n')
+            # a preempted run keeps the records written so far
+            self.file.flush()
+
+    def record(self, subject, status, **fields):
+        """
+        Records the status ('done', 'skipped' or 'failed') of a subject with other fields (e.g. timings in s).
+        """
+        with self.lock:
+            self.counts[status] += 1
+        self._write(dict(subject=subject, status=status, **fields))
+
+    def close(self):
+        """
+        Writes the summary of the run.
+        """
+        self._write({'summary': dict(self.counts), 'elapsed': time.time() - self.time_start})
+        self.file.close()
+        return dict(self.counts)
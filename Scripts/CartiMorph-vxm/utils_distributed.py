@@ -0,0 +1,162 @@
+"""
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+Data-parallel multi-worker training on CPU nodes.
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+The training scripts run under tf.distribute.MultiWorkerMirroredStrategy: every worker
+process holds a copy of the model, draws its part of the (global) batch from its own
+shard of the training files, and the gradients are all-reduced over gRPC (ring
+collectives, no GPUs or external services needed). The cluster is described by the
+TF_CONFIG environment variable of each worker, e.g. on two nodes:
+
+    TF_CONFIG='{"cluster": {"worker": ["node1:12345", "node2:12345"]}, "task": {"type": "worker", "index": 0}}'
+
+launch_local() starts N workers on the local machine with a generated TF_CONFIG.
+Worker 0 is the chief: only it writes checkpoints and other outputs.
+
+If you use this code, please cite the following:
+
+    Yongcheng Yao, Junru Zhong, Liping Zhang, Sheheryar Khan, Weitian Chen.
+    "CartiMorph: a framework for automated knee articular cartilage morphometrics."
+    Medical Image Analysis
+
+Copyright 2023 Yongcheng Yao
+
+-----------------------------------------------------------------------------------
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+compliance with the License. You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is
+distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+implied. See the License for the specific language governing permissions and limitations under
+the License.
+-----------------------------------------------------------------------------------
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import subprocess
+import numpy as np
+
+
+def worker_info():
+    """
+    Returns (task_index, nb_workers) of this process from TF_CONFIG, or (0, 1) without a cluster.
+    """
+    tf_config = json.loads(os.environ.get('TF_CONFIG') or '{}')
+    workers = tf_config.get('cluster', {}).get('worker', [])
+    if not workers:
+        return 0, 1
+    task = tf_config.get('task', {})
+    if task.get('type', 'worker') != 'worker':
+        raise ValueError('Only "worker" tasks are supported, but found "%s"' % task.get('type'))
+    return int(task.get('index', 0)), len(workers)
+
+
+def setup_strategy(nb_threads=None):
+    """
+    Creates the MultiWorkerMirroredStrategy of the cluster in TF_CONFIG (ring all-reduce over gRPC).
+    Must be called before any other TensorFlow operation. Returns (strategy, task_index, nb_workers).
+    """
+    import tensorflow as tf
+    if nb_threads:
+        tf.config.threading.set_intra_op_parallelism_threads(nb_threads)
+    options = tf.distribute.experimental.CommunicationOptions(
+        implementation=tf.distribute.experimental.CommunicationImplementation.RING)
+    strategy = tf.distribute.MultiWorkerMirroredStrategy(communication_options=options)
+    task_index, nb_workers = worker_info()
+    return strategy, task_index, nb_workers
+
+
+def shard(items, task_index, nb_workers):
+    """
+    The items of one worker (every nb_workers-th item).
+    """
+    items = list(items)[task_index::nb_workers]
+    if not items:
+        raise ValueError('Worker %d of %d has no training data.' % (task_index, nb_workers))
+    return items
+
+
+def dataset_creator(make_generator, global_batch_size, sample):
+    """
+    Wraps a generator factory into a DatasetCreator for model.fit().
+
+    make_generator(shard_index, nb_shards, batch_size) returns a generator of (inputs, outputs)
+    lists with batch_size samples drawn from one shard of the training data; each worker
+    builds the generator of its own shard with its part of the global batch. sample is one
+    (inputs, outputs) item of the generator, used for the output signature.
+    """
+    import tensorflow as tf
+
+    def signature(vols):
+        return tuple(tf.TensorSpec((None, *vol.shape[1:]), tf.float32) for vol in vols)
+
+    output_signature = tuple(signature(vols) for vols in sample)
+
+    def dataset_fn(input_context):
+        batch_size = input_context.get_per_replica_batch_size(global_batch_size)
+        gen = make_generator(input_context.input_pipeline_id, input_context.num_input_pipelines, batch_size)
+        dataset = tf.data.Dataset.from_generator(
+            lambda: (tuple(tuple(np.asarray(vol, dtype=np.float32) for vol in vols) for vols in item) for item in gen),
+            output_signature=output_signature)
+        # the generators are sharded already
+        options = tf.data.Options()
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+        return dataset.with_options(options).prefetch(tf.data.AUTOTUNE)
+
+    return tf.keras.utils.experimental.DatasetCreator(dataset_fn)
+
+
+def free_ports(nb_ports):
+    """
+    Free TCP ports on localhost.
+    """
+    sockets = [socket.socket(socket.AF_INET, socket.SOCK_STREAM) for _ in range(nb_ports)]
+    try:
+        for sock in sockets:
+            sock.bind(('localhost', 0))
+        return [sock.getsockname()[1] for sock in sockets]
+    finally:
+        for sock in sockets:
+            sock.close()
+
+
+def launch_local(nb_workers, argv, nb_threads=None):
+    """
+    Runs the command line argv (a Python script and its arguments) in nb_workers local
+    processes with the TF_CONFIG of a local cluster. If a worker fails, the others are stopped.
+    Returns the exit code of the failed worker, or 0.
+    """
+    workers = ['localhost:%d' % port for port in free_ports(nb_workers)]
+    processes = []
+    for index in range(nb_workers):
+        env = dict(os.environ)
+        env['TF_CONFIG'] = json.dumps({'cluster': {'worker': workers}, 'task': {'type': 'worker', 'index': index}})
+        if nb_threads:
+            env['OMP_NUM_THREADS'] = str(nb_threads)
+        processes.append(subprocess.Popen([sys.executable] + list(argv), env=env))
+
+    exit_code = 0
+    try:
+        while processes:
+            for process in list(processes):
+                code = process.poll()
+                if code is None:
+                    continue
+                processes.remove(process)
+                if code != 0 and exit_code == 0:
+                    exit_code = code
+                    for other in processes:
+                        other.terminate()
+            time.sleep(1)
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+        raise
+    return exit_code
@@ -0,0 +1,213 @@
+"""
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+Compact storage of dense displacement fields.
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+A compact field file (.npz) stores a displacement field as float16, as int16 quantized
+with a fixed step (default: max|field|/32767), or as float32, split into slabs along the
+first axis that are compressed separately (deflate). Within a slab, the channels are
+stored one after another and the bytes of each value are split into separate planes
+(byte shuffle); int16 values are also delta-coded along the last axis, which makes
+smooth fields compress several times better.
+
+Instead of the full-resolution warp, the stationary velocity field at the integration
+resolution of VxmDense (preint_flow) can be stored; it is integrated by scaling and
+squaring and rescaled to full resolution (as the VecInt and RescaleTransform layers)
+only when the field is decoded.
+
+The maximum absolute displacement error (in voxels) against the field given at save
+time is recorded in the file:
+    float16   <= max|field| * 2^-11
+    int16     <= step / 2, step = max(--step, max|field| / 32767)
+    svf       depends on the field; measured when the full-resolution warp is given
+
+If you use this code, please cite the following:
+
+    Yongcheng Yao, Junru Zhong, Liping Zhang, Sheheryar Khan, Weitian Chen.
+    "CartiMorph: a framework for automated knee articular cartilage morphometrics."
+    Medical Image Analysis
+
+Copyright 2023 Yongcheng Yao
+
+-----------------------------------------------------------------------------------
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+compliance with the License. You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is
+distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+implied. See the License for the specific language governing permissions and limitations under
+the License.
+-----------------------------------------------------------------------------------
+"""
+
+import os
+import json
+import zipfile
+import numpy as np
+from utils_warping import WarpSampler
+
+FIELD_EXT = '.npz'
+FIELD_DTYPES = ('float16', 'int16', 'float32')
+
+
+def is_compact(filename):
+    return filename.endswith(FIELD_EXT)
+
+
+def field_filename(filename):
+    """
+    The compact field filename of a NIfTI filename (e.g. sub1.nii.gz -> sub1.npz).
+    """
+    for ext in ('.nii.gz', '.nii'):
+        if filename.endswith(ext):
+            return filename[:-len(ext)] + FIELD_EXT
+    return filename if is_compact(filename) else filename + FIELD_EXT
+
+
+def _encode_slab(slab, meta):
+    """
+    Quantize a slab (float32, shape (n, ..., ndims)) and return its byte planes.
+    """
+    if meta['dtype'] == 'int16':
+        slab = np.rint(slab / np.float32(meta['scale'])).astype(np.int16)
+        slab = np.diff(slab, axis=-2, prepend=np.int16(0)).astype(np.int16)
+    else:
+        slab = slab.astype(meta['dtype'])
+    slab = np.ascontiguousarray(np.moveaxis(slab, -1, 0))
+    return np.ascontiguousarray(slab.view(np.uint8).reshape(-1, slab.itemsize).T)
+
+
+def _decode_slab(planes, meta, shape):
+    """
+    Inverse of _encode_slab. Returns the float32 slab of the given shape.
+    """
+    slab = np.ascontiguousarray(planes.T).view(meta['dtype']).reshape(shape[-1], *shape[:-1])
+    slab = np.moveaxis(slab, 0, -1)
+    if meta['dtype'] == 'int16':
+        # the int16 sum wraps around exactly as the int16 difference did
+        slab = np.cumsum(slab, axis=-2, dtype=np.int16).astype(np.float32)
+        slab *= np.float32(meta['scale'])
+    return slab.astype(np.float32, copy=False)
+
+
+def integrate_svf(svf, int_steps):
+    """
+    Scaling and squaring integration of a stationary velocity field (as the VecInt layer).
+    """
+    vec = np.asarray(svf, dtype=np.float32) / (2 ** int_steps)
+    for _ in range(int_steps):
+        vec = vec + WarpSampler(vec, interp_method='linear').warp(vec)
+    return vec
+
+
+def rescale_field(field, factor):
+    """
+    Resize a displacement field by a factor and scale its vectors (as the RescaleTransform layer).
+    """
+    if factor == 1:
+        return field
+    vol_shape = field.shape[:-1]
+    new_shape = [int(n * factor) for n in vol_shape]
+    # sampling grid of the neurite resize: linspace(0, n - 1, new_n) along each axis
+    lin = [np.linspace(0, n - 1, m, dtype=np.float32) for n, m in zip(vol_shape, new_shape)]
+    grid = np.meshgrid(*lin, indexing='ij')
+    shift = np.stack([grid[d] - np.arange(m, dtype=np.float32).reshape([-1 if i == d else 1 for i in range(len(new_shape))])
+                      for d, m in enumerate(new_shape)], axis=-1)
+    sampler = WarpSampler(shift, interp_method='linear', vol_shape=vol_shape)
+    return sampler.warp(field * np.float32(factor))
+
+
+def save_field(field, filename, affine=None, dtype='float16', kind='warp', int_steps=0, rescale_factor=1,
+               step=None, reference=None, slab_size=16, compresslevel=6):
+    """
+    Save a displacement field (or a stationary velocity field with kind='svf') in the compact format.
+    With dtype='int16', the field is quantized with the given step (in voxels, at least max|field|/32767).
+    Returns the maximum absolute displacement error (in voxels) against the reference field
+    (default: the given field; with kind='svf', the error is only measured if a reference is given).
+    """
+    if dtype not in FIELD_DTYPES:
+        raise ValueError('dtype should be one of %s, but found "%s"' % (FIELD_DTYPES, dtype))
+    if kind not in ('warp', 'svf'):
+        raise ValueError('kind should be "warp" or "svf", but found "%s"' % kind)
+    field = np.asarray(field, dtype=np.float32)
+    if field.ndim == field.shape[-1] + 2 and field.shape[0] == 1:
+        field = field[0]
+
+    scale = 1.0
+    if dtype == 'int16':
+        scale = max(float(np.abs(field).max()) / 32767, step or 0) or 1.0
+    meta = dict(kind=kind, dtype=dtype, shape=list(field.shape), scale=scale, int_steps=int(int_steps),
+                rescale_factor=float(rescale_factor), slab_size=int(slab_size),
+                affine=None if affine is None else np.asarray(affine, dtype=np.float64).tolist())
+
+    slabs = {'slab_%04d' % i: _encode_slab(field[start:start + slab_size], meta)
+             for i, start in enumerate(range(0, field.shape[0], slab_size))}
+
+    # measure the error of the stored field
+    if reference is None and kind == 'warp':
+        reference = field
+    if reference is not None:
+        decoded = CompactField(meta, slabs).decode()
+        meta['max_error'] = float(np.abs(decoded - np.asarray(reference, dtype=np.float32).reshape(decoded.shape)).max())
+
+    # write slabs as separate members of the .npz file (to a temporary file first)
+    path_tmp = filename + '.tmp'
+    with zipfile.ZipFile(path_tmp, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as zf:
+        with zf.open('meta.npy', 'w') as f:
+            np.lib.format.write_array(f, np.array(json.dumps(meta)))
+        for name, planes in slabs.items():
+            with zf.open(name + '.npy', 'w', force_zip64=True) as f:
+                np.lib.format.write_array(f, planes)
+    os.replace(path_tmp, filename)
+    return meta.get('max_error')
+
+
+class CompactField:
+    """
+    A compact field file; the slabs are decompressed (and the field integrated) on decode().
+    """
+
+    def __init__(self, meta, slabs):
+        self.meta = meta
+        self.slabs = slabs
+        self.affine = None if meta['affine'] is None else np.array(meta['affine'])
+        self.field = None
+
+    def decode(self):
+        """
+        Returns the full-resolution displacement field (float32, shape (*vol_shape, ndims)).
+        """
+        if self.field is None:
+            shape, slab_size = self.meta['shape'], self.meta['slab_size']
+            field = np.empty(shape, dtype=np.float32)
+            for i, start in enumerate(range(0, shape[0], slab_size)):
+                stop = min(start + slab_size, shape[0])
+                field[start:stop] = _decode_slab(self.slabs['slab_%04d' % i], self.meta, [stop - start] + shape[1:])
+            if self.meta['kind'] == 'svf':
+                if self.meta['int_steps'] > 0:
+                    field = integrate_svf(field, self.meta['int_steps'])
+                field = rescale_field(field, self.meta['rescale_factor'])
+            self.field = field
+        return self.field
+
+
+def load_field(filename):
+    """
+    Open a compact field file (nothing is decompressed until decode()).
+    """
+    slabs = np.load(filename, allow_pickle=False)
+    return CompactField(json.loads(str(slabs['meta'])), slabs)
+
+
+def load_warp(filename):
+    """
+    Load a displacement field from a compact field file or a NIfTI file. Returns (field, affine).
+    """
+    if is_compact(filename):
+        field = load_field(filename)
+        return field.decode(), field.affine
+    import nibabel as nib
+    img = nib.load(filename)
+    return np.asanyarray(img.dataobj).squeeze(), img.affine
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+Build the template segmentation by streaming majority voting.
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+The warped labels are folded into per-voxel, per-class vote counts (uint8, promoted
+to uint16/uint32 only when a count could overflow) as they are produced, so neither
+memory nor disk grows with the number of subjects. The majority vote (ties go to the
+lower label) and the per-class frequency maps follow "constructTempSeg.m".
+
+Usage (on warped labels saved by "inference_img2temp_warpLabel.py"):
+    python utils_labelFusion.py --dir_warpedLabel /path/to/warped/labels \
+        --file_template template.nii.gz --file_TempSeg templateSeg.nii.gz
+
+If you use this code, please cite the following:
+
+    Yongcheng Yao, Junru Zhong, Liping Zhang, Sheheryar Khan, Weitian Chen.
+    "CartiMorph: a framework for automated knee articular cartilage morphometrics."
+    Medical Image Analysis
+
+Copyright 2023 Yongcheng Yao
+
+-----------------------------------------------------------------------------------
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+compliance with the License. You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is
+distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+implied. See the License for the specific language governing permissions and limitations under
+the License.
+-----------------------------------------------------------------------------------
+"""
+
+import os
+import glob
+import argparse
+import numpy as np
+
+
+class LabelFusion:
+    """
+    Per-voxel vote counts of labels 0 .. nb_labels-1.
+    """
+
+    def __init__(self, nb_labels=6):
+        self.nb_labels = nb_labels
+        self.counts = None
+        self.nb_votes = 0
+
+    def add(self, label):
+        """
+        Adds the votes of one label volume (values outside 0 .. nb_labels-1 are ignored).
+        """
+        label = np.asarray(label).squeeze()
+        if not np.issubdtype(label.dtype, np.integer):
+            label = np.rint(label)
+        if self.counts is None:
+            self.counts = np.zeros((self.nb_labels, *label.shape), dtype=np.uint8)
+        elif label.shape != self.counts.shape[1:]:
+            raise ValueError(f'Shape mismatch: label has shape {label.shape}, expected {self.counts.shape[1:]}')
+        if self.nb_votes == np.iinfo(self.counts.dtype).max:
+            self.counts = self.counts.astype(np.uint16 if self.counts.dtype == np.uint8 else np.uint32)
+        for k in range(self.nb_labels):
+            self.counts[k] += label == k
+        self.nb_votes += 1
+
+    def segmentation(self):
+        """
+        Majority vote (uint8); ties go to the lower label.
+        """
+        return np.argmax(self.counts, axis=0).astype(np.uint8)
+
+    def frequency(self):
+        """
+        Per-class frequency maps (float32, classes on the last axis).
+        """
+        return np.moveaxis(self.counts, 0, -1) / np.float32(self.nb_votes)
+
+
+if __name__ == '__main__':
+    import nibabel as nib
+    from utils_streamIO import VolumeReader
+
+    # parse commandline args
+    parser = argparse.ArgumentParser(description='Construct the template segmentation from the warped segmentation labels')
+    parser.add_argument('--dir_warpedLabel', required=True, help='folder of the segmentation labels warped to the template image space')
+    parser.add_argument('--file_template', required=True, help='template image (its header is copied)')
+    parser.add_argument('--file_TempSeg', required=True, help='output template segmentation')
+    parser.add_argument('--file_freqMap', help='(optional) output per-class frequency maps')
+    parser.add_argument('--nb_labels', type=int, default=6, help='number of labels including background (default: 6)')
+    parser.add_argument('--io_threads', type=int, default=4, help='number of threads reading .nii.gz files (default: 4)')
+    args = parser.parse_args()
+
+    list_warpedLabel = sorted(glob.glob(os.path.join(args.dir_warpedLabel, "*.nii.gz")) + glob.glob(os.path.join(args.dir_warpedLabel, "*.nii")))
+    if not list_warpedLabel:
+        raise ValueError(f"Could not find any warped label in '{args.dir_warpedLabel}'")
+
+    fusion = LabelFusion(nb_labels=args.nb_labels)
+    reader = VolumeReader(lambda file: np.asanyarray(nib.load(file).dataobj), nb_threads=args.io_threads, prefetch=2 * args.io_threads)
+    for _, warpedLabel in reader.iterate(list_warpedLabel):
+        fusion.add(warpedLabel)
+
+    # save the template segmentation (and the frequency maps) with the template header
+    template = nib.load(args.file_template)
+    header = template.header.copy()
+    header.set_data_dtype(np.uint8)
+    header['descrip'] = b'segmentation mask for the learned template'
+    nib.save(nib.Nifti1Image(fusion.segmentation(), template.affine, header), args.file_TempSeg)
+    if args.file_freqMap:
+        nib.save(nib.Nifti1Image(fusion.frequency(), template.affine), args.file_freqMap)
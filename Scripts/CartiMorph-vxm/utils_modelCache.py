@@ -0,0 +1,118 @@
+"""
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+Keep registration models and Transform graphs in memory between predictions.
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+Building the Keras graph and reading the .h5 file dominate the run time when the
+template learning model is applied to a cohort image by image. The caches below
+build each model once per input shape and reuse it for every later batch.
+
+Model inference is implemented in
+CartiMorph-vxm (https://github.com/YongchengYAO/CartiMorph-vxm), a work based on
+VoxelMorph (https://github.com/voxelmorph/voxelmorph)
+
+If you use this code, please cite the following:
+
+    Yongcheng Yao, Junru Zhong, Liping Zhang, Sheheryar Khan, Weitian Chen.
+    "CartiMorph: a framework for automated knee articular cartilage morphometrics."
+    Medical Image Analysis
+
+Copyright 2023 Yongcheng Yao
+
+-----------------------------------------------------------------------------------
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+compliance with the License. You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is
+distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+implied. See the License for the specific language governing permissions and limitations under
+the License.
+-----------------------------------------------------------------------------------
+"""
+
+import numpy as np
+import CartiMorph_vxm as vxm
+
+
+class RegistrationModelCache:
+    """
+    Template learning models (one per input shape) reconfigured to predict a single warping field.
+    """
+
+    def __init__(self, file_model, direction='tmp2img', backend='keras', nb_threads=None):
+        """
+        Parameters:
+            file_model: The template learning model (.h5), or the export folder of "utils_modelExport.py".
+            direction: 'tmp2img' (template-to-image) or 'img2tmp' (image-to-template).
+            backend: 'keras' (the .h5 model), or an exported artifact, e.g. 'savedmodel' or 'tflite_float16'.
+            nb_threads: Number of CPU threads of an exported artifact. Default is the runtime default.
+        """
+        if direction not in ('tmp2img', 'img2tmp'):
+            raise ValueError('direction should be "tmp2img" or "img2tmp", but found "%s"' % direction)
+        self.file_model = file_model
+        self.direction = direction
+        self.backend = backend
+        self.nb_threads = nb_threads
+        self.models = {}
+
+    def get(self, inshape):
+        """
+        Returns the registration model for the input shape, building it on first use.
+        """
+        inshape = tuple(inshape)
+        if inshape not in self.models and self.backend != 'keras':
+            from utils_modelExport import ExportedModel
+            model = ExportedModel(self.file_model, backend=self.backend, nb_threads=self.nb_threads)
+            if model.info.get('direction') != self.direction:
+                raise ValueError(f"The model in '{self.file_model}' was exported for the "
+                                 f"'{model.info.get('direction')}' direction, expected '{self.direction}'")
+            if model.inshape != inshape:
+                raise ValueError(f"The model in '{self.file_model}' was exported for inputs of shape "
+                                 f"{model.inshape}, but found {inshape}")
+            self.models[inshape] = model
+        if inshape not in self.models:
+            model = vxm.networks.TemplateCreation.load(self.file_model, inshape=inshape)
+            if self.direction == 'tmp2img':
+                self.models[inshape] = model.get_registration_model_tmp2img()
+            else:
+                self.models[inshape] = model.get_registration_model_img2tmp()
+        return self.models[inshape]
+
+    def predict(self, imgs):
+        """
+        Predicts the warping fields for a batch of images of the same shape.
+        """
+        return self.get(imgs.shape[1:-1]).predict(imgs, batch_size=imgs.shape[0])
+
+
+class TransformCache:
+    """
+    Transform models (one per volume shape and number of features) for a fixed interpolation method.
+    """
+
+    def __init__(self, interp_method='nearest'):
+        self.interp_method = interp_method
+        self.models = {}
+
+    def get(self, inshape, nb_feats):
+        """
+        Returns the Transform model for the volume shape, building it on first use.
+        """
+        key = (tuple(inshape), nb_feats)
+        if key not in self.models:
+            self.models[key] = vxm.networks.Transform(key[0],
+                                                      interp_method=self.interp_method,
+                                                      nb_feats=nb_feats)
+        return self.models[key]
+
+    def predict(self, vols, warpingFields):
+        """
+        Warps a batch of volumes. A single volume (batch size 1) is warped by every field in the batch.
+        """
+        nb_fields = warpingFields.shape[0]
+        if vols.shape[0] == 1 and nb_fields > 1:
+            vols = np.repeat(vols, nb_fields, axis=0)
+        model = self.get(vols.shape[1:-1], vols.shape[-1])
+        return model.predict([vols, warpingFields], batch_size=nb_fields)
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+
+"""
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+Export the registration models as frozen inference artifacts.
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+A trained model (.h5) is reconfigured to predict the warping field only (as the
+inference scripts do) and exported for a fixed input shape to a folder with one or
+more of the following artifacts (backends):
+    savedmodel       TF SavedModel, compiled with XLA (jit_compile)
+    tflite_float16   TF Lite model with float16 weights
+    tflite_int8      TF Lite model with int8 weights (dynamic range quantization)
+    onnx             ONNX model (requires tf2onnx; run with onnxruntime)
+    onnx_int8        ONNX model with int8 weights (requires onnxruntime.quantization)
+The artifacts are listed in export.json together with an accuracy check against the
+original model: the RMSE and the maximum error of the warping field (in voxels), the
+Dice scores of a label volume warped with either field, and the prediction times.
+The inference scripts run an artifact with "--backend <name>" and the export folder
+in place of the .h5 file.
+
+Usage:
+    python utils_modelExport.py --file_model bestModel.h5 --dir_export bestModel_export \
+        --direction tmp2img --check_img image.nii.gz --check_seg templateSeg.nii.gz
+
+If you use this code, please cite the following:
+
+    Yongcheng Yao, Junru Zhong, Liping Zhang, Sheheryar Khan, Weitian Chen.
+    "CartiMorph: a framework for automated knee articular cartilage morphometrics."
+    Medical Image Analysis
+
+Copyright 2023 Yongcheng Yao
+
+-----------------------------------------------------------------------------------
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+compliance with the License. You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is
+distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+implied. See the License for the specific language governing permissions and limitations under
+the License.
+-----------------------------------------------------------------------------------
+"""
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+
+FILE_EXPORT_INFO = 'export.json'
+BACKENDS = {
+    'savedmodel': 'saved_model',
+    'tflite_float16': 'model_float16.tflite',
+    'tflite_int8': 'model_int8.tflite',
+    'onnx': 'model.onnx',
+    'onnx_int8': 'model_int8.onnx',
+}
+
+
+def _import_tf(nb_threads=None):
+    """
+    Imports TensorFlow with the oneDNN optimizations enabled (and nb_threads intra-op threads,
+    which can only be set before TensorFlow is initialized).
+    """
+    os.environ.setdefault('TF_ENABLE_ONEDNN_OPTS', '1')
+    import tensorflow as tf
+    if nb_threads and tf.config.threading.get_intra_op_parallelism_threads() != nb_threads:
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(nb_threads)
+        except RuntimeError:
+            print('Warning: TensorFlow was initialized already, the number of threads (%d) is not applied' % nb_threads)
+    return tf
+
+
+def export_model(model, dir_export, backends=('savedmodel',), info=None):
+    """
+    Exports a Keras model with fixed input shapes to the given backends.
+
+    Parameters:
+        model: Keras model predicting the warping field (any batch size).
+        dir_export: Output folder.
+        backends: Names of the artifacts to write (keys of BACKENDS). Default is ('savedmodel',).
+        info: Additional entries of export.json (e.g. the source model).
+    Returns the content of export.json.
+    """
+    tf = _import_tf()
+    for backend in backends:
+        if backend not in BACKENDS:
+            raise ValueError('backend should be one of %s, but found "%s"' % (tuple(BACKENDS), backend))
+    # onnx_int8 is quantized from the onnx artifact
+    backends = [backend for backend in BACKENDS if backend in backends]
+    os.makedirs(dir_export, exist_ok=True)
+
+    input_specs = [tf.TensorSpec([None, *inp.shape[1:]], tf.float32, name='input_%d' % i)
+                   for i, inp in enumerate(model.inputs)]
+
+    def predict(*inputs):
+        return {'field': model(list(inputs) if len(inputs) > 1 else inputs[0], training=False)}
+
+    # a single-sample function for the converters (TF Lite and ONNX need static shapes)
+    single_specs = [tf.TensorSpec([1, *spec.shape[1:]], tf.float32, name=spec.name) for spec in input_specs]
+    concrete = tf.function(predict).get_concrete_function(*single_specs)
+
+    artifacts = {}
+    for backend in backends:
+        path = os.path.join(dir_export, BACKENDS[backend])
+        if backend == 'savedmodel':
+            module = tf.Module()
+            module.predict = tf.function(predict, input_signature=input_specs, jit_compile=True)
+            tf.saved_model.save(module, path, signatures={'serving_default': module.predict})
+        elif backend.startswith('tflite'):
+            converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete], model)
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            if backend == 'tflite_float16':
+                converter.target_spec.supported_types = [tf.float16]
+            # the gather ops of the spatial transformer may fall back to TF ops
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+            with open(path, 'wb') as f:
+                f.write(converter.convert())
+        elif backend == 'onnx':
+            import tf2onnx
+            tf2onnx.convert.from_function(tf.function(predict), input_signature=single_specs, opset=15, output_path=path)
+        elif backend == 'onnx_int8':
+            from onnxruntime.quantization import quantize_dynamic, QuantType
+            path_fp32 = os.path.join(dir_export, BACKENDS['onnx'])
+            if not os.path.isfile(path_fp32):
+                raise ValueError('"onnx_int8" requires the "onnx" artifact, export it first (or in the same run)')
+            quantize_dynamic(path_fp32, path, weight_type=QuantType.QInt8)
+        artifacts[backend] = BACKENDS[backend]
+        print('Exported %s to %s.' % (backend, path))
+
+    export_info = read_export_info(dir_export) if os.path.isfile(os.path.join(dir_export, FILE_EXPORT_INFO)) else {}
+    export_info.update(info or {})
+    export_info['inputs'] = [[int(n) for n in spec.shape[1:]] for spec in input_specs]
+    export_info.setdefault('artifacts', {}).update(artifacts)
+    write_export_info(dir_export, export_info)
+    return export_info
+
+
+def read_export_info(dir_export):
+    with open(os.path.join(dir_export, FILE_EXPORT_INFO), 'r') as f:
+        return json.load(f)
+
+
+def write_export_info(dir_export, export_info):
+    path = os.path.join(dir_export, FILE_EXPORT_INFO)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(export_info, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+class ExportedModel:
+    """
+    An exported artifact with the predict() interface of the Keras registration model.
+    """
+
+    def __init__(self, dir_export, backend='savedmodel', nb_threads=None):
+        """
+        Parameters:
+            dir_export: Export folder written by export_model().
+            backend: Name of the artifact (a key of BACKENDS). Default is 'savedmodel'.
+            nb_threads: Number of CPU threads of the runtime. Default is the runtime default.
+        """
+        export_info = read_export_info(dir_export)
+        if backend not in export_info['artifacts']:
+            raise ValueError(f"The export folder '{dir_export}' has no '{backend}' artifact "
+                             f"(found: {', '.join(export_info['artifacts'])})")
+        self.backend = backend
+        self.info = export_info
+        self.inputs = [tuple(shape) for shape in export_info['inputs']]
+        path = os.path.join(dir_export, export_info['artifacts'][backend])
+
+        if backend == 'savedmodel':
+            tf = _import_tf(nb_threads)
+            self.tf = tf
+            self.model = tf.saved_model.load(path)
+            self.fn = self.model.signatures['serving_default']
+        elif backend.startswith('tflite'):
+            tf = _import_tf(nb_threads)
+            self.interpreter = tf.lite.Interpreter(model_path=path, num_threads=nb_threads)
+            self.interpreter.allocate_tensors()
+            input_details = self.interpreter.get_input_details()
+            # the converter may reorder the inputs; they are matched by name
+            self.input_index = [next(d['index'] for d in input_details if 'input_%d' % i in d['name'])
+                                for i in range(len(self.inputs))]
+            self.output_index = self.interpreter.get_output_details()[0]['index']
+        else:
+            import onnxruntime as ort
+            options = ort.SessionOptions()
+            if nb_threads:
+                options.intra_op_num_threads = nb_threads
+            self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+            self.input_names = [inp.name for inp in self.session.get_inputs()]
+
+    @property
+    def inshape(self):
+        """
+        Spatial shape of the (first) input.
+        """
+        return self.inputs[0][:-1]
+
+    def _predict_one(self, inputs):
+        if self.backend == 'savedmodel':
+            feeds = {'input_%d' % i: self.tf.constant(inp) for i, inp in enumerate(inputs)}
+            return self.fn(**feeds)['field'].numpy()
+        if self.backend.startswith('tflite'):
+            for index, inp in zip(self.input_index, inputs):
+                self.interpreter.set_tensor(index, inp)
+            self.interpreter.invoke()
+            return self.interpreter.get_tensor(self.output_index)
+        return self.session.run(None, dict(zip(self.input_names, inputs)))[0]
+
+    def predict(self, inputs, batch_size=None):
+        """
+        Predicts the warping fields of a batch of inputs (an array, or a list of arrays for
+        models with several inputs). batch_size is accepted for compatibility with Keras.
+        """
+        if not isinstance(inputs, (list, tuple)):
+            inputs = [inputs]
+        inputs = [np.asarray(inp, dtype=np.float32) for inp in inputs]
+        if len(inputs) != len(self.inputs):
+            raise ValueError('The exported model has %d input(s), but found %d' % (len(self.inputs), len(inputs)))
+        for inp, shape in zip(inputs, self.inputs):
+            if inp.shape[1:] != shape:
+                raise ValueError(f'Input of shape {inp.shape[1:]} does not match the exported shape {shape}')
+        if self.backend == 'savedmodel':
+            return self._predict_one(inputs)
+        # the converted models have a batch size of 1
+        return np.concatenate([self._predict_one([inp[i:i + 1] for inp in inputs]) for i in range(inputs[0].shape[0])])
+
+
+def dice(label1, label2, labels):
+    """
+    Dice score of each label.
+    """
+    scores = []
+    for k in labels:
+        mask1, mask2 = label1 == k, label2 == k
+        total = np.count_nonzero(mask1) + np.count_nonzero(mask2)
+        scores.append(2 * np.count_nonzero(mask1 & mask2) / total if total else 1.0)
+    return scores
+
+
+def timed_predict(model, inputs, repeats=3):
+    """
+    Returns the prediction and the median prediction time (seconds), after one warm-up run.
+    """
+    output = model.predict(inputs)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        model.predict(inputs)
+        times.append(time.perf_counter() - start)
+    return output, float(np.median(times))
+
+
+def check_export(model, exported, inputs, label=None, repeats=3):
+    """
+    Compares an exported artifact with the original Keras model on the given inputs.
+
+    The label volume (in the space of the moving image) is warped with both fields (nearest
+    interpolation) and compared by the Dice score of each foreground label.
+    """
+    from utils_warping import WarpSampler
+    field, time_keras = timed_predict(model, inputs, repeats)
+    field_exported, time_exported = timed_predict(exported, inputs, repeats)
+    error = field_exported.astype(np.float32) - field
+    report = dict(field_rmse=float(np.sqrt(np.mean(error ** 2))), field_max_error=float(np.abs(error).max()),
+                  time_keras=time_keras, time_exported=time_exported, speedup=time_keras / time_exported)
+    if label is not None:
+        label = np.asarray(label).squeeze()
+        labels = [int(k) for k in np.unique(label) if k != 0]
+        scores = []
+        for i in range(field.shape[0]):
+            warped = WarpSampler(field[i], interp_method='nearest').warp(label)
+            warped_exported = WarpSampler(field_exported[i], interp_method='nearest').warp(label)
+            scores.append(dice(warped, warped_exported, labels))
+        report['dice'] = dict(zip(map(str, labels), np.mean(scores, axis=0).tolist()))
+    return report
+
+
+if __name__ == '__main__':
+    import nibabel as nib
+
+    # parse commandline args
+    parser = argparse.ArgumentParser(description='Export a registration model as frozen inference artifacts')
+    parser.add_argument('--file_model', required=True, help='the trained model (.h5)')
+    parser.add_argument('--dir_export', required=True, help='output folder of the artifacts')
+    parser.add_argument('--model_type', default='template', choices=('template', 'vxmdense'),
+                        help='template learning model (CartiMorph_vxm) or image-to-image registration model (voxelmorph) (default: template)')
+    parser.add_argument('--direction', default='tmp2img', choices=('tmp2img', 'img2tmp'),
+                        help='registration direction of the template learning model (default: tmp2img)')
+    parser.add_argument('--inshape', type=int, nargs='+', help='input shape (default: the shape of --check_img)')
+    parser.add_argument('--backends', nargs='+', default=['savedmodel', 'tflite_float16'], choices=tuple(BACKENDS),
+                        help='artifacts to export (default: savedmodel tflite_float16)')
+    parser.add_argument('--check_img', nargs='+',
+                        help='image(s) for the accuracy check: the target image, or the moving and fixed images of vxmdense models')
+    parser.add_argument('--check_seg', help='label volume in the moving image space, warped for the Dice check')
+    parser.add_argument('--threads', type=int, help='number of CPU threads of the exported runtime in the check')
+    args = parser.parse_args()
+
+    if args.inshape is None and not args.check_img:
+        raise ValueError('Either "--inshape" or "--check_img" is required.')
+    nb_inputs = 2 if args.model_type == 'vxmdense' else 1
+    if args.check_img and len(args.check_img) != nb_inputs:
+        raise ValueError('"--check_img" expects %d image(s) for a %s model' % (nb_inputs, args.model_type))
+
+    check_inputs = None
+    if args.check_img:
+        check_inputs = [np.asanyarray(nib.load(file).dataobj, dtype=np.float32)[np.newaxis, ..., np.newaxis]
+                        for file in args.check_img]
+    inshape = tuple(args.inshape) if args.inshape else check_inputs[0].shape[1:-1]
+
+    # the number of threads of the savedmodel check is set before the model is built
+    tf = _import_tf(args.threads)
+    if args.model_type == 'template':
+        from utils_modelCache import RegistrationModelCache
+        model = RegistrationModelCache(args.file_model, direction=args.direction).get(inshape)
+    else:
+        import voxelmorph as vxm
+        model = vxm.networks.VxmDense.load(args.file_model, inshape=inshape, input_model=None).get_registration_model()
+
+    info = dict(file_model=os.path.abspath(args.file_model), model_type=args.model_type,
+                direction=args.direction if args.model_type == 'template' else None)
+    export_info = export_model(model, args.dir_export, backends=args.backends, info=info)
+
+    # accuracy check against the original model
+    if check_inputs is not None:
+        label = np.asanyarray(nib.load(args.check_seg).dataobj) if args.check_seg else None
+        keras_inputs = check_inputs if nb_inputs > 1 else check_inputs[0]
+        checks = export_info.setdefault('checks', {})
+        for backend in args.backends:
+            exported = ExportedModel(args.dir_export, backend=backend, nb_threads=args.threads)
+            checks[backend] = check_export(model, exported, keras_inputs, label=label)
+            print('%s: %s' % (backend, json.dumps(checks[backend])))
+        write_export_info(args.dir_export, export_info)
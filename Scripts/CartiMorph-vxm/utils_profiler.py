@@ -0,0 +1,190 @@
+"""
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+Step-level profiling of model training.
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+The TrainingProfiler callback writes one record per training step to a JSON-lines
+(.jsonl) or CSV (.csv) file:
+    epoch, step          epoch and global step number
+    step_time            wall time since the end of the previous step (s)
+    compute_time         time between the begin and end of the step, i.e. the forward
+                         and backward passes and the weight update (s)
+    data_wait            step_time - compute_time: time spent waiting for the next batch
+                         (and in other callbacks) (s)
+    generator_time       time spent in the training generator for the batches produced
+                         since the previous step (s); the generator may run in a
+                         background thread of Keras, overlapping with compute
+    samples_per_sec      batch size / step_time
+    rss_mb, peak_rss_mb  current and peak resident memory of the process (MB)
+A data_wait close to step_time points to an I/O-bound run (e.g. .nii.gz decoding, see
+--cache-dir); a data_wait close to 0 to a compute-bound run. Optionally, the TF profiler
+traces a window of steps for TensorBoard.
+
+If you use this code, please cite the following:
+
+    Yongcheng Yao, Junru Zhong, Liping Zhang, Sheheryar Khan, Weitian Chen.
+    "CartiMorph: a framework for automated knee articular cartilage morphometrics."
+    Medical Image Analysis
+
+Copyright 2023 Yongcheng Yao
+
+-----------------------------------------------------------------------------------
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+compliance with the License. You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is
+distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+implied. See the License for the specific language governing permissions and limitations under
+the License.
+-----------------------------------------------------------------------------------
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import resource
+import threading
+import numpy as np
+import tensorflow as tf
+
+FIELDS = ('epoch', 'step', 'step_time', 'compute_time', 'data_wait', 'generator_time',
+          'samples_per_sec', 'rss_mb', 'peak_rss_mb')
+
+
+def memory_usage():
+    """
+    Returns the current and the peak resident memory of the process in MB (current is None if unknown).
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, in kilobytes on Linux
+    peak = peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+    current = None
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            current = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        pass
+    return current, peak
+
+
+class TimedGenerator:
+    """
+    Wraps a generator and reports the time of every next() call to the profiler.
+    """
+
+    def __init__(self, generator, profiler):
+        self.generator = generator
+        self.profiler = profiler
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        item = next(self.generator)
+        self.profiler.add_generator_time(time.perf_counter() - start)
+        return item
+
+
+class TrainingProfiler(tf.keras.callbacks.Callback):
+    """
+    Callback logging the time, throughput and memory of every training step.
+    """
+
+    def __init__(self, file_log, batch_size, profile_steps=None, profile_dir=None):
+        """
+        Parameters:
+            file_log: Log file, JSON lines (.jsonl) or CSV (.csv). Records are appended.
+            batch_size: Number of samples per step.
+            profile_steps: Optional (start, stop) global steps traced by the TF profiler.
+            profile_dir: Log folder of the TF profiler (required with profile_steps).
+        """
+        super().__init__()
+        if profile_steps is not None and profile_dir is None:
+            raise ValueError('A log folder of the TF profiler is required with profile_steps.')
+        self.file_log = file_log
+        self.batch_size = batch_size
+        self.profile_steps = profile_steps
+        self.profile_dir = profile_dir
+        self.is_csv = file_log.endswith('.csv')
+        self.step = 0
+        self.epoch = 0
+        self.tracing = False
+        self.time_batch_begin = None
+        self.time_batch_end = None
+        self.generator_time = 0.0
+        self.lock = threading.Lock()
+        self.records = []
+
+        log_dir = os.path.dirname(os.path.abspath(file_log))
+        os.makedirs(log_dir, exist_ok=True)
+        write_header = self.is_csv and (not os.path.isfile(file_log) or os.path.getsize(file_log) == 0)
+        self.file = open(file_log, 'a', newline='' if self.is_csv else None)
+        if self.is_csv:
+            self.writer = csv.DictWriter(self.file, fieldnames=FIELDS)
+            if write_header:
+                self.writer.writeheader()
+
+    def wrap(self, generator):
+        """
+        Returns the generator timed by this profiler.
+        """
+        return TimedGenerator(generator, self)
+
+    def add_generator_time(self, seconds):
+        with self.lock:
+            self.generator_time += seconds
+
+    def on_train_begin(self, logs=None):
+        # the time between two fit() calls is not a training step
+        self.time_batch_end = time.perf_counter()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.profile_steps is not None and self.step == self.profile_steps[0] and not self.tracing:
+            tf.profiler.experimental.start(self.profile_dir)
+            self.tracing = True
+        self.time_batch_begin = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        now = time.perf_counter()
+        if self.tracing and self.step + 1 >= self.profile_steps[1]:
+            tf.profiler.experimental.stop()
+            self.tracing = False
+        with self.lock:
+            generator_time, self.generator_time = self.generator_time, 0.0
+        step_time = now - self.time_batch_end
+        compute_time = now - self.time_batch_begin
+        rss, peak_rss = memory_usage()
+        record = dict(epoch=self.epoch, step=self.step, step_time=step_time, compute_time=compute_time,
+                      data_wait=max(step_time - compute_time, 0.0), generator_time=generator_time,
+                      samples_per_sec=self.batch_size / step_time if step_time > 0 else None,
+                      rss_mb=rss, peak_rss_mb=peak_rss)
+        if self.is_csv:
+            self.writer.writerow(record)
+        else:
+            self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        self.records.append((step_time, compute_time, record['data_wait'], generator_time))
+        self.step += 1
+        self.time_batch_end = now
+
+    def on_train_end(self, logs=None):
+        if self.tracing:
+            tf.profiler.experimental.stop()
+            self.tracing = False
+        if self.records:
+            step_time, compute_time, data_wait, generator_time = np.median(self.records, axis=0)
+            print('Profile of %d steps (median): step %.3fs, compute %.3fs, data wait %.3fs, generator %.3fs, %.2f samples/s, peak RSS %.0f MB'
+                  % (len(self.records), step_time, compute_time, data_wait, generator_time,
+                     self.batch_size / step_time if step_time > 0 else float('nan'), memory_usage()[1]))
+            self.records = []
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,142 @@
+"""
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+Streaming volume I/O for the inference scripts.
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+Decompressing and compressing .nii.gz files takes as long as the prediction itself
+on a CPU node. VolumeReader decodes the next volumes in a thread pool while the
+model predicts, and VolumeWriter compresses and writes the outputs in background
+threads fed by a bounded queue. Both take the load/save function as an argument,
+so they work with CartiMorph_vxm and voxelmorph alike.
+
+Copyright 2023 Yongcheng Yao
+
+-----------------------------------------------------------------------------------
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+compliance with the License. You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is
+distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+implied. See the License for the specific language governing permissions and limitations under
+the License.
+-----------------------------------------------------------------------------------
+"""
+
+import queue
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+# marks the end of the input items
+_END = object()
+
+
+class VolumeReader:
+    """
+    Loads volumes in a thread pool, keeping up to `prefetch` volumes ahead of the consumer.
+    """
+
+    def __init__(self, load_fn, nb_threads=2, prefetch=4):
+        """
+        Parameters:
+            load_fn: Function called with one item (e.g. a filename) that returns the loaded volume.
+            nb_threads: Number of decoding threads. Default is 2.
+            prefetch: Maximum number of volumes loaded ahead of the consumer. Default is 4.
+        """
+        self.load_fn = load_fn
+        self.nb_threads = max(1, nb_threads)
+        self.prefetch = max(1, prefetch)
+
+    def iterate(self, items):
+        """
+        Yields (item, volume) pairs in the order of the input items.
+        """
+        items = iter(items)
+        with ThreadPoolExecutor(max_workers=self.nb_threads) as pool:
+            futures = collections.deque()
+            for item in items:
+                futures.append((item, pool.submit(self.load_fn, item)))
+                if len(futures) >= self.prefetch:
+                    break
+            while futures:
+                item, future = futures.popleft()
+                volume = future.result()
+                # keep the prefetch window full
+                next_item = next(items, _END)
+                if next_item is not _END:
+                    futures.append((next_item, pool.submit(self.load_fn, next_item)))
+                yield item, volume
+
+    def load_all(self, items):
+        """
+        Loads all items concurrently and returns the volumes in the order of the input items.
+        """
+        return [volume for _, volume in self.iterate(items)]
+
+
+class VolumeWriter:
+    """
+    Saves volumes in background threads. put() blocks when `queue_size` writes are pending.
+    """
+
+    def __init__(self, save_fn, nb_threads=1, queue_size=4):
+        """
+        Parameters:
+            save_fn: Function called with the arguments given to put(), e.g. (array, filename, affine).
+            nb_threads: Number of writing threads. Default is 1.
+            queue_size: Maximum number of pending writes. Default is 4.
+        """
+        self.save_fn = save_fn
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.error = None
+        self.threads = [threading.Thread(target=self._work, daemon=True) for _ in range(max(1, nb_threads))]
+        for thread in self.threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            args = self.queue.get()
+            try:
+                if args is None:
+                    return
+                if self.error is None:
+                    self.save_fn(*args)
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def put(self, *args):
+        """
+        Queues one write. Raises the error of a failed earlier write, if any.
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put(args)
+
+    def flush(self):
+        """
+        Waits for the pending writes to finish. Raises the error of a failed write, if any.
+        """
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """
+        Waits for the pending writes to finish and stops the threads.
+        """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
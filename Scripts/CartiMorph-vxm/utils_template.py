@@ -0,0 +1,105 @@
+"""
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+Build the initial template of template learning by streaming averaging.
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+The training scans are decoded in a thread pool and folded into preallocated float32
+mean and variance buffers (Welford's algorithm), so memory does not grow with the
+number of scans. The result is cached in the model folder together with the hash of
+the file list; restarting template training with the same scans loads it instead.
+
+If you use this code, please cite the following:
+
+    Yongcheng Yao, Junru Zhong, Liping Zhang, Sheheryar Khan, Weitian Chen.
+    "CartiMorph: a framework for automated knee articular cartilage morphometrics."
+    Medical Image Analysis
+
+Copyright 2023 Yongcheng Yao
+
+-----------------------------------------------------------------------------------
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+compliance with the License. You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is
+distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+implied. See the License for the specific language governing permissions and limitations under
+the License.
+-----------------------------------------------------------------------------------
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+from utils_streamIO import VolumeReader
+
+FILE_TEMPLATE = 'init_template.nii.gz'
+FILE_VARIANCE = 'init_template_variance.nii.gz'
+FILE_INFO = 'init_template.json'
+
+
+def file_list_hash(files):
+    """
+    SHA-1 of the file names, sizes and modification times.
+    """
+    sha1 = hashlib.sha1()
+    for file in files:
+        stat = os.stat(file)
+        sha1.update(f'{os.path.abspath(file)}\t{stat.st_size}\t{stat.st_mtime_ns}\n'.encode())
+    return sha1.hexdigest()
+
+
+def mean_variance(files, load_fn, nb_threads=4, prefetch=8):
+    """
+    Per-voxel mean and (population) variance of volumes of the same shape, in float32.
+    """
+    mean = M2 = delta = None
+    count = 0
+    for file, vol in VolumeReader(load_fn, nb_threads=nb_threads, prefetch=prefetch).iterate(files):
+        if mean is None:
+            mean = np.zeros(vol.shape, dtype=np.float32)
+            M2 = np.zeros(vol.shape, dtype=np.float32)
+            delta = np.empty(vol.shape, dtype=np.float32)
+        elif vol.shape != mean.shape:
+            raise ValueError(f"Shape mismatch: '{file}' has shape {vol.shape}, expected {mean.shape}")
+        count += 1
+        # Welford update: delta = x - mean; mean += delta / n; M2 += delta * (x - mean)
+        np.subtract(vol, mean, out=delta)
+        mean += delta / count
+        delta *= vol - mean
+        M2 += delta
+    if count == 0:
+        raise ValueError('Could not find any training data.')
+    return mean, M2 / count
+
+
+def init_template(files, load_fn, save_fn, model_dir, affine, nb_threads=4, prefetch=8):
+    """
+    Returns the average of the training scans, loaded from the model folder if it was built from
+    the same files; otherwise it is computed and saved with the variance map.
+
+    load_fn loads one scan (with a feature axis); save_fn is called with (array, filename, affine).
+    """
+    path_template = os.path.join(model_dir, FILE_TEMPLATE)
+    path_info = os.path.join(model_dir, FILE_INFO)
+    files_hash = file_list_hash(files)
+
+    if os.path.isfile(path_template) and os.path.isfile(path_info):
+        with open(path_info, 'r') as f:
+            info = json.load(f)
+        if info.get('hash') == files_hash:
+            print('Loading starting template of %d scans from %s.' % (len(files), path_template))
+            return load_fn(path_template)
+
+    print('Creating starting template by averaging %d scans.' % len(files))
+    template, variance = mean_variance(files, load_fn, nb_threads=nb_threads, prefetch=prefetch)
+    # save average input atlas (and variance map) for the record
+    save_fn(template.squeeze(), path_template, affine)
+    save_fn(variance.squeeze(), os.path.join(model_dir, FILE_VARIANCE), affine)
+    path_tmp = path_info + '.tmp'
+    with open(path_tmp, 'w') as f:
+        json.dump({'hash': files_hash, 'nb_files': len(files)}, f, indent=1)
+    os.replace(path_tmp, path_info)
+    return template
@@ -0,0 +1,181 @@
+"""
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+Memory-mapped volume cache and training generators.
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+The generators of VoxelMorph decompress a random .nii.gz file for every sample. The
+cache below decodes the training list once into a single float32 array on disk
+(<hash>.dat, shape (N, *vol_shape, feats)) with an index (<hash>.json), where the hash
+is taken over the file names, sizes and modification times. The generators mirror
+volgen/scan_to_scan/scan_to_atlas/template_creation and draw their batches from the
+memory-mapped array in a background thread. Training processes using the same list
+share the array through the page cache.
+
+If you use this code, please cite the following:
+
+    Yongcheng Yao, Junru Zhong, Liping Zhang, Sheheryar Khan, Weitian Chen.
+    "CartiMorph: a framework for automated knee articular cartilage morphometrics."
+    Medical Image Analysis
+
+Copyright 2023 Yongcheng Yao
+
+-----------------------------------------------------------------------------------
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+compliance with the License. You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is
+distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+implied. See the License for the specific language governing permissions and limitations under
+the License.
+-----------------------------------------------------------------------------------
+"""
+
+import os
+import json
+import queue
+import threading
+import numpy as np
+from utils_streamIO import VolumeReader
+from utils_template import file_list_hash
+
+
+class VolumeCache:
+    """
+    A read-only, memory-mapped float32 array of the training volumes (one row per file).
+    """
+
+    def __init__(self, cache_dir, files, load_fn, nb_threads=4):
+        """
+        Opens the cache of the file list, building it on first use.
+
+        Parameters:
+            cache_dir: Folder of the cache files.
+            files: List of volume files.
+            load_fn: Function called with one file that returns the volume with a feature axis.
+            nb_threads: Number of threads decoding the volumes while the cache is built. Default is 4.
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        self.files = list(files)
+        files_hash = file_list_hash(self.files)
+        self.path_data = os.path.join(cache_dir, files_hash + '.dat')
+        self.path_index = os.path.join(cache_dir, files_hash + '.json')
+        if not (os.path.isfile(self.path_data) and os.path.isfile(self.path_index)):
+            self._build(load_fn, nb_threads)
+        with open(self.path_index, 'r') as f:
+            index = json.load(f)
+        self.shape = tuple(index['shape'])
+        self.data = np.memmap(self.path_data, dtype=np.float32, mode='r', shape=self.shape)
+
+    def _build(self, load_fn, nb_threads):
+        print('Caching %d volumes in %s.' % (len(self.files), self.path_data))
+        path_tmp = '%s.%d.tmp' % (self.path_data, os.getpid())
+        data = None
+        reader = VolumeReader(load_fn, nb_threads=nb_threads, prefetch=2 * nb_threads)
+        for i, (file, vol) in enumerate(reader.iterate(self.files)):
+            if data is None:
+                shape = (len(self.files), *vol.shape)
+                data = np.memmap(path_tmp, dtype=np.float32, mode='w+', shape=shape)
+            elif vol.shape != data.shape[1:]:
+                raise ValueError(f"Shape mismatch: '{file}' has shape {vol.shape}, expected {data.shape[1:]}")
+            data[i] = vol
+        data.flush()
+        del data
+        os.replace(path_tmp, self.path_data)
+        path_tmp = '%s.%d.tmp' % (self.path_index, os.getpid())
+        with open(path_tmp, 'w') as f:
+            json.dump({'shape': shape, 'dtype': 'float32', 'files': self.files}, f, indent=1)
+        os.replace(path_tmp, self.path_index)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, indices):
+        return self.data[indices]
+
+
+def volgen(cache, batch_size=1, prefetch=4, indices=None):
+    """
+    Generator of random batches from a VolumeCache (as vxm.generators.volgen), prepared in a
+    background thread. The volumes are drawn from the given indices (e.g. the shard of a worker),
+    or from the whole cache.
+    """
+    batches = queue.Queue(maxsize=max(1, prefetch))
+    indices = np.arange(len(cache)) if indices is None else np.asarray(indices)
+
+    def produce():
+        while True:
+            # generate [batchsize] random image indices
+            batch = indices[np.random.randint(len(indices), size=batch_size)]
+            batches.put(np.ascontiguousarray(cache[batch]))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        yield (batches.get(),)
+
+
+def scan_to_scan(cache, bidir=False, batch_size=1, prob_same=0, no_warp=False, prefetch=4, indices=None):
+    """
+    Generator for scan-to-scan registration (as vxm.generators.scan_to_scan).
+    """
+    zeros = None
+    gen = volgen(cache, batch_size=batch_size, prefetch=prefetch, indices=indices)
+    while True:
+        scan1 = next(gen)[0]
+        scan2 = next(gen)[0]
+
+        # some induced chance of making source and target equal
+        if prob_same > 0 and np.random.rand() < prob_same:
+            if np.random.rand() > 0.5:
+                scan1 = scan2
+            else:
+                scan2 = scan1
+
+        # cache zeros
+        if not no_warp and zeros is None:
+            shape = scan1.shape[1:-1]
+            zeros = np.zeros((batch_size, *shape, len(shape)))
+
+        invols = [scan1, scan2]
+        outvols = [scan2, scan1] if bidir else [scan2]
+        if not no_warp:
+            outvols.append(zeros)
+
+        yield (invols, outvols)
+
+
+def scan_to_atlas(cache, atlas, bidir=False, batch_size=1, no_warp=False, prefetch=4, indices=None):
+    """
+    Generator for scan-to-atlas registration (as vxm.generators.scan_to_atlas, without segmentations).
+    """
+    shape = atlas.shape[1:-1]
+    zeros = np.zeros((batch_size, *shape, len(shape)))
+    atlas = np.repeat(atlas, batch_size, axis=0)
+    gen = volgen(cache, batch_size=batch_size, prefetch=prefetch, indices=indices)
+    while True:
+        scan = next(gen)[0]
+        invols = [scan, atlas]
+        outvols = [atlas, scan] if bidir else [atlas]
+        if not no_warp:
+            outvols.append(zeros)
+        yield (invols, outvols)
+
+
+def template_creation(cache, bidir=False, batch_size=1, prefetch=4, indices=None):
+    """
+    Generator for unconditional template creation (as vxm.generators.template_creation).
+    """
+    zeros = None
+    gen = volgen(cache, batch_size=batch_size, prefetch=prefetch, indices=indices)
+    while True:
+        scan = next(gen)[0]
+
+        # cache zeros
+        if zeros is None:
+            shape = scan.shape[1:-1]
+            zeros = np.zeros((1, *shape, len(shape)))
+
+        invols = [scan]
+        outvols = [scan, zeros, zeros, zeros] if bidir else [scan, zeros, zeros]
+        yield (invols, outvols)
@@ -0,0 +1,326 @@
+"""
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+Columnar store of the OAI non-image data (.sas7bdat)
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+Each .sas7bdat (or .xlsx) file is converted once, in chunks and with column-wise byte decoding,
+to a columnar file (Parquet or Feather if pyarrow is installed, pickle otherwise).
+The content hash of the source file is recorded, so a table is only converted again
+when its source changes. Tables are kept in memory once loaded, and indexed lookup
+by SubjectID/MRBarCode replaces re-reading the Excel files.
+
+Usage:
+    # convert the OAI tables
+    python metaStore.py --store /path/to/store --sas mri00.sas7bdat kxr_sq_bu00.sas7bdat \
+        enrollees.sas7bdat allclinical00.sas7bdat subjectchar00.sas7bdat
+    # build the subject information table (as "prepareNonImageData.m")
+    python metaStore.py --store /path/to/store --pathDICOM pathDICOM_OAIZIB.xlsx \
+        --subject_info OAIZIB_subject_info.xlsx
+    # look up subjects
+    python metaStore.py --store /path/to/store --lookup 9001104 9002116
+
+Copyright 2023 Yongcheng Yao
+
+-----------------------------------------------------------------------------------
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+compliance with the License. You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is
+distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+implied. See the License for the specific language governing permissions and limitations under
+the License.
+-----------------------------------------------------------------------------------
+"""
+
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401
+    DEFAULT_FORMAT = 'parquet'
+except ImportError:
+    DEFAULT_FORMAT = 'pickle'
+
+FILE_EXTENSIONS = {'parquet': '.parquet', 'feather': '.feather', 'pickle': '.pkl'}
+INDEX_NAME = 'index.json'
+SUBJECT_INFO_NAME = 'subInfo'
+
+# columns of the subject information table
+SUBJECT_INFO_COLUMNS = ['SubjectID', 'Path', 'MRBarCode', 'KneeSide', 'KLGrade', 'Gender', 'Age', 'BMI']
+
+
+def file_hash(path, block_size=1 << 20):
+    """
+    SHA-1 of the file content.
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def decode_bytes(data, encoding='utf-8'):
+    """
+    Decode the byte strings of the object columns, one column at a time (in place).
+    """
+    for col in data.columns[data.dtypes == object]:
+        values = data[col].dropna()
+        if len(values) and isinstance(values.iloc[0], bytes):
+            data[col] = data[col].str.decode(encoding, errors='replace')
+    return data
+
+
+def read_sas_chunks(path_sas, chunksize=100000, columns=None, encoding='utf-8'):
+    """
+    Yields the decoded chunks of a .sas7bdat file, projected to the given columns.
+    """
+    with pd.read_sas(path_sas, chunksize=chunksize) as reader:
+        for chunk in reader:
+            if columns is not None:
+                chunk = chunk[[col for col in chunk.columns if col in columns]]
+            yield decode_bytes(chunk, encoding)
+
+
+def as_key(series):
+    """
+    Normalize an ID column (e.g. read as float, int or text) to stripped strings for joining.
+    """
+    if pd.api.types.is_float_dtype(series):
+        values = series.to_numpy()
+        out = pd.Series(np.where(np.isnan(values), '', values.astype(str)), index=series.index, dtype=object)
+        whole = ~np.isnan(values) & (values == np.round(values))
+        out[whole] = values[whole].astype(np.int64).astype(str)
+        return out
+    return series.astype(str).str.strip()
+
+
+def as_barcode(series):
+    """
+    Normalize an MRI barcode column (e.g. '016610498212' or 16610498212.0) to a string without leading zeros.
+    """
+    return as_key(series).str.lstrip('0')
+
+
+class MetaStore:
+    """
+    A folder of converted tables with an index of their source files.
+    """
+
+    def __init__(self, store_dir, file_format=DEFAULT_FORMAT):
+        if file_format not in FILE_EXTENSIONS:
+            raise ValueError('file_format should be one of %s, but found "%s"' % (list(FILE_EXTENSIONS), file_format))
+        if file_format in ('parquet', 'feather') and DEFAULT_FORMAT != 'parquet':
+            raise ImportError(f'pyarrow is required for the {file_format} format')
+        self.store_dir = store_dir
+        self.file_format = file_format
+        os.makedirs(store_dir, exist_ok=True)
+        self.path_index = os.path.join(store_dir, INDEX_NAME)
+        self.index = {}
+        if os.path.isfile(self.path_index):
+            with open(self.path_index, 'r') as f:
+                self.index = json.load(f)
+        self.tables = {}
+
+    def _save_index(self):
+        path_tmp = self.path_index + '.tmp'
+        with open(path_tmp, 'w') as f:
+            json.dump(self.index, f, indent=1, sort_keys=True)
+        os.replace(path_tmp, self.path_index)
+
+    def _write(self, data, name):
+        file_format = self.file_format
+        path = os.path.join(self.store_dir, name + FILE_EXTENSIONS[file_format])
+        path_tmp = path + '.tmp'
+        if file_format == 'parquet':
+            data.to_parquet(path_tmp, index=False)
+        elif file_format == 'feather':
+            data.reset_index(drop=True).to_feather(path_tmp)
+        else:
+            data.to_pickle(path_tmp)
+        os.replace(path_tmp, path)
+        return os.path.basename(path), file_format
+
+    def _read(self, name, columns=None):
+        entry = self.index[name]
+        path = os.path.join(self.store_dir, entry['file'])
+        if entry['format'] == 'parquet':
+            return pd.read_parquet(path, columns=columns)
+        elif entry['format'] == 'feather':
+            return pd.read_feather(path, columns=columns)
+        data = pd.read_pickle(path)
+        return data if columns is None else data[columns]
+
+    def is_current(self, name, path_source):
+        """
+        Whether the table was converted from the current content of the source file.
+        """
+        entry = self.index.get(name)
+        if entry is None or not os.path.isfile(os.path.join(self.store_dir, entry['file'])):
+            return False
+        stat = os.stat(path_source)
+        # the size and modification time spare hashing unchanged files
+        if entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime:
+            return True
+        return entry.get('sha1') == file_hash(path_source)
+
+    def put(self, data, name, path_source=None):
+        """
+        Store a DataFrame as a table.
+        """
+        file_name, file_format = self._write(data, name)
+        path_old = os.path.join(self.store_dir, self.index.get(name, {}).get('file', file_name))
+        if path_old != os.path.join(self.store_dir, file_name) and os.path.isfile(path_old):
+            os.remove(path_old)
+        entry = {'file': file_name, 'format': file_format, 'rows': len(data)}
+        if path_source is not None:
+            stat = os.stat(path_source)
+            entry.update({'source': os.path.abspath(path_source), 'sha1': file_hash(path_source),
+                          'size': stat.st_size, 'mtime': stat.st_mtime})
+        self.index[name] = entry
+        self._save_index()
+        # drop the indexed copies of the old table
+        self.tables = {key: value for key, value in self.tables.items() if not (isinstance(key, tuple) and key[0] == name)}
+        self.tables[name] = data
+
+    def convert(self, path_source, name=None, chunksize=100000, columns=None, force=False):
+        """
+        Convert a .sas7bdat (or .xlsx) file to a table (named after the file by default), unless it is up to date.
+        Returns True if the file was converted.
+        """
+        if name is None:
+            name = os.path.splitext(os.path.basename(path_source))[0].lower()
+        if not force and self.is_current(name, path_source):
+            return False
+        if path_source.lower().endswith(('.xlsx', '.xls')):
+            data = pd.read_excel(path_source, usecols=columns)
+        else:
+            chunks = list(read_sas_chunks(path_source, chunksize=chunksize, columns=columns))
+            data = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+        self.put(data, name, path_source=path_source)
+        return True
+
+    def load(self, name, columns=None):
+        """
+        Load a table (kept in memory for later calls).
+        """
+        if name not in self.tables:
+            if name not in self.index:
+                raise KeyError(f"Table '{name}' is not found in the store '{self.store_dir}'")
+            self.tables[name] = self._read(name)
+        data = self.tables[name]
+        return data if columns is None else data[columns]
+
+    def indexed(self, name, keys):
+        """
+        A table indexed (and sorted) by one or more key columns normalized to strings.
+        """
+        keys = [keys] if isinstance(keys, str) else list(keys)
+        cache_name = (name, tuple(keys))
+        if cache_name not in self.tables:
+            data = self.load(name).copy()
+            for key in keys:
+                data[key] = as_barcode(data[key]) if key == 'MRBarCode' else as_key(data[key])
+            self.tables[cache_name] = data.set_index(keys).sort_index()
+        return self.tables[cache_name]
+
+    def lookup(self, values, key='SubjectID', name=SUBJECT_INFO_NAME):
+        """
+        Rows of a table whose key column (e.g. SubjectID or MRBarCode) matches the values.
+        """
+        values = as_key(pd.Series(np.atleast_1d(values)))
+        if key == 'MRBarCode':
+            values = values.str.lstrip('0')
+        data = self.indexed(name, key)
+        return data.loc[data.index.intersection(values, sort=False)].reset_index()
+
+    def subject_info(self, table_pathDICOM, tables=None):
+        """
+        Join MRBarCode, KneeSide, KLGrade, Gender, Age and BMI to the subjects of a table with
+        SubjectID and Path columns (as "prepareNonImageData.m").
+
+        tables: names of the OAI tables, keys 'mri', 'kxr', 'gender', 'bmi' and 'age'.
+        """
+        names = {'mri': 'mri00', 'kxr': 'kxr_sq_bu00', 'gender': 'enrollees', 'bmi': 'allclinical00', 'age': 'subjectchar00'}
+        names.update(tables or {})
+
+        subjects = pd.DataFrame({'SubjectID': as_key(table_pathDICOM['SubjectID']),
+                                 'Path': table_pathDICOM['Path'].astype(str)})
+        subjects['MRBarCode'] = as_barcode('0166' + subjects['Path'].str.strip().str[-8:])
+
+        # MRBarCode and knee side, matched by subject ID and MRI barcode
+        mri = self.load(names['mri'], ['ID', 'V00MRBARCD', 'V00MRSIDE'])
+        mri = pd.DataFrame({'SubjectID': as_key(mri['ID']), 'MRBarCode': as_barcode(mri['V00MRBARCD']),
+                            'KneeSide': mri['V00MRSIDE']})
+        mri = mri[mri['MRBarCode'] != '']
+        out = subjects.merge(mri, on=['SubjectID', 'MRBarCode'], how='left', indicator=True, validate='many_to_one')
+        if (out['_merge'] != 'both').any():
+            missing = out.loc[out['_merge'] != 'both', 'SubjectID'].tolist()
+            raise ValueError(f'MRBarCode: 0 matched rows in the source table for subjects {missing}')
+        out = out.drop(columns='_merge')
+        out['MRBarCode'] = out['MRBarCode'].astype(np.int64)
+
+        # KL grade, matched by subject ID and knee side
+        # (the reading from project 15 first, then the reading from project 37/42 if it is unique)
+        kxr = self.load(names['kxr'], ['ID', 'SIDE', 'READPRJ', 'V00XRKL'])
+        kxr = pd.DataFrame({'SubjectID': as_key(kxr['ID']), 'KneeSide': as_key(kxr['SIDE']),
+                            'READPRJ': as_key(kxr['READPRJ']), 'KLGrade': kxr['V00XRKL']})
+        kxr_p15 = kxr[kxr['READPRJ'] == '15']
+        if kxr_p15.duplicated(['SubjectID', 'KneeSide']).any():
+            raise ValueError('K-L grade: more than 1 matched rows in the source table')
+        kxr_p37or42 = kxr[kxr['READPRJ'].isin(['37', '42'])].drop_duplicates(['SubjectID', 'KneeSide', 'KLGrade'])
+        kxr_p37or42 = kxr_p37or42[~kxr_p37or42.duplicated(['SubjectID', 'KneeSide'], keep=False)]
+        kl = pd.concat([kxr_p15, kxr_p37or42]).drop_duplicates(['SubjectID', 'KneeSide'], keep='first')
+        out['_side'] = as_key(out['KneeSide'])
+        out = out.merge(kl[['SubjectID', 'KneeSide', 'KLGrade']].rename(columns={'KneeSide': '_side'}),
+                        on=['SubjectID', '_side'], how='left').drop(columns='_side')
+
+        # Gender, age and BMI, matched by subject ID
+        for column, name, var in (('Gender', names['gender'], 'P02SEX'),
+                                  ('Age', names['age'], 'V00AGE'),
+                                  ('BMI', names['bmi'], 'P01BMI')):
+            table = self.load(name, ['ID', var])
+            table = pd.DataFrame({'SubjectID': as_key(table['ID']), column: table[var]})
+            if table['SubjectID'].duplicated().any():
+                raise ValueError(f'{column}: more than 1 matched rows in the source table')
+            out = out.merge(table, on='SubjectID', how='left')
+        return out[SUBJECT_INFO_COLUMNS]
+
+
+if __name__ == '__main__':
+    # create argument parser
+    parser = argparse.ArgumentParser(description='Convert the OAI .sas7bdat files to a columnar store and join subject information')
+    parser.add_argument('--store', type=str, required=True, help='path to the store folder')
+    parser.add_argument('--sas', type=str, nargs='+', default=[], help='path(s) to .sas7bdat (or .xlsx) file(s) to convert')
+    parser.add_argument('--chunksize', type=int, default=100000, help='number of rows read per chunk (default: 100000)')
+    parser.add_argument('--format', type=str, default=DEFAULT_FORMAT, choices=list(FILE_EXTENSIONS), help=f'file format of new tables (default: {DEFAULT_FORMAT})')
+    parser.add_argument('--force', action='store_true', help='convert the .sas7bdat files even if they are up to date')
+    parser.add_argument('--pathDICOM', type=str, help='(optional) .xlsx file with SubjectID and Path columns; builds the subject information table')
+    parser.add_argument('--subject_info', type=str, help='(optional) output .xlsx file of the subject information table')
+    parser.add_argument('--lookup', type=str, nargs='+', help='(optional) SubjectIDs (or MRBarCodes with "--key MRBarCode") to print')
+    parser.add_argument('--key', type=str, default='SubjectID', choices=['SubjectID', 'MRBarCode'], help='key column for --lookup (default: SubjectID)')
+    args = parser.parse_args()
+
+    store = MetaStore(args.store, file_format=args.format)
+
+    # convert .sas7bdat (.xlsx) files
+    for path_source in args.sas:
+        converted = store.convert(path_source, chunksize=args.chunksize, force=args.force)
+        print(f"{path_source}: {'converted' if converted else 'up to date'}")
+
+    # build the subject information table
+    if args.pathDICOM:
+        subInfo = store.subject_info(pd.read_excel(args.pathDICOM))
+        store.put(subInfo, SUBJECT_INFO_NAME)
+        if args.subject_info:
+            subInfo.to_excel(args.subject_info, index=False, sheet_name='subInfo_OAIZIBseg')
+
+    # look up subjects
+    if args.lookup:
+        print(store.lookup(args.lookup, key=args.key).to_string(index=False))
@@ -19,34 +19,288 @@
 # [1] The SimpleITK.WriteImage will set orientation to RAS+ when the output format is NIfTI
 # [2] <SimpleITK image>.SetDirection will not re-slice the data array, only the affine matrix will be modified
 # -----------------------------------------------------------
+#
+# -----------------------------------------------------------
+# Fused preprocessing of the OAI-ZIB segmentation masks (--path_img, --subject_info)
+# -----------------------------------------------------------
+# The affine matrix in the .mhd files is corrupt. With "--path_img", each mask is converted in one pass:
+#     [1] read the .raw/.mhd file
+#     [2] flip the data array and copy the NIfTI header of the paired MR image (as "copyAffineMat_img2seg.m")
+#     [3] (with "--subject_info") split the tibial cartilage into medial and lateral tibial cartilages
+#         using the KneeSide column of the subject information table (as "splitTC.m")
+#     [4] write the .nii.gz file
+# -----------------------------------------------------------
 
 
 import argparse
 import os
 import glob
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import SimpleITK as sitk
 
-# Create argument parser
-parser = argparse.ArgumentParser(description='Convert .raw/.mhd to .nii files')
-parser.add_argument('--path_raw', '-i', type=str, help='Path to .raw/.mhd directory')
-parser.add_argument('--path_nii', '-o', type=str, help='Path to .nii directory')
-
-# Parse arguments
-args = parser.parse_args()
-
-# Check if directories exist
-if not os.path.isdir(args.path_raw):
-    raise ValueError(f"Path to .raw/.mhd directory '{args.path_raw}' does not exist")
-if not os.path.isdir(args.path_nii):
-    os.makedirs(args.path_nii)
-
-# Get list of raw files
-List_mhd = glob.glob(os.path.join(args.path_raw, '*.mhd'))
-
-# Convert .raw/.mhd to .nii
-for i_path_mhd in List_mhd:
-    i_subID = os.path.splitext(os.path.splitext(os.path.basename(i_path_mhd))[0])[0]
-    i_img = sitk.ReadImage(i_path_mhd)
-    # save to .nii.gz
-    i_path_nii = os.path.join(args.path_nii, f'{i_subID}.nii.gz')
-    sitk.WriteImage(i_img, i_path_nii)
\ No newline at end of file
+# the manifest records the source files of every converted output
+MANIFEST_NAME = 'raw2nii_manifest.json'
+
+# knee side coding of OAI dataset
+KNEE_CODE_R = 1
+KNEE_CODE_L = 2
+
+# label of TC, and the new labels of mTC and lTC
+LABEL_TC = 4
+NEW_LABEL_MTC = 4
+NEW_LABEL_LTC = 5
+
+# 26-connectivity
+STRUCTURE_26 = np.ones((3, 3, 3), dtype=bool)
+
+
+def get_dataFile(path_mhd):
+    """
+    Get the path of the data file (.raw) referenced by the .mhd header.
+    """
+    with open(path_mhd, 'r', errors='ignore') as f:
+        for line in f:
+            key, _, value = line.partition('=')
+            if key.strip() == 'ElementDataFile':
+                value = value.strip()
+                if value == 'LOCAL':
+                    return None
+                return os.path.join(os.path.dirname(path_mhd), value)
+    return None
+
+
+def get_signature(path_mhd, path_img=None, kneeSide=None):
+    """
+    Modification time and size of the .mhd file, its data file, and the paired MR image (if any).
+    """
+    signature = {}
+    for key, path in (('mhd', path_mhd), ('raw', get_dataFile(path_mhd)), ('img', path_img)):
+        if path is not None and os.path.isfile(path):
+            stat = os.stat(path)
+            signature[key] = {'mtime': stat.st_mtime, 'size': stat.st_size}
+    if kneeSide is not None:
+        signature['kneeSide'] = int(kneeSide)
+    return signature
+
+
+def remove_small_components(mask, min_size):
+    """
+    Remove connected components (26-connectivity) with fewer than min_size voxels (as "bwareaopen").
+    """
+    from scipy import ndimage
+    labels, _ = ndimage.label(mask, structure=STRUCTURE_26)
+    keep = np.bincount(labels.ravel()) >= min_size
+    keep[0] = False
+    return keep[labels]
+
+
+def copy_affine(vol_seg, direction_seg, header_img):
+    """
+    Flip the data array of the mask to the orientation of the MR image (as "copyAffineMat_img2seg.m").
+
+    vol_seg is in ITK index order (x, y, z) and direction_seg is the ITK direction matrix of the mask.
+    """
+    # diagonal of the affine matrix SimpleITK would write to NIfTI (LPS+ to RAS+)
+    diag_seg = np.diag(np.diag([-1.0, -1.0, 1.0]) @ np.reshape(direction_seg, (3, 3)))
+    diag_img = np.diag(header_img.get_best_affine()[:3, :3])
+    idx_flipDim = np.nonzero((diag_img > 0) != (diag_seg > 0))[0]
+    if len(idx_flipDim):
+        vol_seg = np.flip(vol_seg, axis=tuple(idx_flipDim))
+    return vol_seg
+
+
+def split_TC(vol, affine, kneeSide, subID):
+    """
+    Split the tibial cartilage into medial and lateral tibial cartilages (as "splitTC.m").
+    """
+    import nibabel as nib
+    from scipy import ndimage
+
+    # remove isolated cluster
+    # (the label for subject 9269383 in the OAI-ZIB dataset has unexpected isolated cluster)
+    mask = vol != 0
+    vol = vol * remove_small_components(mask, int(np.floor(mask.sum() / 10 + 0.5)))
+
+    # get the image dimension pointing to right/left
+    axcodes = nib.aff2axcodes(affine)
+    dim_RL = [i for i, code in enumerate(axcodes) if code in ('R', 'L')][0]
+    code_invertDim = 1 if axcodes[dim_RL] == 'R' else -1
+
+    # get knee side
+    if kneeSide == KNEE_CODE_R:
+        code_invertSide = 1
+    elif kneeSide == KNEE_CODE_L:
+        code_invertSide = -1
+    else:
+        raise ValueError(f'subject {subID}: knee side {kneeSide} in the subject information table is wrong')
+
+    # remove isolated voxels (minimum cluster size is 10)
+    maskTC = remove_small_components(vol == LABEL_TC, 10)
+
+    # detect connected components in the TC mask
+    labelsTC, num_cc = ndimage.label(maskTC, structure=STRUCTURE_26)
+    if num_cc < 2:
+        raise ValueError(f'subject {subID}: the lTC and mTC are connected in the label')
+    size_cc = np.bincount(labelsTC.ravel())[1:]
+    centroids = np.array(ndimage.center_of_mass(maskTC, labelsTC, np.arange(1, num_cc + 1)))
+    # the two largest components; the others join the one with the nearer centroid
+    sortIdx = np.argsort(-size_cc, kind='stable')
+    centroid_cc1 = centroids[sortIdx[0]]
+    centroid_cc2 = centroids[sortIdx[1]]
+    dist_cc1 = np.linalg.norm(centroids - centroid_cc1, axis=1)
+    dist_cc2 = np.linalg.norm(centroids - centroid_cc2, axis=1)
+    group_cc1 = dist_cc1 < dist_cc2
+    group_cc1[sortIdx[0]] = True
+    group_cc1[sortIdx[1]] = False
+    mask_cc1 = np.concatenate([[False], group_cc1])[labelsTC]
+    if centroid_cc1[dim_RL] < centroid_cc2[dim_RL]:
+        mask_lower, mask_higher = mask_cc1, maskTC & ~mask_cc1
+    else:
+        mask_lower, mask_higher = maskTC & ~mask_cc1, mask_cc1
+
+    # assign new labels to mTC and lTC
+    vol_out = np.where(vol == LABEL_TC, 0, vol).astype(np.uint8)
+    if code_invertDim * code_invertSide > 0:
+        vol_out[mask_lower] = NEW_LABEL_MTC
+        vol_out[mask_higher] = NEW_LABEL_LTC
+    else:
+        vol_out[mask_lower] = NEW_LABEL_LTC
+        vol_out[mask_higher] = NEW_LABEL_MTC
+    return vol_out
+
+
+def convert(path_mhd, path_nii, compression_level, path_img=None, kneeSide=None):
+    """
+    Convert one .raw/.mhd file to .nii.gz. Returns the elapsed time and the number of bytes read.
+
+    With path_img, the header of the MR image is copied to the output (and the tibial cartilage
+    is split when kneeSide is given) before the single write.
+    """
+    time_start = time.time()
+    img = sitk.ReadImage(path_mhd)
+    # write to a hidden temporary file first (not matched by *.nii.gz globs) so that an interrupted
+    # run never leaves a truncated output
+    path_tmp = os.path.join(os.path.dirname(path_nii), '.tmp_' + os.path.basename(path_nii))
+    try:
+        if path_img is None:
+            sitk.WriteImage(img, path_tmp, True, compression_level)
+        else:
+            import nibabel as nib
+            subID = os.path.basename(path_nii)[:-len('.nii.gz')]
+            header_img = nib.load(path_img).header
+            vol = np.transpose(sitk.GetArrayFromImage(img), (2, 1, 0))
+            vol = copy_affine(vol, img.GetDirection(), header_img)
+            affine = header_img.get_best_affine()
+            if kneeSide is not None:
+                vol = split_TC(vol, affine, kneeSide, subID)
+            header_seg = header_img.copy()
+            header_seg.set_data_dtype(np.uint8)
+            header_seg['descrip'] = b'mask with corrected affine matrix' + (b' and two TCs' if kneeSide is not None else b'')
+            if compression_level > 0:
+                nib.openers.Opener.default_compresslevel = compression_level
+            nib.save(nib.Nifti1Image(np.ascontiguousarray(vol, dtype=np.uint8), affine, header=header_seg), path_tmp)
+        os.replace(path_tmp, path_nii)
+    finally:
+        if os.path.exists(path_tmp):
+            os.remove(path_tmp)
+    signature = get_signature(path_mhd)
+    nbytes = sum(signature[key]['size'] for key in ('mhd', 'raw') if key in signature)
+    return time.time() - time_start, nbytes
+
+
+def find_img(path_img, subID):
+    """
+    Path of the MR image paired with a mask.
+    """
+    for ext in ('.nii.gz', '.nii'):
+        i_path = os.path.join(path_img, subID + ext)
+        if os.path.isfile(i_path):
+            return i_path
+    raise ValueError(f"MR image of subject {subID} is not found in '{path_img}'")
+
+
+def save_manifest(path_manifest, manifest):
+    path_tmp = path_manifest + '.tmp'
+    with open(path_tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path_tmp, path_manifest)
+
+
+if __name__ == '__main__':
+    # Create argument parser
+    parser = argparse.ArgumentParser(description='Convert .raw/.mhd to .nii files')
+    parser.add_argument('--path_raw', '-i', type=str, help='Path to .raw/.mhd directory')
+    parser.add_argument('--path_nii', '-o', type=str, help='Path to .nii directory')
+    parser.add_argument('--path_img', type=str, help='(optional) Path to the MR images (.nii.gz) whose header is copied to the masks')
+    parser.add_argument('--subject_info', type=str, help='(optional) Subject information table (.xlsx) with the KneeSide column, used to split the tibial cartilage; requires --path_img')
+    parser.add_argument('--num_workers', '-j', type=int, default=os.cpu_count(), help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('--compression_level', type=int, default=-1, help='gzip compression level 1-9 (default: -1, the library default)')
+    parser.add_argument('--force', action='store_true', help='Convert all files, even if the outputs are up to date')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    # Check if directories exist
+    if not os.path.isdir(args.path_raw):
+        raise ValueError(f"Path to .raw/.mhd directory '{args.path_raw}' does not exist")
+    if not os.path.isdir(args.path_nii):
+        os.makedirs(args.path_nii)
+    if args.subject_info and not args.path_img:
+        raise ValueError('Splitting the tibial cartilage requires the MR images. Add "--path_img" or remove "--subject_info".')
+
+    # Get knee side of each subject
+    kneeSides = {}
+    if args.subject_info:
+        import pandas as pd
+        table_subInfo = pd.read_excel(args.subject_info, usecols=['SubjectID', 'KneeSide'])
+        kneeSides = dict(zip(table_subInfo['SubjectID'].astype(str), table_subInfo['KneeSide'].astype(int)))
+
+    # Get list of raw files
+    List_mhd = sorted(glob.glob(os.path.join(args.path_raw, '*.mhd')))
+
+    # Load the manifest of the previous runs
+    path_manifest = os.path.join(args.path_nii, MANIFEST_NAME)
+    manifest = {}
+    if os.path.isfile(path_manifest):
+        with open(path_manifest, 'r') as f:
+            manifest = json.load(f)
+
+    # Skip the outputs whose source files have not changed
+    tasks = {}
+    for i_path_mhd in List_mhd:
+        i_subID = os.path.splitext(os.path.splitext(os.path.basename(i_path_mhd))[0])[0]
+        i_path_nii = os.path.join(args.path_nii, f'{i_subID}.nii.gz')
+        i_path_img = find_img(args.path_img, i_subID) if args.path_img else None
+        i_kneeSide = None
+        if args.subject_info:
+            if i_subID not in kneeSides:
+                raise ValueError(f"Subject {i_subID} is not found in '{args.subject_info}'")
+            i_kneeSide = kneeSides[i_subID]
+        i_signature = get_signature(i_path_mhd, i_path_img, i_kneeSide)
+        if not args.force and os.path.isfile(i_path_nii) and manifest.get(i_subID, {}).get('source') == i_signature:
+            continue
+        tasks[i_subID] = (i_path_mhd, i_path_nii, i_path_img, i_kneeSide, i_signature)
+    print(f'{len(List_mhd)} .mhd files found, {len(List_mhd) - len(tasks)} up to date, {len(tasks)} to convert')
+
+    # Convert .raw/.mhd to .nii in parallel
+    time_start = time.time()
+    nbytes_total = 0
+    with ProcessPoolExecutor(max_workers=max(1, args.num_workers)) as pool:
+        futures = {pool.submit(convert, i_path_mhd, i_path_nii, args.compression_level, i_path_img, i_kneeSide): i_subID
+                   for i_subID, (i_path_mhd, i_path_nii, i_path_img, i_kneeSide, _) in tasks.items()}
+        for future in as_completed(futures):
+            i_subID = futures[future]
+            i_seconds, i_nbytes = future.result()
+            nbytes_total += i_nbytes
+            print(f'{i_subID}: {i_seconds:.2f} s, {i_nbytes / 1e6 / max(i_seconds, 1e-6):.1f} MB/s')
+            # update the manifest after every file so that an interrupted run can be resumed
+            manifest[i_subID] = {'source': tasks[i_subID][-1], 'seconds': round(i_seconds, 3)}
+            save_manifest(path_manifest, manifest)
+
+    time_total = time.time() - time_start
+    if tasks:
+        print(f'Converted {len(tasks)} files in {time_total:.1f} s '
+              f'({len(tasks) / time_total:.2f} files/s, {nbytes_total / 1e6 / time_total:.1f} MB/s)')
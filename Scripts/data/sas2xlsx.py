@@ -1,17 +1,76 @@
 import pandas as pd
 import argparse
+from metaStore import as_key, decode_bytes, read_sas_chunks
 
-# create argument parser
-parser = argparse.ArgumentParser()
-parser.add_argument('--sas', type=str, help='path to .sas7dat file')
-parser.add_argument('--xlsx', type=str, help='path to output .xlsx file')
-args, unknown = parser.parse_known_args()
 
-# read .sas7dat file using pandas
-data = pd.read_sas(args.sas)
+def write_chunks(chunks, path_out):
+    """
+    Append chunks to a .xlsx file (write-only workbook, rows are streamed) or a .csv file.
+    Returns the number of rows written.
+    """
+    nb_rows = 0
+    if path_out.lower().endswith('.csv'):
+        header = True
+        for chunk in chunks:
+            chunk.to_csv(path_out, index=False, mode='w' if header else 'a', header=header)
+            header = False
+            nb_rows += len(chunk)
+        return nb_rows
 
-# decode byte strings to regular strings
-data = data.applymap(lambda x: x.decode() if isinstance(x, bytes) else x)
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    header = True
+    for chunk in chunks:
+        if header:
+            ws.append(list(chunk.columns))
+            header = False
+        for row in chunk.astype(object).where(chunk.notna(), None).itertuples(index=False, name=None):
+            ws.append(row)
+        nb_rows += len(chunk)
+    wb.save(path_out)
+    return nb_rows
 
-# write data to .xlsx file
-data.to_excel(args.xlsx, index=False)
\ No newline at end of file
+
+def filter_rows(chunks, column, ids):
+    """
+    Keep the rows whose ID column is in the set of IDs.
+    """
+    for chunk in chunks:
+        yield chunk[as_key(chunk[column]).isin(ids).to_numpy()]
+
+
+if __name__ == '__main__':
+    # create argument parser
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sas', type=str, help='path to .sas7dat file')
+    parser.add_argument('--xlsx', type=str, help='path to output .xlsx (or .csv) file')
+    parser.add_argument('--chunksize', type=int, default=0, help='(optional) stream the file in chunks of this many rows; memory stays flat with the table size')
+    parser.add_argument('--columns', type=str, nargs='+', help='(optional) columns to keep')
+    parser.add_argument('--id_sheet', type=str, help='(optional) .xlsx file (e.g. a dataset split sheet) whose IDs select the rows to keep')
+    parser.add_argument('--id_sheet_column', type=str, default='SubjectID', help='ID column in --id_sheet (default: SubjectID)')
+    parser.add_argument('--id_column', type=str, default='ID', help='ID column in the .sas7dat file (default: ID)')
+    args, unknown = parser.parse_known_args()
+
+    columns = args.columns
+    if columns is not None and args.id_sheet and args.id_column not in columns:
+        columns = columns + [args.id_column]
+
+    if args.chunksize > 0:
+        # read, decode, filter and write one chunk at a time
+        chunks = read_sas_chunks(args.sas, chunksize=args.chunksize, columns=columns)
+    else:
+        # read .sas7dat file using pandas
+        data = pd.read_sas(args.sas)
+        if columns is not None:
+            data = data[[col for col in data.columns if col in columns]]
+        # decode byte strings to regular strings
+        chunks = [decode_bytes(data)]
+
+    if args.id_sheet:
+        ids = set(as_key(pd.read_excel(args.id_sheet, usecols=[args.id_sheet_column])[args.id_sheet_column]))
+        chunks = filter_rows(chunks, args.id_column, ids)
+
+    # write data to .xlsx file
+    nb_rows = write_chunks(chunks, args.xlsx)
+    print(f'{nb_rows} rows written to {args.xlsx}')
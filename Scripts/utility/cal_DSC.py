@@ -3,50 +3,246 @@ import nibabel as nib
 import numpy as np
 import csv
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from scipy.ndimage import binary_erosion, distance_transform_edt, find_objects, generate_binary_structure
+from scipy.spatial import cKDTree
 
-# Parse command line arguments
-parser = argparse.ArgumentParser(description='Calculate Dice Similarity Coefficient between model predictions and ground truth segmentations.')
-parser.add_argument('--prediction_dir', type=str, help='Path to directory containing model prediction NIfTI files')
-parser.add_argument('--GT_dir', type=str, help='Path to directory containing ground truth segmentation NIfTI files')
-parser.add_argument('--DSC_dir', type=str, help='Path to directory where DSC results should be saved')
-args = parser.parse_args()
-
-
-# Create DSC directory if it doesn't exist
-if not os.path.exists(args.DSC_dir):
-    os.makedirs(args.DSC_dir)
-
-# Define labels to calculate DSC for
-labels = np.arange(1, 6)
-
-# Get list of NIfTI files in prediction directory
-prediction_files = [f for f in os.listdir(args.prediction_dir) if f.endswith('.nii.gz')]
-
-# Initialize DSC results list
-dsc_results = []
-
-# Loop over prediction files
-for file in prediction_files:
-    # Read prediction NIfTI file
-    pred_nii = nib.load(os.path.join(args.prediction_dir, file))
-    pred_data = pred_nii.get_fdata()
-    # Read ground truth NIfTI file
-    gt_nii = nib.load(os.path.join(args.GT_dir, file))
-    gt_data = gt_nii.get_fdata()
-    # Calculate DSC for each label
-    for label in labels:
-        pred_mask = (pred_data == label)
-        gt_mask = (gt_data == label)
-        numerator = np.sum(np.logical_and(pred_mask, gt_mask)) * 2.0
-        denominator = np.sum(pred_mask) + np.sum(gt_mask)
-        if denominator != 0:
-            dsc = numerator / denominator
-            # Save DSC result
-            dsc_results.append([file, label, dsc])
-
-# Save DSC results to CSV file
-with open(os.path.join(args.DSC_dir, 'dsc_results.csv'), 'w', newline='') as csvfile:
-    writer = csv.writer(csvfile)
-    writer.writerow(['File', 'Label', 'DSC'])
-    for result in dsc_results:
-        writer.writerow(result)
\ No newline at end of file
+# number of voxels counted per bincount call (bounds the temporary index array)
+SLAB_SIZE = 1 << 22
+
+# metrics and their column names in the output CSV
+METRIC_COLUMNS = {'dice': 'DSC', 'jaccard': 'Jaccard', 'vs': 'VS', 'hd95': 'HD95', 'assd': 'ASSD'}
+SURFACE_METRICS = ('hd95', 'assd')
+
+
+def load_labels(path):
+    """
+    Read a label volume in its native integer dtype (no float64 copy).
+    """
+    data = np.asanyarray(nib.load(path).dataobj)
+    if not np.issubdtype(data.dtype, np.integer):
+        # scaled or float-typed label files
+        data = np.rint(data).astype(np.int32)
+    if data.size and data.min() < 0:
+        raise ValueError(f"Negative label found in '{path}'")
+    return data
+
+
+def joint_histogram(pred_data, gt_data, nb_labels):
+    """
+    Count every (prediction label, ground-truth label) pair in one pass over the volumes.
+
+    Returns an array H of shape (nb_labels, nb_labels) where H[p, g] is the number of voxels
+    labelled p in the prediction and g in the ground truth.
+    """
+    if pred_data.shape != gt_data.shape:
+        raise ValueError(f'Shape mismatch: prediction {pred_data.shape} vs ground truth {gt_data.shape}')
+    idx_dtype = np.uint16 if nb_labels * nb_labels <= np.iinfo(np.uint16).max else np.int64
+    # flatten both volumes in the same (memory) order to avoid copies
+    order = 'F' if pred_data.flags.f_contiguous else 'C'
+    pred_flat = pred_data.reshape(-1, order=order)
+    gt_flat = gt_data.reshape(-1, order=order)
+    hist = np.zeros(nb_labels * nb_labels, dtype=np.int64)
+    for start in range(0, pred_flat.size, SLAB_SIZE):
+        idx = pred_flat[start:start + SLAB_SIZE].astype(idx_dtype) * idx_dtype(nb_labels)
+        idx += gt_flat[start:start + SLAB_SIZE].astype(idx_dtype)
+        hist += np.bincount(idx, minlength=nb_labels * nb_labels)
+    return hist.reshape(nb_labels, nb_labels)
+
+
+def extract_surface(mask):
+    """
+    Boundary voxels of a binary mask (voxels removed by an erosion with 6-connectivity).
+    Voxels on the image border belong to the boundary, as in MedPy.
+    """
+    structure = generate_binary_structure(mask.ndim, 1)
+    return mask & ~binary_erosion(mask, structure=structure)
+
+
+def pad_box(box, shape, margin):
+    """
+    Grow a bounding box (tuple of slices) by a margin, clipped to the volume.
+    """
+    return tuple(slice(max(s.start - margin, 0), min(s.stop + margin, n)) for s, n in zip(box, shape))
+
+
+def union_box(box1, box2):
+    return tuple(slice(min(s1.start, s2.start), max(s1.stop, s2.stop)) for s1, s2 in zip(box1, box2))
+
+
+def get_box(boxes, label):
+    return boxes[label - 1] if 0 < label <= len(boxes) else None
+
+
+class GTDistanceCache:
+    """
+    Surfaces and Euclidean distance transforms of the ground-truth labels of one subject.
+
+    The distance transform of each label surface is computed once, in the bounding box of the
+    label grown by `margin` voxels, and reused for every prediction scored against the same
+    ground truth. Distances of points outside that box are looked up in a KD-tree of the
+    surface points, so all distances are exact.
+    """
+
+    def __init__(self, gt_data, spacing, margin=10):
+        self.gt_data = gt_data
+        self.spacing = np.asarray(spacing, dtype=np.float64)
+        self.margin = max(1, margin)
+        self.boxes = find_objects(gt_data)
+        self.entries = {}
+
+    def get(self, label):
+        """
+        Returns the cached surface and distance transform of a label (None if the label is absent).
+        """
+        if label not in self.entries:
+            box = get_box(self.boxes, label)
+            if box is None:
+                self.entries[label] = None
+            else:
+                box = pad_box(box, self.gt_data.shape, self.margin)
+                start = np.array([s.start for s in box])
+                surface = extract_surface(self.gt_data[box] == label)
+                edt = distance_transform_edt(~surface, sampling=self.spacing).astype(np.float32)
+                self.entries[label] = dict(box=box, start=start, stop=np.array([s.stop for s in box]), edt=edt,
+                                           surface=np.argwhere(surface) + start, tree=None)
+        return self.entries[label]
+
+    def distance_to_surface(self, label, coords):
+        """
+        Distances (in mm) from voxel coordinates to the ground-truth surface of a label.
+        """
+        entry = self.get(label)
+        inside = np.all((coords >= entry['start']) & (coords < entry['stop']), axis=1)
+        distances = np.empty(len(coords), dtype=np.float64)
+        distances[inside] = entry['edt'][tuple((coords[inside] - entry['start']).T)]
+        if not inside.all():
+            if entry['tree'] is None:
+                entry['tree'] = cKDTree(entry['surface'] * self.spacing)
+            distances[~inside] = entry['tree'].query(coords[~inside] * self.spacing)[0]
+        return distances
+
+
+def surface_distances(pred_data, pred_boxes, gt_cache, label):
+    """
+    Directed surface distances (prediction to ground truth, ground truth to prediction) for one label.
+    """
+    gt_entry = gt_cache.get(label)
+    box = pad_box(union_box(get_box(pred_boxes, label), get_box(gt_cache.boxes, label)), pred_data.shape, 1)
+    start = np.array([s.start for s in box])
+    pred_surface = extract_surface(pred_data[box] == label)
+    pred_coords = np.argwhere(pred_surface) + start
+    # the box contains the whole prediction surface, so this transform is exact for the GT surface points
+    pred_edt = distance_transform_edt(~pred_surface, sampling=gt_cache.spacing)
+    dist_gt2pred = pred_edt[tuple((gt_entry['surface'] - start).T)]
+    dist_pred2gt = gt_cache.distance_to_surface(label, pred_coords)
+    return dist_pred2gt, dist_gt2pred
+
+
+def cal_metrics_subject(file, prediction_dirs, GT_dir, labels, metrics, margin=10):
+    """
+    Calculate the selected metrics of each label for one subject and every prediction set.
+    Labels absent from both volumes are skipped.
+
+    Returns a dict {prediction_dir: rows}, where each row is [file, label, *metric values],
+    or None if the ground truth of the subject is missing.
+    """
+    if not os.path.isfile(os.path.join(GT_dir, file)):
+        return None
+    gt_nii = nib.load(os.path.join(GT_dir, file))
+    gt_data = load_labels(os.path.join(GT_dir, file))
+    gt_cache = None
+    if any(metric in SURFACE_METRICS for metric in metrics):
+        gt_cache = GTDistanceCache(gt_data, gt_nii.header.get_zooms()[:3], margin=margin)
+
+    results = {}
+    for prediction_dir in prediction_dirs:
+        path_pred = os.path.join(prediction_dir, file)
+        if not os.path.isfile(path_pred):
+            print(f"Warning: '{path_pred}' does not exist, skipped")
+            continue
+        pred_data = load_labels(path_pred)
+        nb_labels = int(max(pred_data.max(initial=0), gt_data.max(initial=0), max(labels))) + 1
+        hist = joint_histogram(pred_data, gt_data, nb_labels)
+        intersection = np.diag(hist)
+        size_pred = hist.sum(axis=1)
+        size_gt = hist.sum(axis=0)
+        pred_boxes = find_objects(pred_data) if gt_cache is not None else None
+
+        rows = []
+        for label in labels:
+            denominator = size_pred[label] + size_gt[label]
+            if denominator == 0:
+                continue
+            values = {}
+            values['dice'] = intersection[label] * 2.0 / denominator
+            values['jaccard'] = intersection[label] / (denominator - intersection[label])
+            values['vs'] = 1.0 - abs(int(size_pred[label]) - int(size_gt[label])) / denominator
+            if gt_cache is not None:
+                if size_pred[label] == 0 or size_gt[label] == 0:
+                    values['hd95'] = values['assd'] = np.nan
+                else:
+                    dist_pred2gt, dist_gt2pred = surface_distances(pred_data, pred_boxes, gt_cache, label)
+                    values['hd95'] = np.percentile(np.hstack((dist_pred2gt, dist_gt2pred)), 95)
+                    values['assd'] = 0.5 * (dist_pred2gt.mean() + dist_gt2pred.mean())
+            rows.append([file, label] + [values[metric] for metric in metrics])
+        results[prediction_dir] = rows
+    return results
+
+
+def _cal_metrics_subject(task):
+    return cal_metrics_subject(*task)
+
+
+if __name__ == '__main__':
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='Calculate Dice Similarity Coefficient (and other overlap/surface-distance metrics) between model predictions and ground truth segmentations.')
+    parser.add_argument('--prediction_dir', type=str, nargs='+', help='Path to directory (or directories, e.g. 2d 3dF 3dCF) containing model prediction NIfTI files')
+    parser.add_argument('--GT_dir', type=str, help='Path to directory containing ground truth segmentation NIfTI files')
+    parser.add_argument('--DSC_dir', type=str, help='Path to directory where DSC results should be saved')
+    parser.add_argument('--labels', type=int, nargs='+', default=list(range(1, 6)), help='Labels to calculate DSC for (default: 1 2 3 4 5)')
+    parser.add_argument('--metrics', type=str, nargs='+', default=['dice'], choices=list(METRIC_COLUMNS), help='Metrics to calculate: dice, jaccard, vs (volume similarity), hd95 and assd in mm (default: dice)')
+    parser.add_argument('--margin', type=int, default=10, help='Margin (in voxels) around each ground-truth label for the cached distance transform (default: 10)')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(), help='Number of worker processes (default: number of CPUs)')
+    args = parser.parse_args()
+
+    # Create DSC directory if it doesn't exist
+    if not os.path.exists(args.DSC_dir):
+        os.makedirs(args.DSC_dir)
+
+    # Define labels and metrics to calculate
+    labels = [int(label) for label in args.labels]
+    metrics = list(dict.fromkeys(args.metrics))
+
+    # Get list of NIfTI files in the prediction directories
+    prediction_files = []
+    for prediction_dir in args.prediction_dir:
+        prediction_files += [f for f in os.listdir(prediction_dir) if f.endswith('.nii.gz') and not f.startswith('.') and f not in prediction_files]
+
+    # Calculate metrics for each subject, spread over a process pool
+    # (all prediction sets of a subject are scored in the same task to reuse the ground-truth cache)
+    tasks = [(file, args.prediction_dir, args.GT_dir, labels, metrics, args.margin) for file in prediction_files]
+    results = []
+    missing_gt = []
+    with ProcessPoolExecutor(max_workers=max(1, args.num_workers)) as pool:
+        for task, subject_results in zip(tasks, pool.map(_cal_metrics_subject, tasks, chunksize=4)):
+            if subject_results is None:
+                missing_gt.append(task[0])
+                continue
+            for prediction_dir, rows in subject_results.items():
+                if len(args.prediction_dir) > 1:
+                    rows = [[os.path.basename(os.path.normpath(prediction_dir))] + row for row in rows]
+                results.extend(rows)
+    if missing_gt:
+        print(f"Warning: no ground truth in '{args.GT_dir}' for {len(missing_gt)} prediction(s), skipped: {sorted(missing_gt)}")
+
+    # Save results to CSV file
+    header = ['File', 'Label'] + [METRIC_COLUMNS[metric] for metric in metrics]
+    if len(args.prediction_dir) > 1:
+        header = ['Prediction'] + header
+    file_results = 'dsc_results.csv' if metrics == ['dice'] else 'metrics_results.csv'
+    with open(os.path.join(args.DSC_dir, file_results), 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(header)
+        for result in results:
+            writer.writerow(result)
@@ -0,0 +1,133 @@
+import os
+import csv
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import find_objects, generate_binary_structure, label as label_components
+
+from cal_DSC import load_labels
+
+# columns of the component statistics
+STATS_HEADER = ['File', 'Label', 'Components', 'Removed', 'VoxelsKept', 'VoxelsRemoved', 'LargestVoxels', 'VolumeRemoved_mm3']
+
+
+def removed_components(sizes, voxel_volume, min_voxels=0, min_volume=0.0, min_percent=0.0, keep_largest=False):
+    """
+    Mask of the components (sizes in voxels, of one label) to remove.
+
+    A component is removed if it is smaller than min_voxels, min_volume (mm^3) or min_percent of
+    the label (the rule of CM_cal_deleteSmallComponents.m), or if it is not the largest one and
+    keep_largest is set.
+    """
+    remove = (sizes < min_voxels) | (sizes * voxel_volume < min_volume)
+    if min_percent > 0:
+        remove |= np.round(100.0 * sizes / sizes.sum()) < min_percent
+    if keep_largest and sizes.size > 1:
+        largest = np.zeros(sizes.size, dtype=bool)
+        largest[np.argmax(sizes)] = True
+        remove |= ~largest
+    return remove
+
+
+def clean_label(data, box, label, structure, voxel_volume, **thresholds):
+    """
+    Removes the small components of one label in place (set to background), in its bounding box.
+
+    Returns [components, removed, voxels kept, voxels removed, largest component size (voxels)].
+    """
+    crop = data[box]
+    lmap, nb_components = label_components(crop == label, structure=structure)
+    if nb_components == 0:
+        return [0, 0, 0, 0, 0]
+    sizes = np.bincount(lmap.ravel(), minlength=nb_components + 1)[1:]
+    remove = removed_components(sizes, voxel_volume, **thresholds)
+    if remove.any():
+        # index 0 (background of the label map) is never removed
+        crop[np.concatenate(([False], remove))[lmap]] = 0
+    return [nb_components, int(remove.sum()), int(sizes[~remove].sum()), int(sizes[remove].sum()), int(sizes.max())]
+
+
+def clean_subject(file, input_dir, output_dir, labels, connectivity=3, keep_largest=(), **thresholds):
+    """
+    Removes the small components of the labels of one segmentation mask and saves it.
+
+    Returns the rows of the component statistics, one per label present in the mask.
+    """
+    nii = nib.load(os.path.join(input_dir, file))
+    data = load_labels(os.path.join(input_dir, file))
+    voxel_volume = float(np.prod(nii.header.get_zooms()[:3]))
+    structure = generate_binary_structure(data.ndim, connectivity)
+    # boxes of the input labels; removing a component of one label does not change the others
+    boxes = find_objects(data)
+    rows = []
+    for label in labels:
+        box = boxes[label - 1] if 0 < label <= len(boxes) else None
+        if box is None:
+            continue
+        stats = clean_label(data, box, label, structure, voxel_volume, keep_largest=label in keep_largest, **thresholds)
+        rows.append([file, label] + stats + [round(stats[3] * voxel_volume, 4)])
+
+    # written under a temporary name, so the output folder can be the input folder
+    img = nib.Nifti1Image(data, nii.affine, nii.header)
+    img.set_data_dtype(data.dtype)
+    path_out = os.path.join(output_dir, file)
+    path_tmp = os.path.join(output_dir, '.tmp_' + file)
+    try:
+        nib.save(img, path_tmp)
+        os.replace(path_tmp, path_out)
+    finally:
+        if os.path.exists(path_tmp):
+            os.remove(path_tmp)
+    return rows
+
+
+def _clean_subject(task):
+    file, input_dir, output_dir, labels, kwargs = task
+    return clean_subject(file, input_dir, output_dir, labels, **kwargs)
+
+
+if __name__ == '__main__':
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='Remove small connected components of the labels of segmentation masks (e.g. nnUNet predictions).')
+    parser.add_argument('--input_dir', type=str, required=True, help='Path to directory containing the segmentation NIfTI files')
+    parser.add_argument('--output_dir', type=str, required=True, help='Path to directory where the cleaned segmentations (and component_stats.csv) should be saved (may be the input directory)')
+    parser.add_argument('--labels', type=int, nargs='+', default=list(range(1, 6)), help='Labels to clean (default: 1 2 3 4 5)')
+    parser.add_argument('--min_voxels', type=int, default=0, help='Remove components with fewer voxels (default: 0)')
+    parser.add_argument('--min_volume', type=float, default=0.0, help='Remove components with a smaller volume in mm^3 (default: 0)')
+    parser.add_argument('--min_percent', type=float, default=0.0, help='Remove components smaller than this percentage of the label (default: 0)')
+    parser.add_argument('--keep_largest', type=int, nargs='*', help='Labels of which only the largest component is kept (no labels: all the labels to clean)')
+    parser.add_argument('--connectivity', type=int, default=3, choices=[1, 2, 3], help='Connectivity of the components: 1 (6-), 2 (18-) or 3 (26-connectivity) (default: 3)')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(), help='Number of worker processes (default: number of CPUs)')
+    args = parser.parse_args()
+
+    # Create output directory if it doesn't exist
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # "--keep_largest" without labels applies to all the labels to clean
+    labels = [int(label) for label in args.labels]
+    if args.keep_largest is None:
+        keep_largest = []
+    else:
+        keep_largest = [int(label) for label in args.keep_largest] or labels
+    kwargs = dict(connectivity=args.connectivity, keep_largest=keep_largest, min_voxels=args.min_voxels,
+                  min_volume=args.min_volume, min_percent=args.min_percent)
+
+    # Clean each subject, spread over a process pool
+    files = sorted(f for f in os.listdir(args.input_dir) if f.endswith(('.nii.gz', '.nii')) and not f.startswith('.tmp_'))
+    tasks = [(file, args.input_dir, args.output_dir, labels, kwargs) for file in files]
+    results = []
+    time_start = time.time()
+    with ProcessPoolExecutor(max_workers=max(1, args.num_workers)) as pool:
+        for rows in pool.map(_clean_subject, tasks, chunksize=4):
+            results.extend(rows)
+    nb_removed = sum(row[3] for row in results)
+    print(f'Cleaned {len(files)} segmentations in {time.time() - time_start:.1f} s ({nb_removed} components removed)')
+
+    # Save component statistics to CSV file
+    with open(os.path.join(args.output_dir, 'component_stats.csv'), 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(STATS_HEADER)
+        for result in results:
+            writer.writerow(result)
@@ -0,0 +1,415 @@
+"""
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+Header-only catalog of NIfTI/MHD images
+<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
+
+Only the headers of the images are read (in parallel): the first bytes of a .nii.gz
+file are decompressed and .mhd headers are parsed as text. The shape, data type,
+voxel size, affine matrix (NIfTI RAS+ convention; .mhd files are converted from LPS+),
+orientation code (e.g. RAS) and a content hash of every file are stored in an indexed
+SQLite table. A refresh only reads the files whose modification time or size changed,
+so a cohort is validated in seconds:
+    - unreadable headers
+    - orientations (or shapes) other than the expected ones, or the majority of a folder
+    - images and labels (paired by file name, the nnU-Net "_0000" suffix is ignored)
+      whose shape or affine matrix differ, e.g. the RAS+/LPS+ issue of the OAI-ZIB masks
+      described in "raw2nii.py"
+    - files with the same content
+and the images are listed by shape for batched prediction.
+
+Usage:
+    # catalog and validate the images and labels
+    python niiCatalog.py --db catalog.sqlite --dirs imagesTr labelsTr --validate \
+        --expect_axcodes RAS --pair imagesTr labelsTr
+    # one list of images per shape (e.g. for "--list_targetImg" of "inference_temp2img_warpTempSeg.py")
+    python niiCatalog.py --db catalog.sqlite --dirs imagesInference --groups shapeLists
+
+Copyright 2023 Yongcheng Yao
+
+-----------------------------------------------------------------------------------
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+compliance with the License. You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed under the License is
+distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+implied. See the License for the specific language governing permissions and limitations under
+the License.
+-----------------------------------------------------------------------------------
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+IMAGE_EXTENSIONS = ('.nii.gz', '.nii', '.mhd')
+
+# data types of MetaImage files
+MET_TYPES = {'MET_CHAR': 'int8', 'MET_UCHAR': 'uint8', 'MET_SHORT': 'int16', 'MET_USHORT': 'uint16',
+             'MET_INT': 'int32', 'MET_UINT': 'uint32', 'MET_LONG': 'int64', 'MET_ULONG': 'uint64',
+             'MET_LONG_LONG': 'int64', 'MET_ULONG_LONG': 'uint64', 'MET_FLOAT': 'float32', 'MET_DOUBLE': 'float64'}
+
+# bytes read from the start and the end of a file for the fast hash
+FAST_HASH_BYTES = 1 << 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY,
+    folder TEXT,
+    name TEXT,
+    format TEXT,
+    mtime REAL,
+    size INTEGER,
+    shape TEXT,
+    dtype TEXT,
+    spacing TEXT,
+    affine TEXT,
+    axcodes TEXT,
+    hash TEXT,
+    error TEXT,
+    scanned REAL
+);
+CREATE INDEX IF NOT EXISTS idx_images_folder ON images(folder);
+CREATE INDEX IF NOT EXISTS idx_images_name ON images(name);
+CREATE INDEX IF NOT EXISTS idx_images_shape ON images(shape);
+CREATE INDEX IF NOT EXISTS idx_images_hash ON images(hash);
+"""
+
+COLUMNS = ('path', 'folder', 'name', 'format', 'mtime', 'size', 'shape', 'dtype', 'spacing', 'affine', 'axcodes',
+           'hash', 'error', 'scanned')
+
+
+def split_ext(path):
+    """
+    File name without the image extension, and the extension.
+    """
+    base = os.path.basename(path)
+    for ext in IMAGE_EXTENSIONS:
+        if base.endswith(ext):
+            return base[:-len(ext)], ext
+    return os.path.splitext(base)
+
+
+def read_mhd_header(path):
+    """
+    Key-value pairs of a MetaImage header.
+    """
+    header = {}
+    with open(path, 'r', errors='ignore') as f:
+        for line in f:
+            key, sep, value = line.partition('=')
+            if sep:
+                header[key.strip()] = value.strip()
+            if key.strip() == 'ElementDataFile':
+                break
+    return header
+
+
+def data_files(path):
+    """
+    The files holding an image: the .mhd header and its data file, or the NIfTI file.
+    """
+    if not path.endswith('.mhd'):
+        return [path]
+    value = read_mhd_header(path).get('ElementDataFile', 'LOCAL')
+    if value == 'LOCAL':
+        return [path]
+    return [path, os.path.join(os.path.dirname(path), value)]
+
+
+def file_signature(path):
+    """
+    Modification time (latest) and size (total) of the files of an image.
+    """
+    stats = [os.stat(file) for file in data_files(path) if os.path.isfile(file)]
+    return max(stat.st_mtime for stat in stats), sum(stat.st_size for stat in stats)
+
+
+def content_hash(path, mode='full'):
+    """
+    SHA-1 of the files of an image ('full'), or of their sizes and first and last MB ('fast').
+    """
+    if mode == 'none':
+        return None
+    sha1 = hashlib.sha1()
+    for file in data_files(path):
+        with open(file, 'rb') as f:
+            if mode == 'fast':
+                size = os.fstat(f.fileno()).st_size
+                sha1.update(str(size).encode())
+                sha1.update(f.read(FAST_HASH_BYTES))
+                if size > 2 * FAST_HASH_BYTES:
+                    f.seek(-FAST_HASH_BYTES, os.SEEK_END)
+                    sha1.update(f.read())
+            else:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    sha1.update(block)
+    return sha1.hexdigest()
+
+
+def read_header(path):
+    """
+    Shape, data type, voxel size and affine matrix (RAS+) of an image, from its header only.
+    """
+    if path.endswith('.mhd'):
+        header = read_mhd_header(path)
+        shape = [int(v) for v in header['DimSize'].split()]
+        ndim = len(shape)
+        spacing = [float(v) for v in header.get('ElementSpacing', header.get('ElementSize', ' '.join(['1'] * ndim))).split()]
+        origin = [float(v) for v in header.get('Offset', header.get('Position', header.get('Origin', ' '.join(['0'] * ndim)))).split()]
+        matrix = header.get('TransformMatrix', header.get('Rotation', header.get('Orientation')))
+        matrix = np.eye(ndim) if matrix is None else np.reshape([float(v) for v in matrix.split()], (ndim, ndim))
+        # row i of TransformMatrix is the direction of axis i (LPS+), as read by ITK
+        affine = np.eye(4)
+        affine[:ndim, :ndim] = matrix.T * np.asarray(spacing)
+        affine[:ndim, 3] = origin
+        affine = np.diag([-1.0, -1.0, 1.0, 1.0]) @ affine
+        dtype = MET_TYPES.get(header.get('ElementType'), header.get('ElementType'))
+        nb_channels = int(header.get('ElementNumberOfChannels', 1))
+        if nb_channels > 1:
+            shape = shape + [nb_channels]
+        return shape, dtype, spacing, affine
+
+    import nibabel as nib
+    img = nib.load(path)
+    shape = [int(n) for n in img.header.get_data_shape()]
+    spacing = [round(float(v), 6) for v in img.header.get_zooms()[:min(len(shape), 3)]]
+    return shape, img.header.get_data_dtype().name, spacing, img.affine
+
+
+def axcodes(affine):
+    import nibabel as nib
+    return ''.join(nib.aff2axcodes(affine))
+
+
+def scan_file(task):
+    """
+    The catalog record of one file (with the error message if the header cannot be read).
+    """
+    path, hash_mode = task
+    name, ext = split_ext(path)
+    mtime, size = file_signature(path)
+    record = dict(path=path, folder=os.path.dirname(path), name=name, format=ext.lstrip('.'), mtime=mtime,
+                  size=size, shape=None, dtype=None, spacing=None, affine=None, axcodes=None, hash=None,
+                  error=None, scanned=time.time())
+    try:
+        shape, dtype, spacing, affine = read_header(path)
+        record.update(shape='x'.join(map(str, shape)), dtype=dtype, spacing=json.dumps(spacing),
+                      affine=json.dumps(np.round(affine, 6).tolist()), axcodes=axcodes(affine))
+        record['hash'] = content_hash(path, hash_mode)
+    except Exception as e:
+        record['error'] = '%s: %s' % (type(e).__name__, e)
+    return record
+
+
+def list_images(folder, recursive=False):
+    pattern = os.path.join(folder, '**', '*') if recursive else os.path.join(folder, '*')
+    return sorted(os.path.abspath(path) for path in glob.glob(pattern, recursive=recursive)
+                  if path.endswith(IMAGE_EXTENSIONS) and os.path.isfile(path))
+
+
+class ImageCatalog:
+    """
+    SQLite table of image headers, refreshed incrementally.
+    """
+
+    def __init__(self, path_db):
+        self.path_db = path_db
+        self.db = sqlite3.connect(path_db)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+
+    def refresh(self, folders, recursive=False, hash_mode='full', num_workers=None, force=False):
+        """
+        Reads the headers of the new and changed images of the folders and removes the deleted ones.
+        Returns the numbers of scanned, unchanged and removed files.
+        """
+        paths = [path for folder in folders for path in list_images(folder, recursive)]
+        known = {record['path']: (record['mtime'], record['size'], record['hash'] is None)
+                 for folder in folders for record in self.records(folder, recursive)}
+        tasks = []
+        for path in paths:
+            signature = file_signature(path)
+            previous = known.get(path)
+            # a file is scanned again if it changed, or if a hash is requested but missing
+            if force or previous is None or previous[:2] != signature or (hash_mode != 'none' and previous[2]):
+                tasks.append((path, hash_mode))
+        removed = sorted(set(known) - set(paths))
+
+        with ProcessPoolExecutor(max_workers=max(1, num_workers or os.cpu_count())) as pool:
+            records = list(pool.map(scan_file, tasks, chunksize=8))
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO images (%s) VALUES (%s)' % (', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+                                [tuple(record[column] for column in COLUMNS) for record in records])
+            self.db.executemany('DELETE FROM images WHERE path = ?', [(path,) for path in removed])
+        return len(tasks), len(paths) - len(tasks), len(removed)
+
+    def records(self, folder=None, recursive=False):
+        """
+        The records of a folder (and its subfolders with recursive), or all records, sorted by path.
+        """
+        if folder is None:
+            rows = self.db.execute('SELECT * FROM images ORDER BY path')
+        elif recursive:
+            folder = os.path.abspath(folder)
+            rows = self.db.execute('SELECT * FROM images WHERE folder = ? OR substr(folder, 1, ?) = ? ORDER BY path',
+                                   (folder, len(folder) + 1, folder + os.sep))
+        else:
+            rows = self.db.execute('SELECT * FROM images WHERE folder = ? ORDER BY path', (os.path.abspath(folder),))
+        return [dict(row) for row in rows]
+
+    def shape_groups(self, folder=None, recursive=False):
+        """
+        The paths of the readable images grouped by shape.
+        """
+        groups = collections.defaultdict(list)
+        for record in self.records(folder, recursive):
+            if record['error'] is None:
+                groups[record['shape']].append(record['path'])
+        return dict(groups)
+
+    def close(self):
+        self.db.close()
+
+
+def pair_key(name):
+    # nnU-Net images carry a channel suffix that the labels do not
+    return name[:-len('_0000')] if name.endswith('_0000') else name
+
+
+def validate(records, expect_axcodes=None, expect_shape=None):
+    """
+    Issues of the images of one folder, as (path, message) pairs.
+    """
+    issues = []
+    readable = [record for record in records if record['error'] is None]
+    for record in records:
+        if record['error'] is not None:
+            issues.append((record['path'], 'unreadable header (%s)' % record['error']))
+    if not readable:
+        return issues
+    # without an expected value, the majority of the folder is expected
+    majority_axcodes = collections.Counter(record['axcodes'] for record in readable).most_common(1)[0][0]
+    for record in readable:
+        expected = expect_axcodes or majority_axcodes
+        if record['axcodes'] != expected:
+            issues.append((record['path'], 'orientation %s, expected %s' % (record['axcodes'], expected)))
+        if expect_shape and record['shape'] != expect_shape:
+            issues.append((record['path'], 'shape %s, expected %s' % (record['shape'], expect_shape)))
+    return issues
+
+
+def validate_pairs(records_img, records_seg, atol=1e-3):
+    """
+    Issues of the image/label pairs of two folders (paired by file name), as (path, message) pairs.
+    """
+    issues = []
+    segs = {pair_key(record['name']): record for record in records_seg}
+    imgs = {pair_key(record['name']): record for record in records_img}
+    for key, img in imgs.items():
+        seg = segs.get(key)
+        if seg is None:
+            issues.append((img['path'], 'no label'))
+            continue
+        if img['error'] is not None or seg['error'] is not None:
+            continue
+        if img['shape'].split('x')[:3] != seg['shape'].split('x')[:3]:
+            issues.append((seg['path'], 'shape %s, image shape %s' % (seg['shape'], img['shape'])))
+        elif not np.allclose(json.loads(img['affine']), json.loads(seg['affine']), atol=atol):
+            issues.append((seg['path'], 'affine matrix (%s) differs from the image (%s)' % (seg['axcodes'], img['axcodes'])))
+    for key in sorted(set(segs) - set(imgs)):
+        issues.append((segs[key]['path'], 'no image'))
+    return issues
+
+
+def find_duplicates(records):
+    """
+    Files with the same content hash, as (path, message) pairs.
+    """
+    by_hash = collections.defaultdict(list)
+    for record in records:
+        if record['hash'] is not None:
+            by_hash[record['hash']].append(record['path'])
+    return [(path, 'same content as %s' % paths[0]) for paths in by_hash.values() if len(paths) > 1 for path in paths[1:]]
+
+
+def summary(records):
+    """
+    Counts of the shapes, orientations, data types and voxel sizes of a folder.
+    """
+    readable = [record for record in records if record['error'] is None]
+    lines = ['%d files (%d unreadable)' % (len(records), len(records) - len(readable))]
+    for column in ('shape', 'axcodes', 'dtype', 'spacing'):
+        counts = collections.Counter(record[column] for record in readable)
+        lines.append('  %s: %s' % (column, ', '.join('%s (%d)' % item for item in counts.most_common())))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='Catalog the headers of NIfTI/MHD images for validation and shape grouping')
+    parser.add_argument('--db', type=str, required=True, help='path to the catalog (SQLite file)')
+    parser.add_argument('--dirs', type=str, nargs='+', required=True, help='image folder(s) to catalog')
+    parser.add_argument('--recursive', action='store_true', help='include the subfolders')
+    parser.add_argument('--hash', type=str, default='full', choices=['full', 'fast', 'none'],
+                        help='content hash: full (SHA-1 of the files), fast (of the size and the first and last MB), or none (default: full)')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(), help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('--force', action='store_true', help='read all headers, even of the unchanged files')
+    parser.add_argument('--validate', action='store_true', help='report invalid files (exit code 1 if any)')
+    parser.add_argument('--expect_axcodes', type=str, help='(optional) expected orientation code, e.g. RAS (default: the majority of each folder)')
+    parser.add_argument('--expect_shape', type=int, nargs='+', help='(optional) expected image shape, e.g. 160 384 384')
+    parser.add_argument('--pair', type=str, nargs=2, metavar=('DIR_IMG', 'DIR_SEG'),
+                        help='(optional) image and label folders whose pairs must have the same shape and affine matrix')
+    parser.add_argument('--groups', type=str, help='(optional) output folder of one list of images per shape (shape_<shape>.txt)')
+    args = parser.parse_args()
+
+    for folder in args.dirs + (args.pair or []):
+        if not os.path.isdir(folder):
+            raise ValueError(f"Image folder '{folder}' does not exist")
+    folders = list(dict.fromkeys(args.dirs + (args.pair or [])))
+
+    catalog = ImageCatalog(args.db)
+    time_start = time.time()
+    nb_scanned, nb_unchanged, nb_removed = catalog.refresh(folders, recursive=args.recursive, hash_mode=args.hash,
+                                                           num_workers=args.num_workers, force=args.force)
+    print(f'Catalog {args.db}: {nb_scanned} headers read, {nb_unchanged} unchanged, {nb_removed} removed '
+          f'({time.time() - time_start:.1f} s)')
+
+    records = {folder: catalog.records(folder, args.recursive) for folder in folders}
+    for folder in folders:
+        print(f'{folder}: ' + summary(records[folder]))
+
+    if args.groups:
+        os.makedirs(args.groups, exist_ok=True)
+        groups = collections.defaultdict(list)
+        for folder in args.dirs:
+            for shape, paths in catalog.shape_groups(folder, args.recursive).items():
+                groups[shape] += paths
+        for shape, paths in sorted(groups.items()):
+            with open(os.path.join(args.groups, f'shape_{shape}.txt'), 'w') as f:
+                f.write('\n'.join(paths) + '\n')
+            print(f'shape {shape}: {len(paths)} images')
+
+    if args.validate:
+        expect_shape = 'x'.join(map(str, args.expect_shape)) if args.expect_shape else None
+        issues = []
+        for folder in folders:
+            issues += validate(records[folder], args.expect_axcodes, expect_shape)
+        if args.pair:
+            issues += validate_pairs(records[args.pair[0]], records[args.pair[1]])
+        issues += find_duplicates([record for folder in folders for record in records[folder]])
+        for path, message in issues:
+            print(f'{path}: {message}')
+        print(f'{len(issues)} issue(s) found')
+        catalog.close()
+        sys.exit(1 if issues else 0)
+    catalog.close()